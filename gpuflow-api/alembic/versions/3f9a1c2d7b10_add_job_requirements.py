@@ -0,0 +1,37 @@
+"""add job requirements
+
+Revision ID: 3f9a1c2d7b10
+Revises: a511abc5d2ca
+Create Date: 2026-01-05 10:12:41.118230
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3f9a1c2d7b10"
+down_revision: Union[str, Sequence[str], None] = "a511abc5d2ca"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("job", sa.Column("requirements", sa.JSON(), nullable=True))
+    op.create_index(
+        "ix_machine_idle_vram",
+        "machine",
+        ["vram_gb"],
+        unique=False,
+        postgresql_where=sa.text("is_online AND status = 'idle'"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_machine_idle_vram", table_name="machine")
+    op.drop_column("job", "requirements")
@@ -0,0 +1,29 @@
+"""add job error message
+
+Revision ID: 8c2e4b6a9d31
+Revises: 3f9a1c2d7b10
+Create Date: 2026-01-09 14:03:27.552904
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8c2e4b6a9d31"
+down_revision: Union[str, Sequence[str], None] = "3f9a1c2d7b10"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("job", sa.Column("error_message", sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("job", "error_message")
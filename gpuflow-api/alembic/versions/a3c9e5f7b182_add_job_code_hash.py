@@ -0,0 +1,35 @@
+"""add job code hash
+
+Revision ID: a3c9e5f7b182
+Revises: f2b8d6e1a4c9
+Create Date: 2026-02-02 14:07:45.318226
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a3c9e5f7b182"
+down_revision: Union[str, Sequence[str], None] = "f2b8d6e1a4c9"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("job", sa.Column("code_hash", sa.String(length=64), nullable=True))
+    op.alter_column(
+        "job", "pickled_function", existing_type=sa.LargeBinary(), nullable=True
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.alter_column(
+        "job", "pickled_function", existing_type=sa.LargeBinary(), nullable=False
+    )
+    op.drop_column("job", "code_hash")
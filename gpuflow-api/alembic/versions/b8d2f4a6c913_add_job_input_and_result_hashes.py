@@ -0,0 +1,31 @@
+"""add job input and result hashes
+
+Revision ID: b8d2f4a6c913
+Revises: a3c9e5f7b182
+Create Date: 2026-02-05 10:26:03.874512
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b8d2f4a6c913"
+down_revision: Union[str, Sequence[str], None] = "a3c9e5f7b182"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("job", sa.Column("input_hash", sa.String(length=64), nullable=True))
+    op.add_column("job", sa.Column("result_hash", sa.String(length=64), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("job", "result_hash")
+    op.drop_column("job", "input_hash")
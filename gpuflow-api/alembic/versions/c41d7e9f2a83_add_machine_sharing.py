@@ -0,0 +1,65 @@
+"""add machine sharing
+
+Revision ID: c41d7e9f2a83
+Revises: 8c2e4b6a9d31
+Create Date: 2026-01-16 09:41:05.730112
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c41d7e9f2a83"
+down_revision: Union[str, Sequence[str], None] = "8c2e4b6a9d31"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "machine",
+        sa.Column(
+            "max_concurrent_jobs", sa.Integer(), server_default="1", nullable=False
+        ),
+    )
+    op.add_column(
+        "machine",
+        sa.Column("running_jobs", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.add_column(
+        "machine",
+        sa.Column(
+            "vram_allocated_gb", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.add_column("job", sa.Column("vram_gb", sa.Integer(), nullable=True))
+    # the fallback scan now looks for free slots instead of status == 'idle'
+    op.drop_index("ix_machine_idle_vram", table_name="machine")
+    op.create_index(
+        "ix_machine_free_vram",
+        "machine",
+        [sa.text("(vram_gb - vram_allocated_gb)")],
+        unique=False,
+        postgresql_where=sa.text("is_online AND running_jobs < max_concurrent_jobs"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_machine_free_vram", table_name="machine")
+    op.create_index(
+        "ix_machine_idle_vram",
+        "machine",
+        ["vram_gb"],
+        unique=False,
+        postgresql_where=sa.text("is_online AND status = 'idle'"),
+    )
+    op.drop_column("job", "vram_gb")
+    op.drop_column("machine", "vram_allocated_gb")
+    op.drop_column("machine", "running_jobs")
+    op.drop_column("machine", "max_concurrent_jobs")
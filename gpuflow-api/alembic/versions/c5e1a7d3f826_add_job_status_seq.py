@@ -0,0 +1,32 @@
+"""add job status seq
+
+Revision ID: c5e1a7d3f826
+Revises: b8d2f4a6c913
+Create Date: 2026-02-09 15:48:21.603917
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c5e1a7d3f826"
+down_revision: Union[str, Sequence[str], None] = "b8d2f4a6c913"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "job",
+        sa.Column("status_seq", sa.Integer(), server_default="0", nullable=False),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("job", "status_seq")
@@ -0,0 +1,52 @@
+"""add job leases
+
+Revision ID: d5a8f1b3c627
+Revises: c41d7e9f2a83
+Create Date: 2026-01-21 16:22:48.904417
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d5a8f1b3c627"
+down_revision: Union[str, Sequence[str], None] = "c41d7e9f2a83"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "job", sa.Column("lease_expires_at", sa.DateTime(timezone=True), nullable=True)
+    )
+    op.add_column(
+        "job",
+        sa.Column("attempts", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.create_index(
+        "ix_job_active_lease",
+        "job",
+        ["lease_expires_at"],
+        unique=False,
+        postgresql_where=sa.text("status IN ('assigned', 'running')"),
+    )
+    op.create_index(
+        "ix_job_active_machine",
+        "job",
+        ["machine_id"],
+        unique=False,
+        postgresql_where=sa.text("status IN ('assigned', 'running')"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_job_active_machine", table_name="job")
+    op.drop_index("ix_job_active_lease", table_name="job")
+    op.drop_column("job", "attempts")
+    op.drop_column("job", "lease_expires_at")
@@ -0,0 +1,39 @@
+"""add job priority and user share weight
+
+Revision ID: d7a4b2e9c160
+Revises: c5e1a7d3f826
+Create Date: 2026-02-11 10:27:44.318205
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d7a4b2e9c160"
+down_revision: Union[str, Sequence[str], None] = "c5e1a7d3f826"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "job",
+        sa.Column(
+            "priority", sa.String(length=16), server_default="normal", nullable=False
+        ),
+    )
+    op.add_column(
+        "user",
+        sa.Column("share_weight", sa.Integer(), server_default="1", nullable=False),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("user", "share_weight")
+    op.drop_column("job", "priority")
@@ -0,0 +1,31 @@
+"""add machine last_seen_at
+
+Revision ID: e7c3a9d4f218
+Revises: d5a8f1b3c627
+Create Date: 2026-01-23 11:04:37.215903
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e7c3a9d4f218"
+down_revision: Union[str, Sequence[str], None] = "d5a8f1b3c627"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "machine", sa.Column("last_seen_at", sa.DateTime(timezone=True), nullable=True)
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("machine", "last_seen_at")
@@ -0,0 +1,40 @@
+"""add job listing indexes
+
+Revision ID: f2b8d6e1a4c9
+Revises: e7c3a9d4f218
+Create Date: 2026-01-26 09:41:12.530174
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "f2b8d6e1a4c9"
+down_revision: Union[str, Sequence[str], None] = "e7c3a9d4f218"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        "ix_job_creator_created",
+        "job",
+        ["creator_id", "created_at", "id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_job_creator_status_created",
+        "job",
+        ["creator_id", "status", "created_at", "id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_job_creator_status_created", table_name="job")
+    op.drop_index("ix_job_creator_created", table_name="job")
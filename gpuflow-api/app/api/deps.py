@@ -1,35 +1,118 @@
+import math
+from typing import Any
+from uuid import UUID
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from app.core.config import CONFIG
 from app.models.users import User
 from app.models.machine import Machine
-from app.db.session import get_db
-from sqlalchemy.orm import Session
+from app.db.session import get_async_db, get_db
+from app.services.auth_cache import (
+    MACHINE_FIELDS,
+    USER_FIELDS,
+    auth_cache,
+    principal_name,
+    token_key,
+)
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
 from fastapi import Header
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=CONFIG.API_V1_STR + "/login/access-token")
 
 
-def get_current_user(
-    db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
-) -> User:
-    credentials_exception = HTTPException(
+def credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+def decode_token(token: str) -> tuple[UUID, float]:
+    """returns the user id and the expiry of a verified token"""
     try:
         payload = jwt.decode(token, CONFIG.SECRET_KEY, algorithms=[CONFIG.ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
+        # a missing or malformed subject fails here, not in the query
+        user_id = UUID(str(payload.get("sub")))
+    except (JWTError, ValueError):
+        raise credentials_exception()
+    return user_id, float(payload.get("exp") or math.inf)
+
+
+def cache_fields(principal: Any, fields: tuple[str, ...]) -> dict[str, Any]:
+    cached: dict[str, Any] = {}
+    for field in fields:
+        value = getattr(principal, field)
+        cached[field] = str(value) if isinstance(value, UUID) else value
+    return cached
+
+
+def cached_principal(model: Any, fields: dict[str, Any]) -> Any:
+    """
+    a detached instance of the cached identity, merged with load=False it
+    becomes part of the request session without a query. columns that are not
+    cached load lazily on first access, in an AsyncSession they have to be
+    refreshed first, see USER_FIELDS
+    """
+    values = dict(fields)
+    for field in ("id", "owner_id"):
+        if values.get(field) is not None:
+            values[field] = UUID(values[field])
+    principal = model(**values)
+    make_transient_to_detached(principal)
+    return principal
+
+
+def check_active(user: User) -> User:
+    if not user.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    return user
+
+
+def get_current_user(
+    db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
+) -> User:
+    key = token_key("user", token)
+    fields = auth_cache.get(key)
+    if fields is not None:
+        return check_active(db.merge(cached_principal(User, fields), load=False))
+
+    user_id, expires_at = decode_token(token)
     user = db.query(User).filter(User.id == user_id).first()
     if user is None:
-        raise credentials_exception
-    return user
+        raise credentials_exception()
+    auth_cache.put(
+        key,
+        principal_name("user", user.id),
+        cache_fields(user, USER_FIELDS),
+        expires_at,
+    )
+    return check_active(user)
+
+
+async def get_current_user_async(
+    db: AsyncSession = Depends(get_async_db), token: str = Depends(oauth2_scheme)
+) -> User:
+    key = token_key("user", token)
+    fields = await auth_cache.aget(key)
+    if fields is not None:
+        user = await db.merge(cached_principal(User, fields), load=False)
+        return check_active(user)
+
+    user_id, expires_at = decode_token(token)
+    user = await db.scalar(select(User).where(User.id == user_id))
+    if user is None:
+        raise credentials_exception()
+    await auth_cache.aput(
+        key,
+        principal_name("user", user.id),
+        cache_fields(user, USER_FIELDS),
+        expires_at,
+    )
+    return check_active(user)
 
 
 def get_current_machine(
@@ -39,7 +122,56 @@ def get_current_machine(
         raise HTTPException(status_code=401, detail="Missing Authentication")
 
     token = authorization.replace("Bearer ", "")
+    key = token_key("machine", token)
+    fields = auth_cache.get(key)
+    if fields is not None:
+        return db.merge(cached_principal(Machine, fields), load=False)
+
     machine = db.query(Machine).filter(Machine.auth_token == token).first()
     if not machine:
         raise HTTPException(status_code=401, detail="Invalid Machine token")
+    # machine tokens do not expire, rotation invalidates them
+    auth_cache.put(
+        key,
+        principal_name("machine", machine.id),
+        cache_fields(machine, MACHINE_FIELDS),
+        math.inf,
+    )
+    return machine
+
+
+async def get_current_machine_async(
+    authorization: str = Header(None), db: AsyncSession = Depends(get_async_db)
+) -> Machine:
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Missing Authentication")
+
+    token = authorization.replace("Bearer ", "")
+    key = token_key("machine", token)
+    fields = await auth_cache.aget(key)
+    if fields is not None:
+        return await db.merge(cached_principal(Machine, fields), load=False)
+
+    machine = await db.scalar(select(Machine).where(Machine.auth_token == token))
+    if not machine:
+        raise HTTPException(status_code=401, detail="Invalid Machine token")
+    await auth_cache.aput(
+        key,
+        principal_name("machine", machine.id),
+        cache_fields(machine, MACHINE_FIELDS),
+        math.inf,
+    )
     return machine
+
+
+async def get_current_principal_async(
+    authorization: str = Header(None), db: AsyncSession = Depends(get_async_db)
+) -> User | Machine:
+    """a user or a machine, for endpoints that both of them call"""
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Missing Authentication")
+    token = authorization.replace("Bearer ", "")
+    # user tokens are JWTs, machine tokens are url safe and never contain a dot
+    if token.count(".") == 2:
+        return await get_current_user_async(db, token)
+    return await get_current_machine_async(authorization, db)
@@ -0,0 +1,100 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, RedirectResponse
+from app.api import deps
+from app.core.config import CONFIG
+from app.schemas.upload import BlobResponse
+from app.services.blob_store import blob_store, is_digest
+
+router = APIRouter()
+
+# a digest always names the same bytes, caches may keep a blob forever
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def check_digest(digest: str) -> None:
+    if not is_digest(digest):
+        raise HTTPException(status_code=400, detail="Invalid digest")
+
+
+async def blob_response(
+    digest: str, request: Request, filename: Optional[str] = None
+) -> Response:
+    """
+    serves a blob without reading it into memory. local blobs go out as a
+    FileResponse, which answers Range requests and hands the file to the
+    server when it can send it without copying. blobs in s3 are a redirect to
+    a presigned url, the bytes never pass through the api
+    """
+    headers = {"ETag": f'"{digest}"', "Cache-Control": IMMUTABLE}
+    if request.headers.get("if-none-match") == f'"{digest}"':
+        return Response(status_code=304, headers=headers)
+    path = await run_in_threadpool(blob_store.local_path, digest)
+    if path is not None:
+        return FileResponse(
+            path,
+            media_type="application/octet-stream",
+            headers=headers,
+            filename=filename,
+        )
+    if not await run_in_threadpool(blob_store.exists, digest):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    url = await run_in_threadpool(blob_store.download_url, digest)
+    return RedirectResponse(url, status_code=307)
+
+
+async def read_capped_body(request: Request, limit: int) -> bytes:
+    """
+    the request body, refused with 413 as soon as it is known to pass `limit`,
+    from Content-Length up front or from the bytes read so far
+    """
+    declared = request.headers.get("content-length")
+    if declared is not None and declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail="Blob too large")
+    chunks: list[bytes] = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail="Blob too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+@router.post("/", response_model=BlobResponse)
+async def upload_blob(
+    request: Request, current_user=Depends(deps.get_current_user_async)
+):
+    """
+    stores the raw request body, uploading the same bytes twice is a no-op.
+    anything over BLOB_MAX_BYTES goes through the resumable /uploads instead
+    """
+    data = await read_capped_body(request, CONFIG.BLOB_MAX_BYTES)
+    if not data:
+        raise HTTPException(status_code=400, detail="Empty blob")
+    digest = await run_in_threadpool(blob_store.put, data)
+    return {"digest": digest, "size": len(data)}
+
+
+@router.head("/{digest}")
+async def blob_exists(digest: str, principal=Depends(deps.get_current_principal_async)):
+    # lets clients skip uploads and job payloads the store already holds
+    check_digest(digest)
+    if not await run_in_threadpool(blob_store.exists, digest):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    return Response(headers={"ETag": f'"{digest}"', "Cache-Control": IMMUTABLE})
+
+
+@router.get("/{digest}")
+async def download_blob(
+    digest: str,
+    request: Request,
+    principal=Depends(deps.get_current_principal_async),
+):
+    """
+    readable by any user or machine that knows the digest. agents are sent
+    the digest with START_JOB and only come here for code they have not cached
+    """
+    check_digest(digest)
+    return await blob_response(digest, request)
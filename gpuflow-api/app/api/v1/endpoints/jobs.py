@@ -1,80 +1,418 @@
+import asyncio
+import base64
+import json
+import re
+import uuid
+from typing import Optional
+from uuid import UUID
 from app.models.machine import Machine
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import JSON, String, Text, bindparam, case, func, insert
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer
 from app.api import deps
-from app.models.job import Job
+from app.api.v1.endpoints.blobs import blob_response
+from app.models.job import FINISHED_JOB_STATUSES, Job
 from app.models.users import User
-from app.schemas.job import JobCreate, JobResponse, JobUpdate
-from app.services.tasks import process_job_task
+from app.schemas.job import (
+    JobBatchCreate,
+    JobBatchResponse,
+    JobCode,
+    JobCreate,
+    JobResponse,
+    JobUpdate,
+)
+from app.services.blob_store import blob_store
+from app.services.matcher import release_allocation
+from app.core.config import CONFIG
+from app.services.job_logs import (
+    append_job_event,
+    job_log_hub,
+    replay_job_events,
+    stream_position,
+)
+from app.services.job_queue import pending_queue
+from app.services.job_status import apply_job_update, is_stale
+from app.services.redis_bridge import redis_bridge
+from app.services.result_cache import cache_entry, memo_key, result_cache
+from app.services.tasks import process_job_task, request_drain
 from datetime import datetime, timezone
 
 router = APIRouter()
 
+# the code blob and the arguments are never part of a JobResponse, loading them
+# would raise instead of silently pulling megabytes per page
+SKIP_PAYLOAD = (
+    defer(Job.pickled_function, raiseload=True),
+    defer(Job.function_args, raiseload=True),
+)
+
+
+# redis stream ids, what EventSource sends back as Last-Event-ID
+EVENT_ID_PATTERN = re.compile(r"^\d+-\d+$")
+
+
+def encode_cursor(job: Job) -> str:
+    position = {"created_at": job.created_at.isoformat(), "id": str(job.id)}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(position["created_at"]), UUID(position["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def store_code(job_in: JobCode) -> str:
+    """returns the digest of the job's code, storing it first when sent inline"""
+    if job_in.code_hash is not None:
+        if not await run_in_threadpool(blob_store.exists, job_in.code_hash):
+            raise HTTPException(status_code=404, detail="Code blob not found")
+        return job_in.code_hash
+    code_bytes = job_in.code_string.encode(encoding="utf-8")
+    if len(code_bytes) > CONFIG.BLOB_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Code too large")
+    return await run_in_threadpool(blob_store.put, code_bytes)
+
+
+async def check_blob(digest: Optional[str], detail: str) -> None:
+    if digest is not None and not await run_in_threadpool(blob_store.exists, digest):
+        raise HTTPException(status_code=404, detail=detail)
+
 
 @router.post(path="/", response_model=JobResponse)
-def create_job(
+async def create_job(
     job_in: JobCreate,
-    current_use=Depends(deps.get_current_user),
-    db: Session = Depends(deps.get_db),
+    current_use=Depends(deps.get_current_user_async),
+    db: AsyncSession = Depends(deps.get_async_db),
 ):
-    code_bytes = job_in.code_string.encode(encoding="utf-8")
+    await check_blob(job_in.input_hash, "Input blob not found")
+    code_hash = await store_code(job_in)
     new_job = Job(
-        creator_id=current_use.id, pickled_function=code_bytes, status="pending"
+        creator_id=current_use.id,
+        code_hash=code_hash,
+        input_hash=job_in.input_hash,
+        requirements=job_in.requirements,
+        priority=job_in.priority,
+        status="pending",
+    )
+    key = memo_key(
+        current_use.id, code_hash, None, job_in.input_hash, job_in.requirements
     )
+    (cached,) = await result_cache.lookup([key]) if key else (None,)
+    if cached is not None:
+        # an identical deterministic job completed before, no machine needed
+        now = datetime.now(timezone.utc)
+        new_job.status = "completed"
+        new_job.started_at = now
+        new_job.completed_at = now
+        new_job.result_hash = cached["result_hash"]
+        new_job.result_url = cached["result_url"]
     db.add(new_job)
-    db.commit()
-    db.refresh(new_job)
-    process_job_task.delay(str(new_job.id))
+    await db.commit()
+    await db.refresh(new_job)
+    if cached is not None:
+        return new_job
+    # the redis and broker clients block, keep them off the event loop
+    if CONFIG.SCHEDULER_MODE == "loop":
+        await run_in_threadpool(
+            pending_queue.push,
+            str(new_job.id),
+            str(current_use.id),
+            new_job.priority,
+            current_use.share_weight,
+        )
+    else:
+        await run_in_threadpool(process_job_task.delay, str(new_job.id))
     return new_job
 
 
+def batch_insert_statement():
+    """
+    one INSERT ... SELECT over unnest() of the per job columns. the code
+    digest, the creator, the requirements and the priority are bound once
+    however many rows there are. jobs answered from the result cache go in
+    completed
+    """
+    rows = (
+        func.unnest(
+            bindparam("ids", type_=ARRAY(PG_UUID(as_uuid=True))),
+            bindparam("args", type_=ARRAY(Text)),
+            bindparam("statuses", type_=ARRAY(String)),
+            bindparam("result_hashes", type_=ARRAY(String)),
+            bindparam("result_urls", type_=ARRAY(String)),
+        )
+        .table_valued("id", "function_args", "status", "result_hash", "result_url")
+        .render_derived(name="batch")
+    )
+    finished_at = case((rows.c.status == "completed", func.now()), else_=None)
+    columns = [
+        "id",
+        "creator_id",
+        "code_hash",
+        "input_hash",
+        "function_args",
+        "requirements",
+        "priority",
+        "status",
+        "result_hash",
+        "result_url",
+        "started_at",
+        "completed_at",
+    ]
+    return insert(Job.__table__).from_select(
+        columns,
+        select(
+            rows.c.id,
+            bindparam("creator_id", type_=PG_UUID(as_uuid=True)),
+            bindparam("code_hash", type_=String),
+            bindparam("input_hash", type_=String),
+            rows.c.function_args,
+            bindparam("requirements", type_=JSON),
+            bindparam("priority", type_=String),
+            rows.c.status,
+            rows.c.result_hash,
+            rows.c.result_url,
+            finished_at,
+            finished_at,
+        ),
+    )
+
+
+@router.post(path="/batch", response_model=JobBatchResponse)
+async def create_job_batch(
+    batch_in: JobBatchCreate,
+    current_use=Depends(deps.get_current_user_async),
+    db: AsyncSession = Depends(deps.get_async_db),
+):
+    await check_blob(batch_in.input_hash, "Input blob not found")
+    code_hash = await store_code(batch_in)
+    job_ids = [uuid.uuid4() for _ in batch_in.args]
+    args = [json.dumps(arg) for arg in batch_in.args]
+    keys = [
+        memo_key(
+            current_use.id, code_hash, arg, batch_in.input_hash, batch_in.requirements
+        )
+        for arg in args
+    ]
+    # one MGET for every deterministic job of the batch
+    hits = iter(await result_cache.lookup([key for key in keys if key]))
+    cached = [next(hits) if key else None for key in keys]
+    await db.execute(
+        batch_insert_statement(),
+        {
+            "ids": job_ids,
+            "args": args,
+            "statuses": ["pending" if hit is None else "completed" for hit in cached],
+            "result_hashes": [hit and hit["result_hash"] for hit in cached],
+            "result_urls": [hit and hit["result_url"] for hit in cached],
+            "creator_id": current_use.id,
+            "code_hash": code_hash,
+            "input_hash": batch_in.input_hash,
+            "requirements": batch_in.requirements,
+            "priority": batch_in.priority,
+        },
+    )
+    await db.commit()
+
+    # one script call for the whole batch and at most one broker message
+    owner_id = str(current_use.id)
+    queued = [
+        (str(job_id), owner_id, batch_in.priority)
+        for job_id, hit in zip(job_ids, cached)
+        if hit is None
+    ]
+    if queued:
+        await run_in_threadpool(
+            pending_queue.push_many, queued, {owner_id: current_use.share_weight}
+        )
+        await run_in_threadpool(request_drain)
+    return {"job_ids": job_ids}
+
+
 @router.patch(path="/{job_id}")
-def update_job_status(
+async def update_job_status(
     job_id: str,
     job_update: JobUpdate,
-    current_machine: Machine = Depends(deps.get_current_machine),
-    db: Session = Depends(deps.get_db),
+    current_machine: Machine = Depends(deps.get_current_machine_async),
+    db: AsyncSession = Depends(deps.get_async_db),
 ):
-    job: Job | None = db.query(Job).filter(Job.id == job_id).first()
+    await check_blob(job_update.result_hash, "Result blob not found")
+    # locked like the job_status flush and the lease reaper do, so only one of
+    # them can take the job out of its active state and release the allocation
+    job: Job | None = await db.scalar(
+        select(Job).where(Job.id == job_id).with_for_update()
+    )
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
+    # requeued by the reaper or reassigned meanwhile
     if str(job.machine_id) != str(current_machine.id):
         raise HTTPException(status_code=401, detail="Unauthorized to update this job")
-    if job_update.status:
-        job.status = job_update.status
-    if job_update.status == "running":
-        job.started_at: datetime = datetime.now(timezone.utc)
-    if job_update.status == "completed":
-        job.completed_at: datetime = datetime.now(timezone.utc)
-        job.result_url = job_update.result
-        if job.machine:
-            job.machine.status = "idle"
-    if job_update.error_message:
-        job.error_message = job_update.error_message
-    db.commit()
-    db.refresh(job)
+    if is_stale(job, job_update):
+        # a retried or overtaken update, the job already has a newer one
+        return job
+    if job.status in FINISHED_JOB_STATUSES:
+        raise HTTPException(status_code=409, detail="Job already finished")
+    previous_status = job.status
+    released = apply_job_update(job, job_update, datetime.now(timezone.utc))
+    if released:
+        await db.run_sync(release_allocation, job)
+    await db.commit()
+    await db.refresh(job)
+    if job.status != previous_status:
+        await append_job_event(str(job.id), "status", {"status": job.status})
+        entry = cache_entry(job)
+        if entry is not None:
+            await result_cache.remember(dict([entry]))
+    if released:
+        # the job ran on current_machine, reload the counters the release changed
+        await db.refresh(current_machine)
+    if released and current_machine.is_online:
+        # only re-index once the commit is visible to the workers
+        await redis_bridge.sync_machine_capacity(current_machine)
+        await run_in_threadpool(request_drain)
     return job
 
 
 @router.get("/", response_model=list[JobResponse])
-def get_jobs(
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(deps.get_db),
-    current_user: User = Depends(deps.get_current_user),
+async def get_jobs(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(default=100, ge=1, le=500),
+    status: Optional[str] = None,
+    db: AsyncSession = Depends(deps.get_async_db),
+    current_user: User = Depends(deps.get_current_user_async),
 ) -> list[Job]:
-    return db.query(Job).filter(Job.creator_id == current_user.id).all()
+    """
+    newest first. when there are more, the X-Next-Cursor header holds the
+    cursor for the next page
+    """
+    query = (
+        select(Job)
+        .options(*SKIP_PAYLOAD)
+        .where(Job.creator_id == current_user.id)
+        .order_by(Job.created_at.desc(), Job.id.desc())
+        .limit(limit + 1)
+    )
+    if status:
+        query = query.where(Job.status == status)
+    if cursor:
+        # keyset, every page is one index range scan however deep it is
+        query = query.where(tuple_(Job.created_at, Job.id) < decode_cursor(cursor))
+    jobs = list((await db.scalars(query)).all())
+    if len(jobs) > limit:
+        jobs = jobs[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(jobs[-1])
+    return jobs
 
 
 @router.get("/{job_id}", response_model=JobResponse)
-def get_job(
+async def get_job(
     job_id: str,
-    db: Session = Depends(deps.get_db),
-    current_user: User = Depends(deps.get_current_user),
+    db: AsyncSession = Depends(deps.get_async_db),
+    current_user: User = Depends(deps.get_current_user_async),
 ) -> Job:
-    job: Job | None = db.query(Job).filter(Job.id == job_id).first()
+    job: Job | None = await db.scalar(
+        select(Job).options(*SKIP_PAYLOAD).where(Job.id == job_id)
+    )
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     if job.creator_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized to access this job")
     return job
+
+
+@router.get(path="/{job_id}/result")
+async def download_job_result(
+    job_id: str,
+    request: Request,
+    db: AsyncSession = Depends(deps.get_async_db),
+    current_user: User = Depends(deps.get_current_user_async),
+):
+    """the job's output, with Range support for resuming large downloads"""
+    job = await get_job(job_id, db, current_user)
+    if job.result_hash is None:
+        raise HTTPException(status_code=404, detail="Job has no result")
+    return await blob_response(job.result_hash, request, filename=f"{job.id}.result")
+
+
+def sse_message(event: dict) -> str:
+    return (
+        f"id: {event['id']}\nevent: {event['event']}\n"
+        f"data: {json.dumps(event['payload'])}\n\n"
+    )
+
+
+def ends_stream(event: dict) -> bool:
+    return (
+        event["event"] == "status"
+        and event["payload"].get("status") in FINISHED_JOB_STATUSES
+    )
+
+
+async def follow_job_events(job_id: str, after: Optional[str], finished: bool):
+    queue = await job_log_hub.follow(job_id)
+    try:
+        seen = after
+        for event in await replay_job_events(job_id, after):
+            yield sse_message(event)
+            seen = event["id"]
+            if ends_stream(event):
+                return
+        if finished:
+            return
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    queue.get(), CONFIG.JOB_LOG_KEEPALIVE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                # keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                # fell behind, EventSource reconnects with Last-Event-ID
+                return
+            if seen is not None and stream_position(event["id"]) <= stream_position(
+                seen
+            ):
+                continue
+            yield sse_message(event)
+            seen = event["id"]
+            if ends_stream(event):
+                return
+    finally:
+        job_log_hub.unfollow(job_id, queue)
+
+
+@router.get(path="/{job_id}/logs")
+async def stream_job_logs(
+    job_id: str,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+    db: AsyncSession = Depends(deps.get_async_db),
+    current_user: User = Depends(deps.get_current_user_async),
+):
+    """
+    server-sent events with the job's log lines, progress and status changes.
+    replays the recent ones first, or everything after Last-Event-ID when a
+    client reconnects, and ends once the job completed or failed
+    """
+    if last_event_id is not None and not EVENT_ID_PATTERN.match(last_event_id):
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    job = await get_job(job_id, db, current_user)
+    finished = job.status in FINISHED_JOB_STATUSES
+    # a stream can stay open for hours, it must not keep a pooled connection
+    await db.close()
+    return StreamingResponse(
+        follow_job_events(str(job.id), last_event_id, finished),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
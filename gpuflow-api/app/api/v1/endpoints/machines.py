@@ -1,11 +1,23 @@
 import secrets
+from datetime import datetime, timedelta, timezone
+from typing import Literal, Optional
+from uuid import UUID
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import exists, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app.api import deps
-from app.db.session import get_db
+from app.db.session import get_async_db, get_db
+from app.models.job import ACTIVE_JOB_STATUSES, Job
 from app.models.machine import Machine
 from app.models.users import User
-from app.schemas.machine import MachineCreate, MachineResponse
+from app.schemas.machine import (
+    MachineCreate,
+    MachineMetricsResponse,
+    MachineResponse,
+)
+from app.services.auth_cache import auth_cache, principal_name
+from app.services.telemetry import telemetry_store
 
 router = APIRouter()
 
@@ -35,6 +47,7 @@ def register_machine(
         auth_token=new_token,
         gpu_name=machine_in.gpu_name,
         vram_gb=machine_in.vram_gb,
+        max_concurrent_jobs=machine_in.max_concurrent_jobs,
         status="offline",
         is_online=False,
     )
@@ -50,3 +63,70 @@ def get_my_machines(
     db: Session = Depends(get_db), current_user: User = Depends(deps.get_current_user)
 ):
     return current_user.machines
+
+
+@router.post("/{machine_id}/rotate-token", response_model=MachineResponse)
+def rotate_machine_token(
+    machine_id: UUID,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(deps.get_current_user),
+):
+    machine: Machine | None = (
+        db.query(Machine)
+        .filter(Machine.id == machine_id, Machine.owner_id == current_user.id)
+        .first()
+    )
+    if not machine:
+        raise HTTPException(status_code=404, detail="Machine not found")
+    machine.auth_token = secrets.token_urlsafe(32)
+    db.commit()
+    db.refresh(machine)
+    # the old token must stop working now, not when its cache entry expires
+    auth_cache.invalidate(principal_name("machine", machine.id))
+    return machine
+
+
+@router.get("/{machine_id}/metrics", response_model=MachineMetricsResponse)
+async def get_machine_metrics(
+    machine_id: UUID,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    resolution: Optional[Literal["1s", "1m", "1h"]] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(deps.get_current_user_async),
+):
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(hours=1)
+    # naive timestamps are utc
+    start, end = [
+        moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+        for moment in (start, end)
+    ]
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+
+    # providers see their own machines, users the machines running their jobs
+    runs_my_job = exists().where(
+        Job.machine_id == Machine.id,
+        Job.creator_id == current_user.id,
+        Job.status.in_(ACTIVE_JOB_STATUSES),
+    )
+    visible = await db.scalar(
+        select(Machine.id).where(
+            Machine.id == machine_id,
+            or_(Machine.owner_id == current_user.id, runs_my_job),
+        )
+    )
+    if visible is None:
+        raise HTTPException(status_code=404, detail="Machine not found")
+
+    tier, points = await telemetry_store.query(
+        str(machine_id), start.timestamp(), end.timestamp(), resolution
+    )
+    return {
+        "machine_id": machine_id,
+        "resolution": tier,
+        "start": start,
+        "end": end,
+        "points": points,
+    }
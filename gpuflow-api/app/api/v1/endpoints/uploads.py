@@ -0,0 +1,145 @@
+import uuid
+from typing import Optional
+from uuid import UUID
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from app.api import deps
+from app.core.config import CONFIG
+from app.models.users import User
+from app.schemas.upload import (
+    BlobResponse,
+    UploadComplete,
+    UploadCreate,
+    UploadResponse,
+)
+from app.services import uploads
+from app.services.auth_cache import principal_name
+
+router = APIRouter()
+
+
+def owner_of(principal) -> str:
+    kind = "user" if isinstance(principal, User) else "machine"
+    return principal_name(kind, principal.id)
+
+
+async def load_upload(upload_id: UUID, principal) -> dict:
+    upload = await run_in_threadpool(uploads.read_upload, upload_id.hex)
+    # someone else's upload looks the same as a missing one
+    if upload is None or upload["owner"] != owner_of(principal):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+
+def upload_response(upload_id: UUID, upload: dict, response: Response) -> dict:
+    response.headers["Upload-Offset"] = str(upload["offset"])
+    return {
+        "upload_id": upload_id.hex,
+        "offset": upload["offset"],
+        "length": upload["length"],
+    }
+
+
+def parse_checksum(header: Optional[str]) -> Optional[str]:
+    """Upload-Checksum: sha256 <hex digest of this request's body>"""
+    if header is None:
+        return None
+    algorithm, _, value = header.partition(" ")
+    if algorithm.lower() != "sha256" or len(value.strip()) != 64:
+        raise HTTPException(status_code=400, detail="Unsupported Upload-Checksum")
+    return value.strip().lower()
+
+
+@router.post("/", response_model=UploadResponse)
+async def create_upload(
+    response: Response,
+    upload_in: Optional[UploadCreate] = None,
+    principal=Depends(deps.get_current_principal_async),
+):
+    """
+    starts a resumable upload. the body then goes up in any number of PATCH
+    requests, each streamed to disk as it arrives, and POST .../complete turns
+    it into a blob
+    """
+    upload_in = upload_in or UploadCreate()
+    if upload_in.length is not None and upload_in.length > CONFIG.UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Upload too large")
+    upload_id = uuid.uuid4()
+    await run_in_threadpool(
+        uploads.create_upload, upload_id.hex, owner_of(principal), upload_in.length
+    )
+    upload = {"offset": 0, "length": upload_in.length}
+    return upload_response(upload_id, upload, response)
+
+
+@router.get("/{upload_id}", response_model=UploadResponse)
+async def get_upload(
+    upload_id: UUID,
+    response: Response,
+    principal=Depends(deps.get_current_principal_async),
+):
+    # where to resume after a dropped connection
+    upload = await load_upload(upload_id, principal)
+    return upload_response(upload_id, upload, response)
+
+
+@router.patch("/{upload_id}", response_model=UploadResponse)
+async def append_upload(
+    upload_id: UUID,
+    request: Request,
+    response: Response,
+    upload_offset: int = Header(..., alias="Upload-Offset"),
+    upload_checksum: Optional[str] = Header(None, alias="Upload-Checksum"),
+    principal=Depends(deps.get_current_principal_async),
+):
+    upload = await load_upload(upload_id, principal)
+    checksum = parse_checksum(upload_checksum)
+    limit = min(upload["length"] or CONFIG.UPLOAD_MAX_BYTES, CONFIG.UPLOAD_MAX_BYTES)
+    try:
+        upload["offset"] = await uploads.append_chunk(
+            upload_id.hex, upload_offset, request.stream(), limit, checksum
+        )
+    except uploads.UploadOffsetMismatch as e:
+        raise HTTPException(
+            status_code=409,
+            detail=str(e),
+            headers={"Upload-Offset": str(e.offset)},
+        )
+    except uploads.UploadBusy:
+        raise HTTPException(status_code=409, detail="Upload is busy")
+    except uploads.UploadTooLarge:
+        raise HTTPException(status_code=413, detail="Upload too large")
+    except uploads.UploadChecksumMismatch:
+        raise HTTPException(status_code=460, detail="Checksum mismatch")
+    return upload_response(upload_id, upload, response)
+
+
+@router.post("/{upload_id}/complete", response_model=BlobResponse)
+async def complete_upload(
+    upload_id: UUID,
+    upload_in: UploadComplete,
+    principal=Depends(deps.get_current_principal_async),
+):
+    upload = await load_upload(upload_id, principal)
+    if upload["length"] is not None and upload["offset"] != upload["length"]:
+        raise HTTPException(status_code=409, detail="Upload is incomplete")
+    if uploads.is_appending(upload_id.hex):
+        raise HTTPException(status_code=409, detail="Upload is busy")
+    try:
+        size = await run_in_threadpool(
+            uploads.finish_upload, upload_id.hex, upload_in.digest
+        )
+    except uploads.UploadChecksumMismatch:
+        raise HTTPException(status_code=460, detail="Checksum mismatch")
+    return {"digest": upload_in.digest, "size": size}
+
+
+@router.delete("/{upload_id}", status_code=204)
+async def abort_upload(
+    upload_id: UUID, principal=Depends(deps.get_current_principal_async)
+):
+    await load_upload(upload_id, principal)
+    if uploads.is_appending(upload_id.hex):
+        raise HTTPException(status_code=409, detail="Upload is busy")
+    await run_in_threadpool(uploads.remove_upload, upload_id.hex)
+    return Response(status_code=204)
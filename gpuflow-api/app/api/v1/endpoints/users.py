@@ -1,10 +1,18 @@
+from uuid import UUID
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from app.db.session import get_db
-from app.schemas.user import UserCreate, UserResponse
+from app.schemas.user import (
+    QueueDepthResponse,
+    ShareWeightUpdate,
+    UserCreate,
+    UserResponse,
+)
 from app.models.users import User
 from app.core.security import get_password_hash
 from app.api import deps
+from app.services.auth_cache import auth_cache, principal_name
+from app.services.job_queue import pending_queue
 
 router = APIRouter()
 
@@ -30,3 +38,63 @@ def create_user(user_in: UserCreate, db: Session = Depends(get_db)):
 def read_user_me(current_user: User = Depends(deps.get_current_user)) -> User:
     """this returns with the current user profile"""
     return current_user
+
+
+@router.post("/{user_id}/deactivate", response_model=UserResponse)
+def deactivate_user(
+    user_id: UUID,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(deps.get_current_user),
+) -> User:
+    """users can deactivate themselves, superusers anyone"""
+    if user_id != current_user.id and not current_user.is_superuser:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    user: User | None = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    user.is_active = False
+    db.commit()
+    db.refresh(user)
+    # cached tokens would otherwise stay valid until they expire
+    auth_cache.invalidate(principal_name("user", user.id))
+    return user
+
+
+@router.get("/{user_id}/queue", response_model=QueueDepthResponse)
+def read_queue_depth(
+    user_id: UUID,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(deps.get_current_user),
+):
+    """how many of the user's jobs wait for a machine, users see their own"""
+    if user_id != current_user.id and not current_user.is_superuser:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    user: User | None = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {
+        "user_id": user.id,
+        "pending": pending_queue.depth_of(str(user.id)),
+        "share_weight": user.share_weight,
+    }
+
+
+@router.put("/{user_id}/share-weight", response_model=UserResponse)
+def update_share_weight(
+    user_id: UUID,
+    weight_in: ShareWeightUpdate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(deps.get_current_user),
+) -> User:
+    """superusers only, takes effect on the user's next queued job"""
+    if not current_user.is_superuser:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    user: User | None = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    user.share_weight = weight_in.share_weight
+    db.commit()
+    db.refresh(user)
+    pending_queue.set_weight(str(user.id), user.share_weight)
+    auth_cache.invalidate(principal_name("user", user.id))
+    return user
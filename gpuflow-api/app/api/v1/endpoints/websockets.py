@@ -1,44 +1,261 @@
+import logging
+import re
+from datetime import datetime, timezone
+from functools import partial
+from uuid import UUID
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from sqlalchemy.orm import Session
-from app.db.session import get_db
+from fastapi.websockets import WebSocketState
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import CONFIG
+from app.core.metrics import observe_delivery
+from app.core.observability import tracer
+from app.db.session import AsyncSessionLocal, get_async_db
 from app.services.websocket_manager import manager
+from app.services.redis_bridge import redis_bridge
+from app.models.job import ACTIVE_JOB_STATUSES, Job
 from app.models.machine import Machine
+from app.services.heartbeats import heartbeat_buffer
+from app.schemas.job import JobStatusMessage
+from app.schemas.machine import HardwareInfoMessage
+from app.services.job_logs import append_job_event
+from app.services.job_status import job_status_buffer
+from app.services.leases import renew_leases_statement
+from app.services.matcher import inventory_of
+from app.services.telemetry import telemetry_store
+from app.services.wire import WireError, receive_message
+from app.services.tasks import request_drain
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# what an agent may report about a running job, longer log data is cut
+JOB_EVENT_FIELDS = {
+    "log": ("stream", "data"),
+    "progress": ("progress", "message"),
+}
+
+
+def is_job_id(job_id) -> bool:
+    try:
+        UUID(str(job_id))
+    except ValueError:
+        return False
+    return True
+
+
+# a redis stream entry id, "<milliseconds>-<sequence>", both within 64 bits
+DELIVERY_ID = re.compile(r"\d{1,19}-\d{1,19}")
+
+
+def is_delivery_id(delivery_id) -> bool:
+    return (
+        isinstance(delivery_id, str) and DELIVERY_ID.fullmatch(delivery_id) is not None
+    )
+
+
+async def holds_job(machine_id: str, job_id: str, held: set[str]) -> bool:
+    """
+    checked once per job and connection, later events skip the query. a short
+    session of its own, the connection's session keeps no transaction open
+    """
+    if job_id in held:
+        return True
+    if not is_job_id(job_id):
+        return False
+    async with AsyncSessionLocal() as db:
+        holder = await db.scalar(
+            select(Job.id).where(
+                Job.id == job_id,
+                Job.machine_id == machine_id,
+                Job.status.in_(ACTIVE_JOB_STATUSES),
+            )
+        )
+    if holder is None:
+        return False
+    held.add(job_id)
+    return True
+
+
+def job_event_payload(data: dict) -> dict:
+    payload = {field: data.get(field) for field in JOB_EVENT_FIELDS[data["type"]]}
+    if isinstance(payload.get("data"), str):
+        payload["data"] = payload["data"][: CONFIG.JOB_LOG_MAX_DATA_BYTES]
+    return payload
+
+
+async def deliver_jobs(machine_id: str, replay: bool = False) -> None:
+    """
+    sends the machine its START_JOB messages. with replay=True it first resends
+    the ones the agent never acked, skipping jobs that moved on meanwhile
+    """
+    with tracer.start_as_current_span(
+        "deliver_jobs", attributes={"machine_id": machine_id}
+    ):
+        if replay:
+            await replay_job_deliveries(machine_id)
+
+        # unsent messages stay pending in the stream and are replayed on reconnect
+        for data in await redis_bridge.read_job_deliveries(machine_id):
+            await manager.send_message(
+                machine_id, data, on_sent=partial(observe_delivery, data)
+            )
+
+
+async def replay_job_deliveries(machine_id: str) -> None:
+    deliveries = await redis_bridge.read_job_deliveries(machine_id, replay=True)
+    if not deliveries:
+        return
+    # a short session of its own, the connection's session keeps no transaction
+    # open, see holds_job()
+    async with AsyncSessionLocal() as db:
+        jobs = {
+            str(job_id): (status, str(holder))
+            for job_id, status, holder in await db.execute(
+                select(Job.id, Job.status, Job.machine_id).where(
+                    Job.id.in_(
+                        [
+                            data["job_id"]
+                            for data in deliveries
+                            if is_job_id(data.get("job_id"))
+                        ]
+                    )
+                )
+            )
+        }
+    for data in deliveries:
+        if jobs.get(data.get("job_id")) != ("assigned", machine_id):
+            await redis_bridge.ack_job_delivery(machine_id, data["delivery_id"])
+            continue
+        await manager.send_message(machine_id, data)
 
 
 @router.websocket("/ws/machine/{auth_token}")
 async def websocket_endpoint(
-    websocket: WebSocket, auth_token: str, db: Session = Depends(get_db)
+    websocket: WebSocket, auth_token: str, db: AsyncSession = Depends(get_async_db)
 ):
-    machine = db.query(Machine).filter(Machine.auth_token == auth_token).first()
+    machine = await db.scalar(select(Machine).where(Machine.auth_token == auth_token))
     if not machine:
         await websocket.close(code=4003)  # Unauthorized
         return
 
     machine_id = str(machine.id)
-    await manager.connect(machine_id, websocket)
+    protocol = await manager.connect(machine_id, websocket)
+    try:
+        # the group must exist before the node is routable, a doorbell could
+        # otherwise read a stream that has none
+        await redis_bridge.ensure_job_stream(machine_id)
+        await redis_bridge.register_machine(machine_id)
 
-    machine.is_online = True
-    machine.status = "idle"
-    db.commit()
+        # capacity comes from the jobs the machine still holds, some may be replayed
+        held = await db.execute(
+            select(func.count(Job.id), func.coalesce(func.sum(Job.vram_gb), 0)).where(
+                Job.machine_id == machine.id, Job.status.in_(ACTIVE_JOB_STATUSES)
+            )
+        )
+        running_jobs, vram_allocated_gb = held.one()
+        machine.is_online = True
+        machine.running_jobs = running_jobs
+        machine.vram_allocated_gb = vram_allocated_gb
+        machine.status = "busy" if running_jobs else "idle"
+        machine.last_seen_at = datetime.now(timezone.utc)
+        await db.execute(renew_leases_statement(machine.id))
+        await db.commit()
+        # straight to redis, the sweeper must not see the old timestamp
+        await redis_bridge.record_last_seen(
+            {machine_id: machine.last_seen_at.timestamp()}
+        )
+        await redis_bridge.sync_machine_capacity(machine)
+        await deliver_jobs(machine_id, replay=True)
+        # new capacity, hand it whatever has been waiting
+        await run_in_threadpool(request_drain)
+        # jobs this connection was found to hold, for log and progress events
+        held_jobs: set[str] = set()
 
-    try:
-        while True:
-            data = await websocket.receive_json()
+        # the writer closes a connection that falls behind, the receive after
+        # that raises the disconnect
+        while websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                data = await receive_message(websocket, protocol)
+            except WireError as e:
+                logger.warning("Unreadable message from %s: %s", machine_id, e)
+                continue
             if data.get("type") == "hardware_info":
-                machine.gpu_name = data.get("gpu_name")
-                machine.vram_gb = data.get("vram_gb")
-                db.commit()
-                print(
-                    f"Updated hardware specs for {machine.name}: GPU={machine.gpu_name}, VRAM={machine.vram_gb}GB"
-                )
+                try:
+                    specs = HardwareInfoMessage.model_validate(data)
+                except ValidationError:
+                    logger.warning("Invalid hardware_info from %s", machine_id)
+                else:
+                    # out of the index until the next flush stores the new specs
+                    await redis_bridge.mark_machine_unavailable(
+                        machine_id, machine.gpu_name
+                    )
+                    machine.gpu_name = specs.gpu_name
+                    machine.vram_gb = specs.vram_gb
+                    heartbeat_buffer.set_hardware(
+                        machine_id, specs.gpu_name, specs.vram_gb
+                    )
+                    logger.info(
+                        "Updated hardware specs for %s: GPU=%s, VRAM=%sGB",
+                        machine.name,
+                        machine.gpu_name,
+                        machine.vram_gb,
+                    )
+            if data.get("type") == "cache_inventory":
+                # every image and environment the agent has cached, replaces
+                # the previous report
+                await redis_bridge.replace_inventory(machine_id, inventory_of(data))
+            if data.get("type") == "ack" and is_delivery_id(data.get("delivery_id")):
+                await redis_bridge.ack_job_delivery(machine_id, data["delivery_id"])
             if data.get("type") == "heartbeat":
-                print(f"Heartbeat received from {machine.name}")
-                pass
+                # no database write here, the flush renews the leases in bulk
+                heartbeat_buffer.touch(machine_id)
+            if data.get("type") == "metrics":
+                # gpu_util, vram_used_gb, temperature_c and power_w
+                telemetry_store.record(machine_id, data)
+                heartbeat_buffer.touch(machine_id)
+            if data.get("type") == "job_status":
+                # applied with the other updates of the next flush, which acks it
+                try:
+                    update = JobStatusMessage.model_validate(data)
+                except ValidationError:
+                    await manager.send_message(
+                        machine_id,
+                        {
+                            "event": "JOB_STATUS_ACK",
+                            "job_id": data.get("job_id"),
+                            "seq": data.get("seq"),
+                            "applied": False,
+                            "detail": "Invalid job_status",
+                        },
+                        droppable=True,
+                    )
+                else:
+                    job_status_buffer.submit(machine_id, update)
+            if data.get("type") in JOB_EVENT_FIELDS and data.get("job_id"):
+                # stdout / stderr lines and progress, followed by the job's owner
+                job_id = str(data["job_id"])
+                if await holds_job(machine_id, job_id, held_jobs):
+                    await append_job_event(
+                        job_id, data["type"], job_event_payload(data)
+                    )
     except WebSocketDisconnect:
-        manager.disconnect(machine_id)
-        machine.is_online = False
-        machine.status = "offline"
-        db.commit()
-        print(f"Machine {machine.name} disconnected")
+        pass
+    finally:
+        # only the connection the machine is still registered with takes it
+        # offline, a reconnect to this node or another one keeps it online
+        if manager.disconnect(machine_id, websocket):
+            telemetry_store.forget(machine_id)
+            if await redis_bridge.unregister_machine(machine_id):
+                await redis_bridge.mark_machine_unavailable(
+                    machine_id, machine.gpu_name
+                )
+                name = machine.name
+                # whatever the loop left open, possibly failed
+                await db.rollback()
+                machine.is_online = False
+                machine.status = "offline"
+                await db.commit()
+                logger.info("Machine %s disconnected", name)
@@ -1,5 +1,5 @@
 from fastapi import APIRouter
-from app.api.v1.endpoints import users, auth, machines, websockets, jobs
+from app.api.v1.endpoints import users, auth, machines, websockets, jobs, blobs, uploads
 
 router = APIRouter()
 router.include_router(users.router, prefix="/users", tags=["users"])
@@ -7,3 +7,5 @@ router.include_router(auth.router, tags=["auth"])
 router.include_router(machines.router, prefix="/machines", tags=["machines"])
 router.include_router(websockets.router, tags=["websockets"])
 router.include_router(jobs.router, prefix="/jobs", tags=["jobs"])
+router.include_router(blobs.router, prefix="/blobs", tags=["blobs"])
+router.include_router(uploads.router, prefix="/uploads", tags=["uploads"])
@@ -13,6 +13,25 @@ celery_app.conf.update(
     result_serializer="json",
     timezone="UTC",
     enable_utc=True,
+    beat_schedule={
+        # picks up jobs whose backoff ran out while no capacity event fired
+        "drain-pending-jobs": {
+            "task": "app.services.tasks.drain_pending_jobs",
+            "schedule": CONFIG.PENDING_DRAIN_INTERVAL_SECONDS,
+        },
+        "restore-pending-jobs": {
+            "task": "app.services.tasks.restore_pending_queue",
+            "schedule": CONFIG.PENDING_RESTORE_INTERVAL_SECONDS,
+        },
+        "sweep-silent-machines": {
+            "task": "app.services.tasks.sweep_machines",
+            "schedule": CONFIG.MACHINE_SWEEP_INTERVAL_SECONDS,
+        },
+        "reap-expired-job-leases": {
+            "task": "app.services.tasks.reap_expired_job_leases",
+            "schedule": CONFIG.LEASE_REAP_INTERVAL_SECONDS,
+        },
+    },
 )
 
 celery_app.autodiscover_tasks(["app.services"])
@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 
@@ -7,6 +8,12 @@ class Settings(BaseSettings):
     API_V1_STR: str = "/api/v1"
 
     DATABASE_URL: str
+    # asyncpg url for the async engine, derived from DATABASE_URL when unset
+    ASYNC_DATABASE_URL: Optional[str] = None
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
 
     SECRET_KEY: str
     ALGORITHM: str
@@ -17,6 +24,118 @@ class Settings(BaseSettings):
 
     REDIS_URL: str
 
+    # verified principals cached by token hash, shared through redis when enabled
+    AUTH_CACHE_TTL_SECONDS: float = 60.0
+    AUTH_CACHE_MAX_ENTRIES: int = 10000
+    AUTH_CACHE_REDIS: bool = False
+    AUTH_CACHE_LOCAL_TTL_SECONDS: float = 5.0
+
+    # routing id of this api process, random per process when unset
+    NODE_ID: Optional[str] = None
+    JOB_STREAM_MAXLEN: int = 1000
+    JOB_STREAM_READ_BATCH: int = 100
+    # every machine websocket is written by its own task from a bounded queue.
+    # one that falls behind or stalls a send is closed, the agent reconnects
+    # and gets its unacked START_JOB messages again. keep the queue well above
+    # JOB_STREAM_READ_BATCH, one delivery queues a whole batch at once
+    WEBSOCKET_SEND_QUEUE_SIZE: int = 1024
+    WEBSOCKET_SEND_TIMEOUT_SECONDS: float = 10.0
+    # agents offering a gpuflow.v1.msgpack subprotocol get binary frames,
+    # bodies this large or more compressed with zstd (zstd extra) or deflate.
+    # json text frames for the ones offering none
+    WEBSOCKET_BINARY_ENABLED: bool = True
+    WEBSOCKET_COMPRESS_MIN_BYTES: int = 1024
+    WEBSOCKET_MAX_MESSAGE_BYTES: int = 16 * 1024 * 1024
+
+    # content addressed store for job code and artifacts, "local" keeps blobs
+    # under BLOB_STORE_PATH, "s3" in any s3 compatible bucket
+    BLOB_STORE_BACKEND: str = "local"
+    BLOB_STORE_PATH: str = "blobs"
+    BLOB_S3_BUCKET: Optional[str] = None
+    BLOB_S3_PREFIX: str = "blobs/"
+    BLOB_S3_ENDPOINT_URL: Optional[str] = None
+    BLOB_S3_URL_EXPIRES_SECONDS: int = 3600
+    # most bytes one POST /blobs may carry, bigger files go through /uploads
+    BLOB_MAX_BYTES: int = 16 * 1024 * 1024
+
+    # resumable uploads are spooled to disk on the api node that took them,
+    # under BLOB_STORE_PATH/.uploads when unset so finishing one is a rename
+    UPLOAD_SPOOL_PATH: Optional[str] = None
+    UPLOAD_MAX_BYTES: int = 64 * 1024 * 1024 * 1024
+    UPLOAD_TTL_SECONDS: int = 24 * 3600
+    UPLOAD_SWEEP_INTERVAL_SECONDS: float = 3600.0
+
+    # job_status messages from the machine websockets, applied in batches
+    JOB_STATUS_FLUSH_INTERVAL_SECONDS: float = 0.5
+    JOB_STATUS_FLUSH_BATCH: int = 500
+
+    # per job stream of log lines, progress and status changes
+    JOB_LOG_MAXLEN: int = 10000
+    JOB_LOG_TTL_SECONDS: int = 24 * 3600
+    JOB_LOG_REPLAY_COUNT: int = 500
+    JOB_LOG_MAX_DATA_BYTES: int = 16 * 1024
+    JOB_LOG_FOLLOWER_BUFFER: int = 1000
+    JOB_LOG_POLL_SECONDS: float = 1.0
+    JOB_LOG_KEEPALIVE_SECONDS: float = 15.0
+
+    # results of jobs with requirements={"deterministic": true}
+    RESULT_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    RESULT_CACHE_MAX_ENTRIES: int = 100000
+
+    # most jobs one POST /jobs/batch may create
+    JOB_BATCH_MAX_SIZE: int = 10000
+
+    # pending job queue. only jobs no machine could ever run, online or not,
+    # are failed after PENDING_MAX_ATTEMPTS, the rest wait for a free machine
+    PENDING_MAX_ATTEMPTS: int = 50
+    PENDING_BACKOFF_SECONDS: float = 1.0
+    PENDING_MAX_BACKOFF_SECONDS: float = 60.0
+    PENDING_DRAIN_BATCH: int = 100
+    PENDING_DRAIN_INTERVAL_SECONDS: float = 5.0
+    # the queue is rebuilt from the pending rows this often, a redis restart
+    # under running workers leaves it empty otherwise
+    PENDING_RESTORE_INTERVAL_SECONDS: float = 300.0
+
+    # heartbeats are buffered per api process and written in bulk
+    HEARTBEAT_FLUSH_INTERVAL_SECONDS: float = 5.0
+    MACHINE_OFFLINE_AFTER_SECONDS: float = 60.0
+    MACHINE_SWEEP_INTERVAL_SECONDS: float = 15.0
+
+    # machine metrics ring buffers, buckets kept per tier (1s, 1m, 1h)
+    TELEMETRY_SECOND_BUCKETS: int = 600
+    TELEMETRY_MINUTE_BUCKETS: int = 1440
+    TELEMETRY_HOUR_BUCKETS: int = 720
+    TELEMETRY_FLUSH_INTERVAL_SECONDS: float = 1.0
+    TELEMETRY_MAX_POINTS: int = 1500
+
+    # job leases, renewed by machine heartbeats
+    JOB_LEASE_SECONDS: int = 120
+    JOB_MAX_ATTEMPTS: int = 3
+    LEASE_REAP_INTERVAL_SECONDS: float = 15.0
+    LEASE_REAP_BATCH: int = 500
+    LEASE_REAP_MAX_BATCHES: int = 20
+
+    # "task" places every job in its own celery task, "loop" hands them to the
+    # batched scheduler in app/services/scheduler.py
+    SCHEDULER_MODE: str = "task"
+    SCHEDULER_TICK_SECONDS: float = 0.2
+    SCHEDULER_BATCH_SIZE: int = 1000
+
+    # container images and dependency environments the agents report cached. a
+    # job naming one prefers a machine with it warm among this many that fit
+    ENV_CACHE_MAX_ITEMS: int = 256
+    ENV_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    LOCALITY_CANDIDATES: int = 20
+
+    # prometheus text format on GET /metrics. several processes on one host
+    # (uvicorn --workers) share their numbers through PROMETHEUS_MULTIPROC_DIR
+    METRICS_ENABLED: bool = True
+    # logs go through a queue to a background thread, never to stdout
+    LOG_LEVEL: str = "INFO"
+    # opentelemetry spans through logfire, needs the tracing extra. exported to
+    # logfire when LOGFIRE_TOKEN is set, to OTEL_EXPORTER_OTLP_ENDPOINT when set
+    TRACING_ENABLED: bool = False
+
     class Config:
         env_file = "dev.env"
 
@@ -0,0 +1,182 @@
+import os
+import time
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+import redis
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# uvicorn --workers and anything else on the host write their samples to files
+# in this directory and every process serves the sum, see prometheus_client
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+SEND_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+ASSIGNMENT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+REQUEST_LATENCY = Histogram(
+    "gpuflow_http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_DB_QUERIES = Histogram(
+    "gpuflow_http_request_db_queries",
+    "database statements executed while serving one HTTP request",
+    ["method", "route"],
+    buckets=QUERY_BUCKETS,
+)
+JOB_ASSIGNMENT_LATENCY = Histogram(
+    "gpuflow_job_assignment_latency_seconds",
+    "job submitted to its START_JOB written for a machine",
+    buckets=ASSIGNMENT_BUCKETS,
+)
+REDIS_BRIDGE_LAG = Histogram(
+    "gpuflow_redis_bridge_lag_seconds",
+    "START_JOB written to the machine's stream to sent on its websocket",
+    buckets=LATENCY_BUCKETS,
+)
+WEBSOCKET_SEND_LATENCY = Histogram(
+    "gpuflow_websocket_send_seconds",
+    "time to hand one message to a machine websocket",
+    ["event"],
+    buckets=SEND_BUCKETS,
+)
+WEBSOCKET_QUEUE_WAIT = Histogram(
+    "gpuflow_websocket_queue_wait_seconds",
+    "time one message waited in its machine's send queue",
+    ["event"],
+    buckets=LATENCY_BUCKETS,
+)
+WEBSOCKET_SEND_FAILURES = Counter(
+    "gpuflow_websocket_send_failures",
+    "messages dropped and machine websockets closed for falling behind",
+    ["reason"],
+)
+WEBSOCKET_BYTES = Counter(
+    "gpuflow_websocket_bytes",
+    "machine websocket payload bytes as framed on the wire",
+    ["direction", "protocol"],
+)
+CONNECTED_MACHINES = Gauge(
+    "gpuflow_connected_machines",
+    "machine websockets held by the api processes",
+    multiprocess_mode="livesum",
+)
+
+# statements counted for the request being served, a list so the copies of the
+# context that sync endpoints run in share the one counter
+_request_queries: ContextVar[Optional[list[int]]] = ContextVar(
+    "request_queries", default=None
+)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(*_: Any) -> None:
+    # every engine, the async one runs its statements through a sync engine too
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+
+
+class MetricsMiddleware:
+    """
+    latency and database statements per request, labelled by route template
+    so job ids never become label values. plain asgi, the machine websocket
+    and streamed responses pass straight through
+    """
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message: dict) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        queries = [0]
+        token = _request_queries.set(queries)
+        began = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - began
+            _request_queries.reset(token)
+            # the router puts the matched route into the scope
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            REQUEST_LATENCY.labels(scope["method"], route, str(status)).observe(elapsed)
+            REQUEST_DB_QUERIES.labels(scope["method"], route).observe(queries[0])
+
+
+def observe_delivery(data: dict, now: float) -> None:
+    """
+    START_JOB sent to the agent. the stream entry id is the time redis took the
+    message, the scheduler wrote it right after assigning the job
+    """
+    written = int(data["delivery_id"].split("-", 1)[0]) / 1000
+    REDIS_BRIDGE_LAG.observe(max(now - written, 0.0))
+    submitted_at = data.get("submitted_at")
+    if submitted_at is not None:
+        JOB_ASSIGNMENT_LATENCY.observe(max(written - submitted_at, 0.0))
+
+
+class PendingQueueCollector:
+    """
+    the queue depth lives in redis and is the same for every process, it is
+    read when scraped instead of being tracked
+    """
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        from app.services.job_queue import pending_queue
+
+        try:
+            depth = pending_queue.depth()
+        except redis.RedisError:
+            return
+        yield GaugeMetricFamily(
+            "gpuflow_pending_jobs", "jobs waiting for a machine", value=depth
+        )
+
+
+pending_queue_collector = PendingQueueCollector()
+REGISTRY.register(pending_queue_collector)  # type: ignore[arg-type]
+
+
+def is_multiprocess() -> bool:
+    return bool(os.environ.get(MULTIPROC_DIR_ENV))
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """the text exposition and its content type"""
+    if not is_multiprocess():
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(pending_queue_collector)  # type: ignore[arg-type]
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead() -> None:
+    """drops this process's live gauges from the shared directory"""
+    if is_multiprocess():
+        multiprocess.mark_process_dead(os.getpid())
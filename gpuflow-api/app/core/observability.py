@@ -0,0 +1,64 @@
+import atexit
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Optional
+from opentelemetry import trace
+from app.core.config import CONFIG
+
+# spans for our own hot paths. a no-op until setup_tracing() installs a provider
+tracer = trace.get_tracer("gpuflow")
+
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging() -> None:
+    """
+    the root logger only puts records on a queue, one thread formats them and
+    writes stderr, so a slow pipe never stalls the event loop
+    """
+    global _listener
+    if _listener is not None:
+        return
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(records))
+    root.setLevel(CONFIG.LOG_LEVEL.upper())
+
+
+def setup_tracing(app: Any = None) -> None:
+    """
+    opentelemetry spans for requests, sql, redis and celery through logfire,
+    with TRACING_ENABLED only. needs the tracing extra
+    """
+    if not CONFIG.TRACING_ENABLED:
+        return
+    try:
+        import logfire
+
+        logfire.configure(
+            service_name=CONFIG.PROJECT_NAME.lower(),
+            service_version=CONFIG.VERSION,
+            send_to_logfire="if-token-present",
+            console=False,
+        )
+        from app.db.session import async_engine, engine
+
+        logfire.instrument_sqlalchemy(engine=engine)
+        logfire.instrument_sqlalchemy(engine=async_engine.sync_engine)
+        logfire.instrument_redis()
+        logfire.instrument_celery()
+        if app is not None:
+            logfire.instrument_fastapi(app, excluded_urls="/metrics")
+    except ImportError as e:
+        raise RuntimeError(
+            "TRACING_ENABLED needs the tracing extra (logfire instrumentations)"
+        ) from e
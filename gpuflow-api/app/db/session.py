@@ -1,11 +1,40 @@
 # this will create a database connection
+from typing import AsyncIterator
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from app.core.config import CONFIG
 
-engine = create_engine(CONFIG.DATABASE_URL)
+
+def async_database_url() -> str:
+    if CONFIG.ASYNC_DATABASE_URL:
+        return CONFIG.ASYNC_DATABASE_URL
+    url = make_url(CONFIG.DATABASE_URL)
+    if url.get_backend_name() == "postgresql":
+        url = url.set(drivername="postgresql+asyncpg")
+    return url.render_as_string(hide_password=False)
+
+
+pool_options = {
+    "pool_size": CONFIG.DB_POOL_SIZE,
+    "max_overflow": CONFIG.DB_MAX_OVERFLOW,
+    "pool_timeout": CONFIG.DB_POOL_TIMEOUT,
+    "pool_recycle": CONFIG.DB_POOL_RECYCLE,
+    "pool_pre_ping": True,
+}
+
+engine = create_engine(CONFIG.DATABASE_URL, **pool_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# the websocket handler and the job endpoints run on the event loop, they must
+# never wait on a blocking driver
+async_engine = create_async_engine(async_database_url(), **pool_options)
+# objects stay usable after commit, the handlers keep the machine row around
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
 
 def get_db():
     db = SessionLocal()
@@ -13,3 +42,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, HTTPException, Response
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 from app.core.config import CONFIG
@@ -6,15 +6,29 @@ from app.db.session import get_db
 from app.api.v1.router import router as api_router
 import asyncio
 import json
+import logging
 from contextlib import asynccontextmanager
+from fastapi.concurrency import run_in_threadpool
+from app.core.metrics import MetricsMiddleware, mark_process_dead, render_metrics
+from app.core.observability import setup_logging, setup_tracing
 from app.services.websocket_manager import manager
+from app.api.v1.endpoints.websockets import deliver_jobs
 from app.services.redis_bridge import redis_bridge
+from app.services.dispatch import NODE_ID, node_channel
+from app.services.heartbeats import heartbeat_buffer
+from app.services.job_logs import job_log_hub
+from app.services.job_status import job_status_buffer
+from app.services.telemetry import telemetry_store
+from app.services.uploads import run_upload_sweeper
 from fastapi.middleware.cors import CORSMiddleware
 
+logger = logging.getLogger(__name__)
+
 
 async def listen_to_Redis():
     pubsub = redis_bridge.redis.pubsub()
-    await pubsub.subscribe("gpu_events")
+    # only the messages for machines connected to this process arrive here
+    await pubsub.subscribe(node_channel(NODE_ID))
 
     async for message in pubsub.listen():
         if message["type"] == "message":
@@ -22,20 +36,40 @@ async def listen_to_Redis():
             target_machine_id = data.get("machine_id")
             event_type = data.get("event")
 
-            if event_type == "START_JOB":
-                print("Bridging job to websocket : ", target_machine_id)
-                await manager.send_message(target_machine_id, data)
+            if event_type == "JOBS_AVAILABLE":
+                logger.debug("Bridging jobs to websocket: %s", target_machine_id)
+                try:
+                    await deliver_jobs(target_machine_id)
+                except Exception:
+                    # undelivered messages stay pending and are replayed on reconnect
+                    logger.exception("Error bridging jobs: %s", target_machine_id)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    setup_logging()
     task = asyncio.create_task(listen_to_Redis())
+    flushers = [
+        asyncio.create_task(heartbeat_buffer.run()),
+        asyncio.create_task(telemetry_store.run()),
+        asyncio.create_task(job_status_buffer.run()),
+        asyncio.create_task(run_upload_sweeper()),
+        asyncio.create_task(job_log_hub.run()),
+    ]
     yield
     task.cancel()
+    for flusher in flushers:
+        flusher.cancel()
+    await heartbeat_buffer.flush()
+    await telemetry_store.flush()
+    await job_status_buffer.flush()
+    await redis_bridge.unregister_machines(list(manager.active_connections))
     await redis_bridge.close()
+    mark_process_dead()
 
 
 app = FastAPI(title=CONFIG.PROJECT_NAME, lifespan=lifespan)
+setup_tracing(app)
 
 app.add_middleware(
     CORSMiddleware,  # type: ignore[arg-type]
@@ -44,6 +78,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# outermost, so the latency includes the other middleware
+app.add_middleware(MetricsMiddleware)  # type: ignore[arg-type]
 
 
 @app.get("/")
@@ -62,6 +98,15 @@ def health_check(db: Session = Depends(get_db)) -> dict[str, str]:
     }
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    if not CONFIG.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    # the queue depth is read from redis with the blocking client
+    body, content_type = await run_in_threadpool(render_metrics)
+    return Response(content=body, media_type=content_type)
+
+
 app.include_router(api_router, prefix="/api/v1")
 
 if __name__ == "__main__":
@@ -1,10 +1,28 @@
 import uuid
-from sqlalchemy import Column, String, ForeignKey, DateTime, LargeBinary, Text
+from sqlalchemy import (
+    Column,
+    String,
+    ForeignKey,
+    DateTime,
+    LargeBinary,
+    Text,
+    JSON,
+    Integer,
+    Index,
+    text,
+)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.db.base_class import Base
 
+# a job in one of these holds a slot and vram on its machine
+ACTIVE_JOB_STATUSES = ("assigned", "running")
+FINISHED_JOB_STATUSES = ("completed", "failed")
+# highest first, a pending job of a higher class is always placed before any of
+# a lower one. within a class the owners get fair shares, see job_queue.py
+JOB_PRIORITIES = ("interactive", "normal", "batch")
+
 
 class Job(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -13,16 +31,62 @@ class Job(Base):
     machine_id = Column(UUID(as_uuid=True), ForeignKey("machine.id"), nullable=True)
 
     status = Column(String, default="pending", index=True)
+    priority = Column(
+        String(16), nullable=False, default="normal", server_default="normal"
+    )
 
-    pickled_function = Column(LargeBinary, nullable=False)
+    # sha256 of the code in the blob store, jobs from before the store keep
+    # their code inline in pickled_function
+    code_hash = Column(String(64), nullable=True)
+    pickled_function = Column(LargeBinary, nullable=True)
+    # the dataset the job reads and the output it produced, both blobs
+    input_hash = Column(String(64), nullable=True)
+    result_hash = Column(String(64), nullable=True)
 
     result_url = Column(String, nullable=True)
+    error_message = Column(Text, nullable=True)
 
     function_args = Column(Text, nullable=True)
 
+    # what the job asks of a machine, e.g. {"gpu_name": "RTX 4090", "min_vram_gb": 16}
+    requirements = Column(JSON, nullable=True)
+    # vram held on the machine while the job is assigned or running
+    vram_gb = Column(Integer, nullable=True)
+
+    # renewed by the machine's heartbeats, an expired lease sends the job back
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    # highest seq of the agent's status updates applied so far, older ones that
+    # arrive late are dropped. starts over when the job goes back to pending
+    status_seq = Column(Integer, nullable=False, default=0, server_default="0")
+
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     started_at = Column(DateTime(timezone=True), nullable=True)
     completed_at = Column(DateTime(timezone=True), nullable=True)
 
     owner = relationship("User", back_populates="jobs")
     machine = relationship("Machine", back_populates="jobs")
+
+
+# keyset pagination of a user's jobs, newest first, optionally by status
+Index("ix_job_creator_created", Job.creator_id, Job.created_at, Job.id)
+Index(
+    "ix_job_creator_status_created",
+    Job.creator_id,
+    Job.status,
+    Job.created_at,
+    Job.id,
+)
+
+# only active jobs carry a lease, the reaper and the heartbeat renewal stay on
+# these small partial indexes no matter how many jobs have finished
+Index(
+    "ix_job_active_lease",
+    Job.lease_expires_at,
+    postgresql_where=text("status IN ('assigned', 'running')"),
+)
+Index(
+    "ix_job_active_machine",
+    Job.machine_id,
+    postgresql_where=text("status IN ('assigned', 'running')"),
+)
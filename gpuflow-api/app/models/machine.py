@@ -1,5 +1,14 @@
 import uuid
-from sqlalchemy import Column, String, Boolean, ForeignKey, DateTime, Integer
+from sqlalchemy import (
+    Column,
+    String,
+    Boolean,
+    ForeignKey,
+    DateTime,
+    Integer,
+    Index,
+    text,
+)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -20,12 +29,27 @@ class Machine(Base):
     gpu_name = Column(String)
     vram_gb = Column(Integer)
 
-    # status
+    # status, "busy" as soon as one job runs, the capacity below says how much is left
     is_online = Column(Boolean, default=False)
     status = Column(String, default="offline")
+    # written in bulk by the heartbeat flush, the live value is in redis
+    last_seen_at = Column(DateTime(timezone=True), nullable=True)
+
+    # sharing, a card runs up to max_concurrent_jobs jobs as long as vram lasts
+    max_concurrent_jobs = Column(Integer, nullable=False, default=1, server_default="1")
+    running_jobs = Column(Integer, nullable=False, default=0, server_default="0")
+    vram_allocated_gb = Column(Integer, nullable=False, default=0, server_default="0")
 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     owner = relationship("User", back_populates="machines")
     jobs = relationship("Job", back_populates="machine")
+
+
+# backs the locked fallback scan in the matcher
+Index(
+    "ix_machine_free_vram",
+    Machine.vram_gb - Machine.vram_allocated_gb,
+    postgresql_where=text("is_online AND running_jobs < max_concurrent_jobs"),
+)
@@ -13,6 +13,8 @@ class User(Base):
 
     # financial details
     credits = Column(Integer, default=0)
+    # relative share of the machines while several users have jobs waiting
+    share_weight = Column(Integer, nullable=False, default=1, server_default="1")
 
     # Role
     is_active = Column(Boolean, default=True)
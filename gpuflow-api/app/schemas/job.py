@@ -1,20 +1,57 @@
 from datetime import datetime
 from uuid import UUID
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field, model_validator
+from typing import Any, Literal, Optional
+from app.core.config import CONFIG
+from app.schemas.upload import DIGEST_PATTERN
 
 
-class JobCreate(BaseModel):
-    code_string: str
+class JobCode(BaseModel):
+    """the code inline, or the digest of a blob uploaded to /blobs before"""
+
+    code_string: Optional[str] = None
+    code_hash: Optional[str] = Field(None, pattern=DIGEST_PATTERN)
+
+    @model_validator(mode="after")
+    def one_code_source(self):
+        if (self.code_string is None) == (self.code_hash is None):
+            raise ValueError("Give either code_string or code_hash")
+        return self
+
+
+class JobCreate(JobCode):
     requirements: Optional[dict] = None
+    priority: Literal["interactive", "normal", "batch"] = "normal"
+    # a dataset uploaded through /uploads, handed to the agent with the job
+    input_hash: Optional[str] = Field(None, pattern=DIGEST_PATTERN)
+
+
+class JobBatchCreate(JobCode):
+    """one function mapped over many inputs, every entry of args becomes a job"""
+
+    args: list[Any] = Field(..., min_length=1, max_length=CONFIG.JOB_BATCH_MAX_SIZE)
+    requirements: Optional[dict] = None
+    priority: Literal["interactive", "normal", "batch"] = "normal"
+    # shared by every job of the batch
+    input_hash: Optional[str] = Field(None, pattern=DIGEST_PATTERN)
+
+
+class JobBatchResponse(BaseModel):
+    # in the order of args
+    job_ids: list[UUID]
 
 
 class JobResponse(BaseModel):
     id: UUID
     status: str
+    priority: str
     creator_id: UUID
     created_at: datetime
     machine_id: Optional[UUID] = None
+    vram_gb: Optional[int] = None
+    code_hash: Optional[str] = None
+    input_hash: Optional[str] = None
+    result_hash: Optional[str] = None
     result_url: Optional[str] = None
     error_message: Optional[str] = None
 
@@ -22,7 +59,24 @@ class JobResponse(BaseModel):
         from_attributes = True
 
 
-class JobUpdate(BaseModel):
-    status: str
+class JobResult(BaseModel):
+    """what JobUpdate and JobStatusMessage report besides the status"""
+
     result: Optional[str] = None
+    # the job's output, uploaded through /uploads before the job completes
+    result_hash: Optional[str] = Field(None, pattern=DIGEST_PATTERN)
     error_message: Optional[str] = None
+
+
+class JobUpdate(JobResult):
+    status: str
+    # numbers the agent's updates of one job, a lower or repeated one is ignored
+    seq: Optional[int] = Field(None, ge=1)
+
+
+class JobStatusMessage(JobResult):
+    """a job_status message on the machine websocket"""
+
+    job_id: UUID
+    status: Literal["running", "completed", "failed"]
+    seq: int = Field(..., ge=1)
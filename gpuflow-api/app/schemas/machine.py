@@ -1,6 +1,7 @@
-from pydantic import BaseModel
+from datetime import datetime
+from pydantic import BaseModel, Field
 from uuid import UUID
-from typing import Optional
+from typing import Literal, Optional
 
 
 class MachineCreate(BaseModel):
@@ -9,6 +10,7 @@ class MachineCreate(BaseModel):
     device_id: str
     gpu_name: Optional[str] = None
     vram_gb: Optional[int] = None
+    max_concurrent_jobs: int = Field(default=1, ge=1)
 
 
 class MachineResponse(BaseModel):
@@ -21,6 +23,35 @@ class MachineResponse(BaseModel):
     device_id: Optional[str] = None
     gpu_name: Optional[str] = None
     vram_gb: Optional[int] = None
+    max_concurrent_jobs: int = 1
+    running_jobs: int = 0
+    vram_allocated_gb: int = 0
 
     class Config:
         from_attributes = True
+
+
+class HardwareInfoMessage(BaseModel):
+    """a hardware_info message on the machine websocket"""
+
+    gpu_name: Optional[str] = Field(None, max_length=128)
+    # within the integer column
+    vram_gb: Optional[int] = Field(None, ge=0, le=2**31 - 1)
+
+
+class MetricPoint(BaseModel):
+    # start of the bucket, unix seconds
+    t: int
+    samples: int
+    gpu_util: float
+    vram_used_gb: float
+    temperature_c: float
+    power_w: float
+
+
+class MachineMetricsResponse(BaseModel):
+    machine_id: UUID
+    resolution: Literal["1s", "1m", "1h"]
+    start: datetime
+    end: datetime
+    points: list[MetricPoint]
@@ -0,0 +1,25 @@
+from typing import Optional
+from pydantic import BaseModel, Field
+
+DIGEST_PATTERN = r"^[0-9a-f]{64}$"
+
+
+class UploadCreate(BaseModel):
+    # total size when the client knows it, appends past it are refused
+    length: Optional[int] = Field(None, gt=0)
+
+
+class UploadResponse(BaseModel):
+    upload_id: str
+    offset: int
+    length: Optional[int] = None
+
+
+class UploadComplete(BaseModel):
+    # sha256 of the whole upload, it becomes the blob's name
+    digest: str = Field(..., pattern=DIGEST_PATTERN)
+
+
+class BlobResponse(BaseModel):
+    digest: str
+    size: int
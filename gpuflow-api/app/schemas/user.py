@@ -12,6 +12,18 @@ class UserResponse(BaseModel):
     email: EmailStr
     credits: int
     is_active: bool
+    share_weight: int
 
     class Config:
         from_attributes = True
+
+
+class ShareWeightUpdate(BaseModel):
+    share_weight: int = Field(..., ge=1, le=1000)
+
+
+class QueueDepthResponse(BaseModel):
+    user_id: UUID
+    # jobs waiting for a machine, including ones backing off
+    pending: int
+    share_weight: int
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+import redis
+import redis.asyncio as aioredis
+from app.core.config import CONFIG
+
+# only identity columns are cached, everything else on the principal is loaded
+# lazily from the session it is merged into, so counters and credits never go
+# stale. an AsyncSession cannot load lazily: on the principals of the async
+# dependencies any other column (user.credits, machine.is_online) raises
+# MissingGreenlet. async endpoints read only these, one that needs another
+# column loads it first with `await db.refresh(principal, ["credits"])`
+USER_FIELDS = ("id", "email", "is_active", "is_superuser", "share_weight")
+MACHINE_FIELDS = ("id", "owner_id", "name", "auth_token", "device_id")
+
+KEY_PREFIX = "auth_cache"
+
+
+def token_key(kind: str, token: str) -> str:
+    # raw tokens never sit in memory or in redis as keys
+    return f"{kind}:{hashlib.sha256(token.encode()).hexdigest()}"
+
+
+def principal_name(kind: str, principal_id: Any) -> str:
+    return f"{kind}:{principal_id}"
+
+
+class AuthCache:
+    """
+    bounded LRU of verified principals keyed by token hash, entries expire after
+    AUTH_CACHE_TTL_SECONDS or when their token does. with AUTH_CACHE_REDIS the
+    workers also share a second level in redis, the local level then only keeps
+    entries for AUTH_CACHE_LOCAL_TTL_SECONDS so an invalidation reaches every
+    worker quickly
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        client: Optional[redis.Redis] = None,
+        async_client: Optional[aioredis.Redis] = None,
+        local_ttl: Optional[float] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.redis = client
+        self.async_redis = async_client
+        self.local_ttl = local_ttl if local_ttl is not None else ttl
+        # key -> (expires_at, principal, fields)
+        self._entries: OrderedDict[str, tuple[float, str, dict[str, Any]]] = (
+            OrderedDict()
+        )
+        # principal -> keys, a principal can hold several tokens at once
+        self._keys_by_principal: dict[str, set[str]] = {}
+
+    def get(self, key: str) -> Optional[dict[str, Any]]:
+        fields = self._get_local(key)
+        if fields is None and self.redis is not None:
+            fields = self._from_shared(key, self.redis.get(f"{KEY_PREFIX}:{key}"))
+        return fields
+
+    async def aget(self, key: str) -> Optional[dict[str, Any]]:
+        fields = self._get_local(key)
+        if fields is None and self.async_redis is not None:
+            raw = await self.async_redis.get(f"{KEY_PREFIX}:{key}")
+            fields = self._from_shared(key, raw)
+        return fields
+
+    def put(
+        self, key: str, principal: str, fields: dict[str, Any], expires_at: float
+    ) -> None:
+        ttl = self._put_local(key, principal, fields, expires_at)
+        if self.redis is not None and ttl > 0:
+            pipe = self.redis.pipeline()
+            self._queue_shared_put(pipe, key, principal, fields, ttl)
+            pipe.execute()
+
+    async def aput(
+        self, key: str, principal: str, fields: dict[str, Any], expires_at: float
+    ) -> None:
+        ttl = self._put_local(key, principal, fields, expires_at)
+        if self.async_redis is not None and ttl > 0:
+            pipe = self.async_redis.pipeline()
+            self._queue_shared_put(pipe, key, principal, fields, ttl)
+            await pipe.execute()
+
+    def invalidate(self, principal: str) -> None:
+        """drops every cached token of a deactivated user or a rotated machine"""
+        self._drop_local(principal)
+        if self.redis is not None:
+            index = self._index_key(principal)
+            keys = self.redis.smembers(index)
+            self.redis.delete(index, *[f"{KEY_PREFIX}:{key}" for key in keys])  # type: ignore[union-attr]
+
+    async def ainvalidate(self, principal: str) -> None:
+        self._drop_local(principal)
+        if self.async_redis is not None:
+            index = self._index_key(principal)
+            keys = await self.async_redis.smembers(index)  # type: ignore[misc]
+            await self.async_redis.delete(
+                index, *[f"{KEY_PREFIX}:{key}" for key in keys]
+            )
+
+    def _get_local(self, key: str) -> Optional[dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, principal, fields = entry
+        if expires_at <= time.time():
+            self._remove(key, principal)
+            return None
+        self._entries.move_to_end(key)
+        return fields
+
+    def _put_local(
+        self, key: str, principal: str, fields: dict[str, Any], expires_at: float
+    ) -> float:
+        """returns the seconds the entry may live in the shared level"""
+        now = time.time()
+        expires_at = min(expires_at, now + self.ttl)
+        if expires_at <= now:
+            return 0
+        self._entries[key] = (min(expires_at, now + self.local_ttl), principal, fields)
+        self._entries.move_to_end(key)
+        self._keys_by_principal.setdefault(principal, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest, (_, oldest_principal, _) = next(iter(self._entries.items()))
+            self._remove(oldest, oldest_principal)
+        return expires_at - now
+
+    def _from_shared(self, key: str, raw: Any) -> Optional[dict[str, Any]]:
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        self._put_local(key, entry["principal"], entry["fields"], entry["expires_at"])
+        return entry["fields"]
+
+    def _queue_shared_put(
+        self, pipe: Any, key: str, principal: str, fields: dict[str, Any], ttl: float
+    ) -> None:
+        entry = {
+            "principal": principal,
+            "fields": fields,
+            "expires_at": time.time() + ttl,
+        }
+        index = self._index_key(principal)
+        pipe.set(f"{KEY_PREFIX}:{key}", json.dumps(entry), px=int(ttl * 1000))
+        pipe.sadd(index, key)
+        # the index outlives every entry it points to
+        pipe.expire(index, int(self.ttl) + 1)
+
+    def _index_key(self, principal: str) -> str:
+        return f"{KEY_PREFIX}:principal:{principal}"
+
+    def _drop_local(self, principal: str) -> None:
+        for key in self._keys_by_principal.pop(principal, set()):
+            self._entries.pop(key, None)
+
+    def _remove(self, key: str, principal: str) -> None:
+        self._entries.pop(key, None)
+        keys = self._keys_by_principal.get(principal)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_principal[principal]
+
+
+def build_auth_cache() -> AuthCache:
+    if not CONFIG.AUTH_CACHE_REDIS:
+        return AuthCache(CONFIG.AUTH_CACHE_MAX_ENTRIES, CONFIG.AUTH_CACHE_TTL_SECONDS)
+    return AuthCache(
+        CONFIG.AUTH_CACHE_MAX_ENTRIES,
+        CONFIG.AUTH_CACHE_TTL_SECONDS,
+        client=redis.from_url(CONFIG.REDIS_URL, decode_responses=True),
+        async_client=aioredis.Redis.from_url(CONFIG.REDIS_URL, decode_responses=True),
+        local_ttl=CONFIG.AUTH_CACHE_LOCAL_TTL_SECONDS,
+    )
+
+
+auth_cache = build_auth_cache()
@@ -0,0 +1,178 @@
+import hashlib
+import os
+import re
+import tempfile
+from typing import Optional
+from app.core.config import CONFIG
+
+# blobs are named by the sha256 of their content, the same code submitted any
+# number of times is stored once and a digest always means the same bytes
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+# read size when hashing or copying files, large blobs never sit in memory whole
+FILE_CHUNK_BYTES = 1024 * 1024
+
+
+def digest_of(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_of_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as blob:
+        while chunk := blob.read(FILE_CHUNK_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_digest(value: str) -> bool:
+    return DIGEST_PATTERN.match(value) is not None
+
+
+class BlobStore:
+    """write once storage keyed by digest, backends only move bytes"""
+
+    def put(self, data: bytes) -> str:
+        """stores data unless a blob with the same digest exists, returns the digest"""
+        digest = digest_of(data)
+        if not self.exists(digest):
+            self._write(digest, data)
+        return digest
+
+    def put_file(self, path: str, digest: str) -> None:
+        """
+        moves a spooled file whose digest the caller verified into the store,
+        the file is gone afterwards either way
+        """
+        if self.exists(digest):
+            os.unlink(path)
+        else:
+            self._move(path, digest)
+
+    def get(self, digest: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def exists(self, digest: str) -> bool:
+        raise NotImplementedError
+
+    def local_path(self, digest: str) -> Optional[str]:
+        """a file the api can serve directly, None when the blob lives elsewhere"""
+        return None
+
+    def download_url(self, digest: str) -> Optional[str]:
+        """a url clients can download from without going through the api"""
+        return None
+
+    def _write(self, digest: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def _move(self, path: str, digest: str) -> None:
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    """one file per blob, fanned out over directories by the first two hex digits"""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, digest: str) -> Optional[bytes]:
+        try:
+            with open(self.path(digest), "rb") as blob:
+                return blob.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def local_path(self, digest: str) -> Optional[str]:
+        path = self.path(digest)
+        return path if os.path.exists(path) else None
+
+    def _write(self, digest: str, data: bytes) -> None:
+        directory = os.path.dirname(self.path(digest))
+        os.makedirs(directory, exist_ok=True)
+        # readers never see a half written blob, two writers of the same digest
+        # write the same bytes so the last rename wins harmlessly
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, self.path(digest))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _move(self, path: str, digest: str) -> None:
+        # the spool sits on the same filesystem, this is a rename and not a copy
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        os.replace(path, self.path(digest))
+
+
+class S3BlobStore(BlobStore):
+    """any s3 compatible object store, needs the s3 extra (boto3)"""
+
+    def __init__(
+        self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None
+    ) -> None:
+        try:
+            import boto3
+        except ImportError as e:
+            raise RuntimeError("BLOB_STORE_BACKEND=s3 needs boto3 installed") from e
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def key(self, digest: str) -> str:
+        return f"{self.prefix}{digest}"
+
+    def get(self, digest: str) -> Optional[bytes]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key(digest))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read()
+
+    def exists(self, digest: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(digest))
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    def download_url(self, digest: str) -> Optional[str]:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self.key(digest)},
+            ExpiresIn=CONFIG.BLOB_S3_URL_EXPIRES_SECONDS,
+        )
+
+    def _write(self, digest: str, data: bytes) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=self.key(digest), Body=data)
+
+    def _move(self, path: str, digest: str) -> None:
+        # boto3 streams the file in a multipart upload
+        try:
+            self.client.upload_file(path, self.bucket, self.key(digest))
+        finally:
+            os.unlink(path)
+
+
+def build_blob_store() -> BlobStore:
+    if CONFIG.BLOB_STORE_BACKEND == "s3":
+        if not CONFIG.BLOB_S3_BUCKET:
+            raise RuntimeError("BLOB_STORE_BACKEND=s3 needs BLOB_S3_BUCKET")
+        return S3BlobStore(
+            CONFIG.BLOB_S3_BUCKET, CONFIG.BLOB_S3_PREFIX, CONFIG.BLOB_S3_ENDPOINT_URL
+        )
+    return LocalBlobStore(CONFIG.BLOB_STORE_PATH)
+
+
+blob_store = build_blob_store()
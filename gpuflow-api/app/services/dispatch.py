@@ -0,0 +1,73 @@
+import json
+import uuid
+from typing import Any, Optional
+from app.core.config import CONFIG
+
+# machine_id -> id of the api process holding that machine's websocket
+MACHINE_NODES_KEY = "machine_nodes"
+
+# machine_id -> unix time of its last heartbeat, across every api process.
+# liveness is read from here, the machine row only gets it at the next flush
+LAST_SEEN_KEY = "machine_last_seen"
+
+# START_JOB messages live in a stream per machine until the agent acks them,
+# the pub/sub message to the node is only a doorbell
+JOB_STREAM_GROUP = "agents"
+
+# identifies this api process, every process only subscribes to its own channel
+NODE_ID: str = CONFIG.NODE_ID or uuid.uuid4().hex
+
+# deletes the registry entry only if it still points at the caller's node, a
+# machine that already reconnected elsewhere keeps its new entry
+UNREGISTER_SCRIPT = """
+if redis.call('hget', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('hdel', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+# drops the silent machines the sweep took offline from the last seen set, but
+# only those still scored at or below the cutoff (ARGV[1]). one that heartbeated
+# since the sweep read the set stays in it
+FORGET_SILENT_SCRIPT = """
+local removed = 0
+for i = 2, #ARGV do
+    local score = redis.call('zscore', KEYS[1], ARGV[i])
+    if score and tonumber(score) <= tonumber(ARGV[1]) then
+        removed = removed + redis.call('zrem', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+
+def node_channel(node_id: str) -> str:
+    return f"gpu_events:{node_id}"
+
+
+def job_stream_key(machine_id: str) -> str:
+    return f"machine_jobs:{machine_id}"
+
+
+def resolve_nodes(client: Any, machine_ids: list[str]) -> list[Optional[str]]:
+    """one round trip for the whole batch, None for machines nobody holds"""
+    if not machine_ids:
+        return []
+    return client.hmget(MACHINE_NODES_KEY, machine_ids)
+
+
+def queue_start_job(
+    pipe: Any, machine_id: str, node_id: Optional[str], message: str
+) -> None:
+    pipe.xadd(
+        job_stream_key(machine_id),
+        {"payload": message},
+        maxlen=CONFIG.JOB_STREAM_MAXLEN,
+        approximate=True,
+    )
+    # offline machines get the message from the stream when they reconnect
+    if node_id is not None:
+        pipe.publish(
+            node_channel(node_id),
+            json.dumps({"event": "JOBS_AVAILABLE", "machine_id": machine_id}),
+        )
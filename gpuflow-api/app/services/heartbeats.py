@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterable, Optional
+from uuid import UUID
+from sqlalchemy import bindparam, case, select, update
+from sqlalchemy.orm import Session
+from app.core.config import CONFIG
+from app.db.session import AsyncSessionLocal
+from app.models.job import ACTIVE_JOB_STATUSES, Job
+from app.models.machine import Machine
+from app.services.dispatch import FORGET_SILENT_SCRIPT, LAST_SEEN_KEY
+from app.services.matcher import queue_index_remove, queue_machine_sync
+from app.services.redis_bridge import redis_bridge
+from app.services.websocket_manager import manager
+
+logger = logging.getLogger(__name__)
+
+
+def seen_at(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+class HeartbeatBuffer:
+    """
+    collects heartbeats and hardware_info per api process. flush() writes them
+    with one redis pipeline and a few bulk UPDATEs instead of a commit per event
+    """
+
+    def __init__(self) -> None:
+        self._seen: dict[str, float] = {}
+        self._hardware: dict[str, tuple[Optional[str], Optional[int]]] = {}
+
+    def touch(self, machine_id: str) -> None:
+        self._seen[machine_id] = time.time()
+
+    def set_hardware(
+        self, machine_id: str, gpu_name: Optional[str], vram_gb: Optional[int]
+    ) -> None:
+        self._hardware[machine_id] = (gpu_name, vram_gb)
+        self.touch(machine_id)
+
+    async def flush(self) -> int:
+        """returns the number of machines written"""
+        seen, self._seen = self._seen, {}
+        hardware, self._hardware = self._hardware, {}
+        if not seen:
+            return 0
+        try:
+            await redis_bridge.record_last_seen(seen)
+            # still connected here, a sweep may have taken them offline meanwhile
+            connected = [
+                machine_id
+                for machine_id in seen
+                if machine_id in manager.active_connections
+            ]
+            async with AsyncSessionLocal() as db:
+                machines = await db.run_sync(
+                    write_heartbeats, seen, hardware, connected
+                )
+                await db.commit()
+            # new specs only reach the index once the row has them, so a claim
+            # never sees capacity the database does not
+            if machines:
+                pipe = redis_bridge.redis.pipeline()
+                for machine in machines:
+                    queue_machine_sync(pipe, machine)
+                await pipe.execute()
+        except Exception:
+            # keep whatever arrived meanwhile, it is newer. specs are not put
+            # back, one the database refuses would fail every later flush and
+            # with it the lease renewals of every machine on this process
+            for machine_id, timestamp in seen.items():
+                self._seen.setdefault(machine_id, timestamp)
+            if hardware:
+                logger.warning("Dropped the hardware specs of %s", sorted(hardware))
+            raise
+        return len(seen)
+
+    async def run(self, interval: float = CONFIG.HEARTBEAT_FLUSH_INTERVAL_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error flushing heartbeats")
+
+
+def write_heartbeats(
+    db: Session,
+    seen: dict[str, float],
+    hardware: dict[str, tuple[Optional[str], Optional[int]]],
+    connected: Iterable[str] = (),
+) -> list[Machine]:
+    """
+    bulk writes last_seen_at, renews the leases of the jobs those machines hold,
+    stores new specs and brings the connected machines a sweep took offline
+    back online. returns the online machines whose specs or state changed, the
+    caller commits and puts them back in the index
+    """
+    # job rows before machine rows and both in id order, the order the job
+    # status flush locks them in, otherwise the two can deadlock. the jobs are
+    # locked up front, an UPDATE keyed by machine would take them machine by
+    # machine
+    seen = dict(sorted(seen.items()))
+    held = db.execute(
+        select(Job.id, Job.machine_id)
+        .where(
+            Job.machine_id.in_([UUID(machine_id) for machine_id in seen]),
+            Job.status.in_(ACTIVE_JOB_STATUSES),
+        )
+        .order_by(Job.id)
+        .with_for_update()
+    ).all()
+    # a lease runs from the last heartbeat, not from when it got flushed
+    if held:
+        jobs = Job.__table__
+        db.execute(
+            update(jobs)
+            .where(jobs.c.id == bindparam("held_id"))
+            .values(lease_expires_at=bindparam("expires_at")),
+            [
+                {
+                    "held_id": job_id,
+                    "expires_at": seen_at(seen[str(machine_id)])
+                    + timedelta(seconds=CONFIG.JOB_LEASE_SECONDS),
+                }
+                for job_id, machine_id in held
+            ],
+        )
+
+    machines = Machine.__table__
+    db.execute(
+        update(machines)
+        .where(machines.c.id == bindparam("machine_id"))
+        .values(last_seen_at=bindparam("seen_at")),
+        [
+            {"machine_id": UUID(machine_id), "seen_at": seen_at(timestamp)}
+            for machine_id, timestamp in seen.items()
+        ],
+    )
+
+    # a machine whose heartbeats were late but whose socket never closed, the
+    # rows are locked already by the last_seen_at update above
+    changed = set(hardware)
+    connected_ids = [UUID(machine_id) for machine_id in connected]
+    if connected_ids:
+        restored = db.execute(
+            update(machines)
+            .where(machines.c.id.in_(connected_ids), machines.c.is_online.is_(False))
+            .values(
+                is_online=True,
+                status=case((machines.c.running_jobs > 0, "busy"), else_="idle"),
+            )
+            .returning(machines.c.id)
+        ).scalars()
+        changed.update(str(machine_id) for machine_id in restored)
+
+    if hardware:
+        db.execute(
+            update(machines)
+            .where(machines.c.id == bindparam("machine_id"))
+            .values(
+                gpu_name=bindparam("new_gpu_name"), vram_gb=bindparam("new_vram_gb")
+            ),
+            [
+                {
+                    "machine_id": UUID(machine_id),
+                    "new_gpu_name": gpu_name,
+                    "new_vram_gb": vram_gb,
+                }
+                for machine_id, (gpu_name, vram_gb) in hardware.items()
+            ],
+        )
+    if not changed:
+        return []
+    return (
+        db.query(Machine)
+        .filter(
+            Machine.id.in_([UUID(machine_id) for machine_id in changed]),
+            Machine.is_online.is_(True),
+        )
+        .all()
+    )
+
+
+def sweep_silent_machines(db: Session, client: Any) -> list[str]:
+    """
+    takes machines offline once nothing was heard from them for
+    MACHINE_OFFLINE_AFTER_SECONDS, also the ones whose api process died before
+    it could run the disconnect. returns their ids
+    """
+    cutoff = time.time() - CONFIG.MACHINE_OFFLINE_AFTER_SECONDS
+    silent: list[str] = client.zrangebyscore(LAST_SEEN_KEY, "-inf", cutoff)
+    if not silent:
+        return []
+
+    # the row decides, a machine that reconnected meanwhile has a newer last_seen_at
+    rows = db.execute(
+        update(Machine)
+        .where(
+            Machine.id.in_([UUID(machine_id) for machine_id in silent]),
+            Machine.is_online.is_(True),
+            Machine.last_seen_at < seen_at(cutoff),
+        )
+        .values(is_online=False, status="offline")
+        .returning(Machine.id, Machine.gpu_name)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+
+    pipe = client.pipeline(transaction=False)
+    for machine_id, gpu_name in rows:
+        queue_index_remove(pipe, str(machine_id), gpu_name)
+    forget_silent = client.register_script(FORGET_SILENT_SCRIPT)
+    forget_silent(keys=[LAST_SEEN_KEY], args=[cutoff, *silent], client=pipe)
+    pipe.execute()
+    return [str(machine_id) for machine_id, _ in rows]
+
+
+heartbeat_buffer = HeartbeatBuffer()
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import json
+from typing import Any, Optional
+from app.core.config import CONFIG
+from app.services.redis_bridge import redis_bridge
+
+logger = logging.getLogger(__name__)
+
+# every job has a bounded stream of the log lines, progress and status changes
+# its agent and the api report. users replay the tail of it and then follow it
+# live, one XREAD per api process serves every follower of every job
+
+
+def job_log_key(job_id: str) -> str:
+    return f"job_logs:{job_id}"
+
+
+def stream_position(entry_id: str) -> tuple[int, int]:
+    milliseconds, _, sequence = entry_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+def queue_job_event(pipe: Any, job_id: str, event: str, payload: dict) -> None:
+    """queues one event on a sync or async pipeline, the caller executes it"""
+    key = job_log_key(job_id)
+    pipe.xadd(
+        key,
+        {"event": event, "payload": json.dumps(payload)},
+        maxlen=CONFIG.JOB_LOG_MAXLEN,
+        approximate=True,
+    )
+    # the stream outlives the job by a while, then goes away on its own
+    pipe.expire(key, CONFIG.JOB_LOG_TTL_SECONDS)
+
+
+async def append_job_event(job_id: str, event: str, payload: dict) -> None:
+    pipe = redis_bridge.redis.pipeline(transaction=False)
+    queue_job_event(pipe, job_id, event, payload)
+    await pipe.execute()
+
+
+def decode_entry(entry_id: str, fields: dict) -> dict:
+    return {
+        "id": entry_id,
+        "event": fields["event"],
+        "payload": json.loads(fields["payload"]),
+    }
+
+
+async def latest_position(job_id: str) -> str:
+    entries = await redis_bridge.redis.xrevrange(job_log_key(job_id), count=1)
+    return entries[0][0] if entries else "0-0"
+
+
+async def replay_job_events(job_id: str, after: Optional[str]) -> list[dict]:
+    """
+    the events after `after`, a previous event id, or the last
+    JOB_LOG_REPLAY_COUNT events when the caller has seen none
+    """
+    key = job_log_key(job_id)
+    if after is None:
+        entries = await redis_bridge.redis.xrevrange(
+            key, count=CONFIG.JOB_LOG_REPLAY_COUNT
+        )
+        entries.reverse()
+    else:
+        entries = await redis_bridge.redis.xrange(
+            key, min=f"({after}", count=CONFIG.JOB_LOG_MAXLEN
+        )
+    return [decode_entry(entry_id, fields) for entry_id, fields in entries]
+
+
+class JobLogHub:
+    """
+    fans the job log streams out to the followers on this api process. one
+    blocking XREAD covers every followed job, each follower gets a bounded
+    queue and a follower too slow to keep up is dropped with a None, it can
+    reconnect and resume from its last event id
+    """
+
+    def __init__(self) -> None:
+        self._followers: dict[str, set[asyncio.Queue]] = {}
+        # last entry id read per followed job
+        self._positions: dict[str, str] = {}
+        self._wakeup = asyncio.Event()
+
+    async def follow(self, job_id: str) -> asyncio.Queue:
+        """
+        starts following before the caller replays, so every event after the
+        replay arrives on the queue. events the replay already had may arrive
+        as well, callers skip ids they have seen
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=CONFIG.JOB_LOG_FOLLOWER_BUFFER)
+        if job_id not in self._followers:
+            position = await latest_position(job_id)
+            self._positions.setdefault(job_id, position)
+        self._followers.setdefault(job_id, set()).add(queue)
+        self._wakeup.set()
+        return queue
+
+    def unfollow(self, job_id: str, queue: asyncio.Queue) -> None:
+        followers = self._followers.get(job_id)
+        if followers is None:
+            return
+        followers.discard(queue)
+        if not followers:
+            del self._followers[job_id]
+            self._positions.pop(job_id, None)
+
+    def _offer(self, job_id: str, queue: asyncio.Queue, event: dict) -> None:
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.unfollow(job_id, queue)
+            # make room for the sentinel, the follower is gone either way
+            queue.get_nowait()
+            queue.put_nowait(None)
+
+    async def poll(self) -> int:
+        """one blocking read over every followed job, returns the events read"""
+        streams = {
+            job_log_key(job_id): self._positions[job_id] for job_id in self._followers
+        }
+        response = await redis_bridge.redis.xread(
+            streams,  # type: ignore[arg-type]
+            count=CONFIG.JOB_STREAM_READ_BATCH,
+            block=int(CONFIG.JOB_LOG_POLL_SECONDS * 1000),
+        )
+        read = 0
+        for key, entries in response or []:
+            job_id = key.split(":", 1)[1]
+            if job_id not in self._followers or not entries:
+                continue
+            self._positions[job_id] = entries[-1][0]
+            for entry_id, fields in entries:
+                event = decode_entry(entry_id, fields)
+                for queue in list(self._followers.get(job_id, ())):
+                    self._offer(job_id, queue, event)
+                read += 1
+        return read
+
+    async def run(self):
+        while True:
+            if not self._followers:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception("Error reading job logs")
+                await asyncio.sleep(CONFIG.JOB_LOG_POLL_SECONDS)
+
+
+job_log_hub = JobLogHub()
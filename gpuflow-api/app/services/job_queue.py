@@ -0,0 +1,384 @@
+import time
+from typing import Iterable, Optional
+import redis
+from sqlalchemy.orm import Session
+from app.core.config import CONFIG
+from app.models.job import JOB_PRIORITIES, Job
+from app.models.users import User
+
+# jobs waiting out a backoff, scored by the time they become due
+PENDING_DELAYED_KEY = "pending_jobs:delayed"
+# job_id -> "<priority> <owner_id>" for every job the queue knows about
+PENDING_OWNERS_KEY = "pending_jobs:owners"
+# owner_id -> queued jobs, plus the total over everyone
+PENDING_DEPTH_KEY = "pending_jobs:depth"
+PENDING_TOTAL_KEY = "pending_jobs:total"
+# owner_id -> fair share weight, see User.share_weight
+PENDING_WEIGHTS_KEY = "pending_jobs:weights"
+# arrival counter, orders each owner's due jobs
+PENDING_SEQ_KEY = "pending_jobs:seq"
+PENDING_ATTEMPTS_KEY = "pending_jobs:attempts"
+
+# due jobs moved out of the backoff set per pop
+PROMOTE_BATCH = 1000
+
+# (job_id, owner_id, priority)
+QueuedJob = tuple[str, str, str]
+
+# per priority class: pending_jobs:<priority>:<owner_id> holds an owner's due jobs
+# in arrival order and pending_jobs:<priority>:active the owners with any,
+# scored by their pass. every pop serves the owner with the lowest pass and
+# moves it on by 1 / weight (stride scheduling), so one pop is O(log owners)
+# however many jobs anyone queued. an owner coming back starts at the pass of
+# the last pop, waiting earns no credit. higher classes always go first
+QUEUE_LUA = """
+local DELAYED, OWNERS, DEPTH, TOTAL, WEIGHTS, SEQ =
+    KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6]
+
+local function user_queue(priority, owner)
+    return 'pending_jobs:' .. priority .. ':' .. owner
+end
+
+local function class_key(priority, name)
+    return 'pending_jobs:' .. priority .. ':' .. name
+end
+
+local function parse(meta)
+    return string.match(meta, '^(%S+) (%S+)$')
+end
+
+local function enqueue(job_id, priority, owner)
+    local order = redis.call('INCR', SEQ)
+    redis.call('ZADD', user_queue(priority, owner), order, job_id)
+    local active = class_key(priority, 'active')
+    if not redis.call('ZSCORE', active, owner) then
+        local now = tonumber(redis.call('GET', class_key(priority, 'vtime')) or '0')
+        local last = tonumber(
+            redis.call('HGET', class_key(priority, 'finish'), owner) or '0'
+        )
+        redis.call('ZADD', active, math.max(now, last), owner)
+    end
+end
+
+local function dequeued(owner)
+    if redis.call('HINCRBY', DEPTH, owner, -1) <= 0 then
+        redis.call('HDEL', DEPTH, owner)
+    end
+    redis.call('DECR', TOTAL)
+end
+"""
+
+# ARGV: now, then job_id, owner_id, priority, due for every job. an empty owner
+# takes the job's known owner and priority, jobs already queued keep their place
+PUSH_LUA = (
+    QUEUE_LUA
+    + """
+local now = tonumber(ARGV[1])
+local added = 0
+for i = 2, #ARGV, 4 do
+    local job_id, owner, priority = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    local due = tonumber(ARGV[i + 3])
+    local meta = redis.call('HGET', OWNERS, job_id)
+    if meta then
+        priority, owner = parse(meta)
+    end
+    if owner ~= '' then
+        local queued = redis.call('ZSCORE', DELAYED, job_id)
+            or redis.call('ZSCORE', user_queue(priority, owner), job_id)
+        if not queued then
+            redis.call('HSET', OWNERS, job_id, priority .. ' ' .. owner)
+            if due > now then
+                redis.call('ZADD', DELAYED, due, job_id)
+            else
+                enqueue(job_id, priority, owner)
+            end
+            redis.call('HINCRBY', DEPTH, owner, 1)
+            redis.call('INCR', TOTAL)
+            added = added + 1
+        end
+    end
+end
+return added
+"""
+)
+
+# ARGV: now, limit, promote batch, then the priority classes highest first
+POP_LUA = (
+    QUEUE_LUA
+    + """
+local now, limit = tonumber(ARGV[1]), tonumber(ARGV[2])
+local due = redis.call(
+    'ZRANGEBYSCORE', DELAYED, '-inf', now, 'LIMIT', 0, tonumber(ARGV[3])
+)
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', DELAYED, job_id)
+    local meta = redis.call('HGET', OWNERS, job_id)
+    if meta then
+        local priority, owner = parse(meta)
+        enqueue(job_id, priority, owner)
+    end
+end
+
+local function take(priority, owner, pass)
+    local active = class_key(priority, 'active')
+    local queue = user_queue(priority, owner)
+    local entry = redis.call('ZPOPMIN', queue)
+    if #entry == 0 then
+        redis.call('ZREM', active, owner)
+        return false
+    end
+    local weight = tonumber(redis.call('HGET', WEIGHTS, owner) or '1')
+    if not weight or weight <= 0 then
+        weight = 1
+    end
+    local finish = pass + 1 / weight
+    redis.call('SET', class_key(priority, 'vtime'), pass)
+    redis.call('HSET', class_key(priority, 'finish'), owner, finish)
+    if redis.call('ZCARD', queue) > 0 then
+        redis.call('ZADD', active, finish, owner)
+    else
+        redis.call('ZREM', active, owner)
+    end
+    dequeued(owner)
+    return entry[1]
+end
+
+local function pop_one()
+    for p = 4, #ARGV do
+        local active = class_key(ARGV[p], 'active')
+        while true do
+            local head = redis.call('ZRANGE', active, 0, 0, 'WITHSCORES')
+            if #head == 0 then
+                break
+            end
+            local job_id = take(ARGV[p], head[1], tonumber(head[2]))
+            if job_id then
+                return job_id
+            end
+        end
+    end
+    return false
+end
+
+local popped = {}
+while #popped < limit do
+    local job_id = pop_one()
+    if not job_id then
+        break
+    end
+    popped[#popped + 1] = job_id
+end
+return popped
+"""
+)
+
+# ARGV: job ids. drops them from the queue and from what it knows about them
+FORGET_LUA = (
+    QUEUE_LUA
+    + """
+local ATTEMPTS = KEYS[7]
+for i = 1, #ARGV do
+    local job_id = ARGV[i]
+    local meta = redis.call('HGET', OWNERS, job_id)
+    if meta then
+        local priority, owner = parse(meta)
+        local queue = user_queue(priority, owner)
+        local removed = redis.call('ZREM', DELAYED, job_id)
+            + redis.call('ZREM', queue, job_id)
+        if removed > 0 then
+            dequeued(owner)
+            if redis.call('ZCARD', queue) == 0 then
+                redis.call('ZREM', class_key(priority, 'active'), owner)
+            end
+        end
+        redis.call('HDEL', OWNERS, job_id)
+    end
+    redis.call('HDEL', ATTEMPTS, job_id)
+end
+return #ARGV
+"""
+)
+
+QUEUE_KEYS = [
+    PENDING_DELAYED_KEY,
+    PENDING_OWNERS_KEY,
+    PENDING_DEPTH_KEY,
+    PENDING_TOTAL_KEY,
+    PENDING_WEIGHTS_KEY,
+    PENDING_SEQ_KEY,
+]
+
+
+def queue_entry(job: Job) -> QueuedJob:
+    return str(job.id), str(job.creator_id), job.priority or "normal"
+
+
+class PendingQueue:
+    """
+    jobs that could not be placed yet, one queue per owner and priority class,
+    served by weighted fair share. postgres stays the source of truth
+    (status == "pending"), the redis side is rebuilt from it by restore() at
+    startup and every PENDING_RESTORE_INTERVAL_SECONDS. after a redis restart
+    jobs wait for that run, none is lost
+    """
+
+    def __init__(self, client: redis.Redis) -> None:
+        self.redis = client
+        self._push = client.register_script(PUSH_LUA)
+        self._pop = client.register_script(POP_LUA)
+        self._forget = client.register_script(FORGET_LUA)
+
+    def push(
+        self,
+        job_id: str,
+        owner_id: str,
+        priority: str = "normal",
+        weight: Optional[int] = None,
+        not_before: Optional[float] = None,
+    ) -> None:
+        # a job already queued keeps its original position
+        weights = {owner_id: weight} if weight is not None else None
+        self.push_many([(job_id, owner_id, priority)], weights, not_before)
+
+    def push_many(
+        self,
+        jobs: Iterable[QueuedJob],
+        weights: Optional[dict[str, int]] = None,
+        not_before: Optional[float] = None,
+    ) -> int:
+        """
+        queues (job_id, owner_id, priority) entries, weights refreshes the
+        owners' fair share weights on the way. returns the jobs added
+        """
+        now = time.time()
+        due = not_before if not_before is not None else now
+        args: list = [now]
+        for job_id, owner_id, priority in jobs:
+            args += [job_id, owner_id, priority, due]
+        if weights:
+            self.redis.hset(PENDING_WEIGHTS_KEY, mapping=weights)  # type: ignore[arg-type]
+        if len(args) == 1:
+            return 0
+        return int(self._push(keys=QUEUE_KEYS, args=args))  # type: ignore[arg-type]
+
+    def put_back(self, job_ids: list[str]) -> None:
+        """returns popped jobs to the queue without counting an attempt"""
+        self._push_known(job_ids, [time.time()] * len(job_ids))
+
+    def set_weight(self, owner_id: str, weight: int) -> None:
+        self.redis.hset(PENDING_WEIGHTS_KEY, owner_id, weight)
+
+    def requeue(self, job_id: str, may_fail: bool = True) -> bool:
+        """
+        puts a popped job back with exponential backoff, returns False once it
+        has used up its attempts
+        """
+        return not self.requeue_many([job_id], [job_id] if may_fail else [])
+
+    def requeue_many(
+        self, job_ids: list[str], may_fail: Optional[Iterable[str]] = None
+    ) -> list[str]:
+        """
+        requeue() for a batch, returns the jobs that ran out of attempts. only
+        the jobs in may_fail (all of them when not given) can run out, the
+        others wait for a busy machine at the capped backoff however long
+        """
+        if not job_ids:
+            return []
+        failing = set(job_ids if may_fail is None else may_fail)
+        pipe = self.redis.pipeline()
+        for job_id in job_ids:
+            pipe.hincrby(PENDING_ATTEMPTS_KEY, job_id, 1)
+        attempts = pipe.execute()
+
+        now = time.time()
+        exhausted: list[str] = []
+        retried: list[str] = []
+        due: list[float] = []
+        for job_id, attempt in zip(job_ids, attempts):
+            if attempt > CONFIG.PENDING_MAX_ATTEMPTS and job_id in failing:
+                exhausted.append(job_id)
+                continue
+            delay = min(
+                CONFIG.PENDING_BACKOFF_SECONDS * 2 ** min(attempt - 1, 32),
+                CONFIG.PENDING_MAX_BACKOFF_SECONDS,
+            )
+            retried.append(job_id)
+            due.append(now + delay)
+        self._push_known(retried, due)
+        self.forget_many(exhausted)
+        return exhausted
+
+    def pop_due(self, limit: int) -> list[str]:
+        """
+        removes and returns up to `limit` due jobs in fair share order. the
+        script is the claim, concurrent drainers never get the same job twice
+        """
+        if limit <= 0:
+            return []
+        return self._pop(  # type: ignore[return-value]
+            keys=QUEUE_KEYS,
+            args=[time.time(), limit, PROMOTE_BATCH, *JOB_PRIORITIES],
+        )
+
+    def forget(self, job_id: str) -> None:
+        self.forget_many([job_id])
+
+    def forget_many(self, job_ids: list[str]) -> None:
+        if not job_ids:
+            return
+        self._forget(keys=[*QUEUE_KEYS, PENDING_ATTEMPTS_KEY], args=job_ids)
+
+    def depth(self) -> int:
+        return int(self.redis.get(PENDING_TOTAL_KEY) or 0)  # type: ignore[arg-type]
+
+    def depth_of(self, owner_id: str) -> int:
+        return int(self.redis.hget(PENDING_DEPTH_KEY, owner_id) or 0)  # type: ignore[arg-type]
+
+    def depths(self) -> dict[str, int]:
+        """owner_id -> queued jobs, for every owner with any"""
+        depths: dict = self.redis.hgetall(PENDING_DEPTH_KEY)  # type: ignore[assignment]
+        return {owner_id: int(count) for owner_id, count in depths.items()}
+
+    def restore(self, db: Session, chunk_size: int = 1000) -> int:
+        """re-queues every pending job from the database in submission order"""
+        rows = (
+            db.query(
+                Job.id, Job.creator_id, Job.priority, Job.created_at, User.share_weight
+            )
+            .join(User, Job.creator_id == User.id)
+            .filter(Job.status == "pending")
+            .order_by(Job.created_at)
+            .all()
+        )
+        if not rows:
+            return 0
+        self.redis.hset(  # type: ignore[arg-type]
+            PENDING_WEIGHTS_KEY,
+            mapping={str(row.creator_id): row.share_weight or 1 for row in rows},
+        )
+        now = time.time()
+        for start in range(0, len(rows), chunk_size):
+            args: list = [now]
+            for row in rows[start : start + chunk_size]:
+                created = row.created_at.timestamp() if row.created_at else now
+                args += [
+                    str(row.id),
+                    str(row.creator_id),
+                    row.priority or "normal",
+                    min(created, now),
+                ]
+            self._push(keys=QUEUE_KEYS, args=args)
+        return len(rows)
+
+    def _push_known(self, job_ids: list[str], due: list[float]) -> None:
+        # owner and priority come from the queue's own record of each job
+        if not job_ids:
+            return
+        args: list = [time.time()]
+        for job_id, not_before in zip(job_ids, due):
+            args += [job_id, "", "", not_before]
+        self._push(keys=QUEUE_KEYS, args=args)
+
+
+pending_queue = PendingQueue(redis.from_url(CONFIG.REDIS_URL, decode_responses=True))
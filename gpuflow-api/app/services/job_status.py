@@ -0,0 +1,225 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Optional, Union
+from uuid import UUID
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, defer
+from app.core.config import CONFIG
+from app.db.session import AsyncSessionLocal
+from app.models.job import ACTIVE_JOB_STATUSES, FINISHED_JOB_STATUSES, Job
+from app.models.machine import Machine
+from app.schemas.job import JobStatusMessage, JobUpdate
+from app.services.blob_store import blob_store
+from app.services.job_logs import queue_job_event
+from app.services.leases import lease_deadline
+from app.services.matcher import queue_machine_sync, release_allocations
+from app.services.redis_bridge import redis_bridge
+from app.services.result_cache import cache_entry, result_cache
+from app.services.tasks import request_drain
+from app.services.websocket_manager import manager
+
+logger = logging.getLogger(__name__)
+
+
+def apply_job_update(
+    job: Job, update: Union[JobUpdate, JobStatusMessage], now: datetime
+) -> bool:
+    """
+    the transition PATCH /jobs/{id} and job_status messages share. returns
+    whether the job left an active state, the caller then releases its
+    allocation
+    """
+    previous_status = job.status
+    if update.status:
+        job.status = update.status
+    if update.status == "running":
+        job.started_at = now
+        job.lease_expires_at = lease_deadline()
+    if update.status in FINISHED_JOB_STATUSES:
+        job.completed_at = now
+        # a coalesced batch may have skipped the running update
+        if job.started_at is None:
+            job.started_at = now
+    if update.status == "completed":
+        job.result_url = update.result
+        job.result_hash = update.result_hash
+    if update.error_message:
+        job.error_message = update.error_message
+    if update.seq is not None:
+        job.status_seq = update.seq
+
+    # release only on the first transition out of an active state, so a repeated
+    # update can never hand the same vram back twice
+    released = (
+        previous_status in ACTIVE_JOB_STATUSES
+        and update.status in FINISHED_JOB_STATUSES
+    )
+    if released:
+        job.lease_expires_at = None
+    return released
+
+
+def is_stale(job: Job, update: Union[JobUpdate, JobStatusMessage]) -> bool:
+    return update.seq is not None and update.seq <= (job.status_seq or 0)
+
+
+class JobStatusBuffer:
+    """
+    collects job_status messages from the machine websockets on this api
+    process. only the highest seq per job is kept, flush() applies them all
+    in one transaction and answers each with a JOB_STATUS_ACK
+    """
+
+    def __init__(self) -> None:
+        # job_id -> (machine_id, update)
+        self._pending: dict[str, tuple[str, JobStatusMessage]] = {}
+        self._full = asyncio.Event()
+
+    def submit(self, machine_id: str, update: JobStatusMessage) -> None:
+        job_id = str(update.job_id)
+        current = self._pending.get(job_id)
+        if current is None or update.seq > current[1].seq:
+            self._pending[job_id] = (machine_id, update)
+        if len(self._pending) >= CONFIG.JOB_STATUS_FLUSH_BATCH:
+            self._full.set()
+
+    async def flush(self) -> int:
+        """returns the number of updates applied"""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            rejected = await self._missing_results(pending)
+            async with AsyncSessionLocal() as db:
+                applied, stale, machines, results = await db.run_sync(
+                    write_job_updates,
+                    {
+                        job_id: entry
+                        for job_id, entry in pending.items()
+                        if job_id not in rejected
+                    },
+                )
+                await db.commit()
+        except Exception:
+            # keep whatever arrived meanwhile, it is newer
+            for job_id, entry in pending.items():
+                current = self._pending.get(job_id)
+                if current is None or entry[1].seq > current[1].seq:
+                    self._pending[job_id] = entry
+            raise
+
+        # only publish once the commit is visible to the workers
+        pipe = redis_bridge.redis.pipeline(transaction=False)
+        for job_id, status in applied.items():
+            if status is not None:
+                queue_job_event(pipe, job_id, "status", {"status": status})
+        for machine in machines:
+            if machine.is_online:
+                queue_machine_sync(pipe, machine)
+        await pipe.execute()
+        await result_cache.remember(results)
+        if machines:
+            await run_in_threadpool(request_drain)
+
+        for job_id, (machine_id, update) in pending.items():
+            ack: dict[str, Any] = {
+                "event": "JOB_STATUS_ACK",
+                "job_id": job_id,
+                "seq": update.seq,
+                "applied": job_id in applied,
+            }
+            detail = rejected.get(job_id) or stale.get(job_id)
+            if detail is not None:
+                ack["detail"] = detail
+            # dropped when the machine is behind, the agent resends unacked
+            # updates and a repeated seq is acked again
+            await manager.send_message(machine_id, ack, droppable=True)
+        return len(applied)
+
+    async def _missing_results(
+        self, pending: dict[str, tuple[str, JobStatusMessage]]
+    ) -> dict[str, str]:
+        rejected: dict[str, str] = {}
+        known: dict[str, bool] = {}
+        for job_id, (_, update) in pending.items():
+            digest = update.result_hash
+            if digest is None:
+                continue
+            if digest not in known:
+                known[digest] = await run_in_threadpool(blob_store.exists, digest)
+            if not known[digest]:
+                rejected[job_id] = "Result blob not found"
+        return rejected
+
+    async def run(self, interval: float = CONFIG.JOB_STATUS_FLUSH_INTERVAL_SECONDS):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error flushing job status updates")
+
+
+def write_job_updates(
+    db: Session, pending: dict[str, tuple[str, JobStatusMessage]]
+) -> tuple[
+    dict[str, Optional[str]], dict[str, str], list[Machine], dict[str, dict[str, Any]]
+]:
+    """
+    applies a batch of job_status updates under row locks taken in id order.
+    returns (applied job id -> new status or None when it stayed the same,
+    dropped job id -> reason, machines whose capacity changed, result cache
+    entries of deterministic jobs that completed), the caller commits
+    """
+    if not pending:
+        return {}, {}, [], {}
+    jobs: list[Job] = (
+        db.query(Job)
+        # function_args stays, the result cache key needs it
+        .options(defer(Job.pickled_function))
+        .filter(Job.id.in_([UUID(job_id) for job_id in pending]))
+        .order_by(Job.id)
+        .with_for_update()
+        .all()
+    )
+    applied: dict[str, Optional[str]] = {}
+    stale: dict[str, str] = {job_id: "Job not found" for job_id in pending}
+    released: list[Job] = []
+    results: dict[str, dict[str, Any]] = {}
+    now = datetime.now(timezone.utc)
+    for job in jobs:
+        job_id = str(job.id)
+        machine_id, update = pending[job_id]
+        del stale[job_id]
+        # the assignment may have moved on to another machine meanwhile
+        if str(job.machine_id) != machine_id:
+            stale[job_id] = "Job is not assigned to this machine"
+            continue
+        if is_stale(job, update):
+            stale[job_id] = "Stale seq"
+            continue
+        if job.status in FINISHED_JOB_STATUSES:
+            stale[job_id] = "Job already finished"
+            continue
+        previous_status = job.status
+        if apply_job_update(job, update, now):
+            released.append(job)
+        applied[job_id] = job.status if job.status != previous_status else None
+        entry = cache_entry(job)
+        if entry is not None and job.status != previous_status:
+            results[entry[0]] = entry[1]
+    db.flush()
+    if not released:
+        return applied, stale, [], results
+    release_allocations(db, released)
+    machine_ids = {job.machine_id for job in released}
+    machines = db.query(Machine).filter(Machine.id.in_(machine_ids)).all()
+    return applied, stale, machines, results
+
+
+job_status_buffer = JobStatusBuffer()
@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import case, update
+from sqlalchemy.orm import Session
+from app.core.config import CONFIG
+from app.models.job import ACTIVE_JOB_STATUSES, Job
+from app.models.machine import Machine
+from app.services.job_queue import QueuedJob, queue_entry
+from app.services.matcher import release_allocations
+
+
+def lease_deadline() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=CONFIG.JOB_LEASE_SECONDS)
+
+
+def renew_leases_statement(machine_id):
+    """pushes out the lease of every job the machine holds"""
+    return (
+        update(Job)
+        .where(Job.machine_id == machine_id, Job.status.in_(ACTIVE_JOB_STATUSES))
+        .values(lease_expires_at=lease_deadline())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def renew_leases(db: Session, machine_id) -> None:
+    """the caller commits, async sessions execute renew_leases_statement()"""
+    db.execute(renew_leases_statement(machine_id))
+
+
+def reap_expired_leases(
+    db: Session, batch_size: int
+) -> tuple[list[QueuedJob], list[str], list[Machine]]:
+    """
+    takes one batch of jobs whose lease ran out, frees their machines and puts
+    them back to pending, or to failed once they used up JOB_MAX_ATTEMPTS.
+    returns (requeued jobs as queue entries, failed job ids, machines whose
+    capacity changed)
+    """
+    expired: list[Job] = (
+        db.query(Job)
+        .filter(
+            Job.status.in_(ACTIVE_JOB_STATUSES),
+            Job.lease_expires_at < datetime.now(timezone.utc),
+        )
+        # walks the partial index on lease_expires_at, oldest first
+        .order_by(Job.lease_expires_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not expired:
+        db.rollback()
+        return [], [], []
+
+    machine_ids = list({job.machine_id for job in expired if job.machine_id})
+    requeued: list[QueuedJob] = []
+    failed: list[str] = []
+    for job in expired:
+        if (job.attempts or 0) + 1 < CONFIG.JOB_MAX_ATTEMPTS:
+            requeued.append(queue_entry(job))
+        else:
+            failed.append(str(job.id))
+
+    release_allocations(db, expired)
+    out_of_attempts = Job.attempts + 1 >= CONFIG.JOB_MAX_ATTEMPTS
+    db.execute(
+        update(Job)
+        .where(Job.id.in_([job.id for job in expired]))
+        .values(
+            attempts=Job.attempts + 1,
+            status=case((out_of_attempts, "failed"), else_="pending"),
+            error_message=case(
+                (out_of_attempts, "Machine stopped responding, out of attempts"),
+                else_=Job.error_message,
+            ),
+            machine_id=None,
+            vram_gb=None,
+            lease_expires_at=None,
+            status_seq=0,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    machines = db.query(Machine).filter(Machine.id.in_(machine_ids)).all()
+    return requeued, failed, machines
@@ -0,0 +1,504 @@
+from bisect import bisect_left, insort
+from typing import Any, Generic, Iterable, Optional, Protocol, TypeVar
+from uuid import UUID
+import redis
+from sqlalchemy import bindparam, case, func, update
+from sqlalchemy.orm import Session
+from app.core.config import CONFIG
+from app.models.job import Job
+from app.models.machine import Machine
+
+# machines with nothing running, scored by total vram. jobs that do not say how
+# much vram they need get a whole card from here
+IDLE_INDEX_PREFIX = "idle_machines"
+# machines with a free slot, scored by free vram. jobs with min_vram_gb are
+# bin-packed from here
+SHARED_INDEX_PREFIX = "free_vram"
+# machine ids per cached container image or dependency environment. only ever
+# asked about machines that already fit, so a stale member costs nothing
+WARM_INDEX_PREFIX = "warm_machines"
+# what each machine reported last, the next report is diffed against it
+INVENTORY_PREFIX = "machine_environments"
+
+
+def index_key(gpu_name: Optional[str] = None, prefix: str = IDLE_INDEX_PREFIX) -> str:
+    # every machine sits in the catch-all set and in the set for its gpu model,
+    # both scored by vram so a lookup is a single range query
+    if gpu_name:
+        return f"{prefix}:gpu:{gpu_name.strip().lower()}"
+    return f"{prefix}:all"
+
+
+def index_keys_for(
+    gpu_name: Optional[str], prefix: str = IDLE_INDEX_PREFIX
+) -> list[str]:
+    if gpu_name:
+        return [index_key(None, prefix), index_key(gpu_name, prefix)]
+    return [index_key(None, prefix)]
+
+
+def parse_requirements(requirements: Optional[dict]) -> tuple[Optional[str], int]:
+    """returns the (gpu_name, min_vram_gb) a job asks for"""
+    requirements = requirements or {}
+    gpu_name = requirements.get("gpu_name") or None
+    min_vram_gb = int(requirements.get("min_vram_gb") or 0)
+    return gpu_name, min_vram_gb
+
+
+def parse_environments(requirements: Optional[dict]) -> list[str]:
+    """
+    the image ("image:<ref>") and dependency environment ("env:<digest>") a job
+    starts fastest on where they are cached already
+    """
+    requirements = requirements or {}
+    environments: list[str] = []
+    if requirements.get("image"):
+        environments.append(f"image:{requirements['image']}")
+    if requirements.get("environment"):
+        environments.append(f"env:{requirements['environment']}")
+    return environments
+
+
+def inventory_of(data: dict) -> set[str]:
+    """the environments a cache_inventory message lists, at most ENV_CACHE_MAX_ITEMS"""
+    inventory: set[str] = set()
+    for kind, field in (("image", "images"), ("env", "environments")):
+        names = data.get(field)
+        if not isinstance(names, list):
+            continue
+        inventory.update(
+            f"{kind}:{name}" for name in names if isinstance(name, str) and name
+        )
+    return set(sorted(inventory)[: CONFIG.ENV_CACHE_MAX_ITEMS])
+
+
+def warm_key(environment: str) -> str:
+    return f"{WARM_INDEX_PREFIX}:{environment}"
+
+
+def inventory_key(machine_id: str) -> str:
+    return f"{INVENTORY_PREFIX}:{machine_id}"
+
+
+def queue_inventory_replace(
+    pipe: Any, machine_id: str, previous: set[str], current: set[str]
+) -> None:
+    """
+    moves the machine from the sets of environments it dropped into the ones it
+    reported, sync or asyncio pipeline, the caller executes it
+    """
+    for environment in previous - current:
+        pipe.srem(warm_key(environment), machine_id)
+    for environment in current:
+        pipe.sadd(warm_key(environment), machine_id)
+        # environments nobody reports any more go away on their own
+        pipe.expire(warm_key(environment), CONFIG.ENV_CACHE_TTL_SECONDS)
+    pipe.delete(inventory_key(machine_id))
+    if current:
+        pipe.sadd(inventory_key(machine_id), *current)
+        pipe.expire(inventory_key(machine_id), CONFIG.ENV_CACHE_TTL_SECONDS)
+
+
+def vram_allocation(requirements: Optional[dict], machine_vram_gb: int) -> int:
+    # a job without a vram budget takes the whole card
+    _, min_vram_gb = parse_requirements(requirements)
+    return min_vram_gb or machine_vram_gb
+
+
+def queue_index_sync(
+    pipe: Any,
+    machine_id: str,
+    gpu_name: Optional[str],
+    vram_gb: Optional[int],
+    vram_allocated_gb: int,
+    running_jobs: int,
+    max_concurrent_jobs: int,
+) -> None:
+    """
+    writes the machine's current capacity into the index, works for both the
+    sync and the asyncio pipelines, the caller executes it
+    """
+    vram_gb = vram_gb or 0
+    free_vram_gb = vram_gb - vram_allocated_gb
+    for key in index_keys_for(gpu_name, IDLE_INDEX_PREFIX):
+        if running_jobs == 0:
+            pipe.zadd(key, {machine_id: vram_gb})
+        else:
+            pipe.zrem(key, machine_id)
+    for key in index_keys_for(gpu_name, SHARED_INDEX_PREFIX):
+        if running_jobs < max_concurrent_jobs and free_vram_gb > 0:
+            pipe.zadd(key, {machine_id: free_vram_gb})
+        else:
+            pipe.zrem(key, machine_id)
+
+
+def queue_machine_sync(pipe: Any, machine: Machine) -> None:
+    queue_index_sync(
+        pipe,
+        str(machine.id),
+        machine.gpu_name,
+        machine.vram_gb,
+        machine.vram_allocated_gb or 0,
+        machine.running_jobs or 0,
+        machine.max_concurrent_jobs or 1,
+    )
+
+
+def queue_index_remove(pipe: Any, machine_id: str, gpu_name: Optional[str]) -> None:
+    for prefix in (IDLE_INDEX_PREFIX, SHARED_INDEX_PREFIX):
+        for key in index_keys_for(gpu_name, prefix):
+            pipe.zrem(key, machine_id)
+
+
+def release_allocation(db: Session, job: Job) -> None:
+    """gives the job's slot and vram back to its machine, the caller commits"""
+    release_allocations(db, [job])
+
+
+def release_allocations(db: Session, jobs: Iterable[Job]) -> None:
+    """release_allocation() for many jobs, one executemany grouped by machine"""
+    freed: dict[Any, list[int]] = {}
+    for job in jobs:
+        if job.machine_id is None:
+            continue
+        totals = freed.setdefault(job.machine_id, [0, 0])
+        totals[0] += 1
+        totals[1] += job.vram_gb or 0
+    if not freed:
+        return
+
+    table = Machine.__table__
+    count = bindparam("freed_jobs")
+    vram_gb = bindparam("freed_vram_gb")
+    remaining = table.c.running_jobs - count
+    db.execute(
+        update(table)
+        .where(table.c.id == bindparam("machine_id"))
+        .values(
+            running_jobs=case((remaining > 0, remaining), else_=0),
+            vram_allocated_gb=case(
+                (
+                    table.c.vram_allocated_gb > vram_gb,
+                    table.c.vram_allocated_gb - vram_gb,
+                ),
+                else_=0,
+            ),
+            status=case(
+                (table.c.is_online.is_(False), "offline"),
+                (remaining > 0, "busy"),
+                else_="idle",
+            ),
+        ),
+        [
+            {"machine_id": machine_id, "freed_jobs": jobs_freed, "freed_vram_gb": vram}
+            # id order, concurrent flushes then lock the machines alike
+            for machine_id, (jobs_freed, vram) in sorted(
+                freed.items(), key=lambda item: str(item[0])
+            )
+        ],
+    )
+
+
+def fitting_machines(db: Session, gpu_name: Optional[str], min_vram_gb: int):
+    """online machines with room for such a job right now, tightest fit first"""
+    query = db.query(Machine).filter(
+        Machine.is_online.is_(True),
+        Machine.running_jobs < Machine.max_concurrent_jobs,
+    )
+    if gpu_name:
+        query = query.filter(func.lower(Machine.gpu_name) == gpu_name.lower())
+    if min_vram_gb:
+        free_vram_gb = Machine.vram_gb - Machine.vram_allocated_gb
+        return query.filter(free_vram_gb >= min_vram_gb).order_by(free_vram_gb)
+    return query.filter(Machine.running_jobs == 0).order_by(Machine.vram_gb)
+
+
+def count_free_machines(db: Session) -> int:
+    """online machines with a free slot, what the shared index holds when warm"""
+    return (
+        db.query(func.count(Machine.id))
+        .filter(
+            Machine.is_online.is_(True),
+            Machine.running_jobs < Machine.max_concurrent_jobs,
+        )
+        .scalar()
+        or 0
+    )
+
+
+def unplaceable_jobs(db: Session, jobs: Iterable[Job]) -> set[str]:
+    """
+    ids of the jobs no machine could ever run, online or not and however busy.
+    one existence check per distinct requirement
+    """
+    classes: dict[tuple[Optional[str], int], list[str]] = {}
+    for job in jobs:
+        classes.setdefault(parse_requirements(job.requirements), []).append(str(job.id))
+    unplaceable: set[str] = set()
+    for (gpu_name, min_vram_gb), job_ids in classes.items():
+        query = db.query(Machine.id).filter(Machine.max_concurrent_jobs > 0)
+        if gpu_name:
+            query = query.filter(func.lower(Machine.gpu_name) == gpu_name.lower())
+        if min_vram_gb:
+            query = query.filter(Machine.vram_gb >= min_vram_gb)
+        if query.first() is None:
+            unplaceable.update(job_ids)
+    return unplaceable
+
+
+class MachineIndex:
+    """redis backed index of machines with spare capacity, shared by api and workers"""
+
+    def __init__(self, client: redis.Redis) -> None:
+        self.redis = client
+
+    def sync(self, machine: Machine) -> None:
+        pipe = self.redis.pipeline()
+        queue_machine_sync(pipe, machine)
+        pipe.execute()
+
+    def remove(self, machine_id: str, gpu_name: Optional[str]) -> None:
+        pipe = self.redis.pipeline()
+        queue_index_remove(pipe, machine_id, gpu_name)
+        pipe.execute()
+
+    def free_machine_count(self) -> int:
+        key = index_key(None, SHARED_INDEX_PREFIX)
+        return int(self.redis.zcard(key))  # type: ignore[arg-type]
+
+    def candidates(self, requirements: Optional[dict], limit: int = 5) -> list[str]:
+        # tightest fit first, so big cards stay free for big jobs
+        gpu_name, min_vram_gb = parse_requirements(requirements)
+        prefix = SHARED_INDEX_PREFIX if min_vram_gb else IDLE_INDEX_PREFIX
+        environments = parse_environments(requirements)
+        fits: list[str] = self.redis.zrangebyscore(  # type: ignore[assignment]
+            index_key(gpu_name, prefix),
+            min_vram_gb,
+            "+inf",
+            start=0,
+            num=CONFIG.LOCALITY_CANDIDATES if environments else limit,
+        )
+        if not environments or not fits:
+            return fits
+        warm = self.warm_machines(environments, fits)
+        # a warm cache beats a tighter fit, cold machines are the fallback
+        return sorted(fits, key=lambda machine_id: machine_id not in warm)[:limit]
+
+    def warm_machines(
+        self, environments: list[str], machine_ids: list[str]
+    ) -> set[str]:
+        """the machines that have every one of the environments cached"""
+        pipe = self.redis.pipeline(transaction=False)
+        for environment in environments:
+            pipe.smismember(warm_key(environment), machine_ids)
+        warm = set(machine_ids)
+        for members in pipe.execute():
+            warm &= {
+                machine_id for machine_id, cached in zip(machine_ids, members) if cached
+            }
+        return warm
+
+    def inventories(self, machine_ids: list[str]) -> dict[str, set[str]]:
+        """the cached environments of many machines in one round trip"""
+        pipe = self.redis.pipeline(transaction=False)
+        for machine_id in machine_ids:
+            pipe.smembers(inventory_key(machine_id))
+        return dict(zip(machine_ids, pipe.execute()))
+
+    def claim(self, db: Session, requirements: Optional[dict]) -> Optional[Machine]:
+        """
+        atomically takes a slot (and the vram) on a matching machine inside the
+        caller's transaction. the caller commits and records vram_allocation()
+        on the job
+        """
+        _, min_vram_gb = parse_requirements(requirements)
+        for machine_id in self.candidates(requirements):
+            # compare-and-set, the capacity check and the increment are one statement
+            result = db.execute(self._claim_statement(machine_id, min_vram_gb))
+            machine: Machine | None = db.get(Machine, UUID(machine_id))
+            if machine is None:
+                self.remove(machine_id, None)
+                continue
+            db.refresh(machine)
+            # claimed or stale, either way the index gets the row's real capacity
+            self.sync(machine)
+            if result.rowcount:  # type: ignore[attr-defined]
+                return machine
+
+        # the index can be cold after a redis restart, fall back to a locked scan
+        return self._claim_from_db(db, requirements)
+
+    def _claim_statement(self, machine_id: str, min_vram_gb: int):
+        statement = update(Machine).where(
+            Machine.id == UUID(machine_id),
+            Machine.is_online.is_(True),
+            Machine.running_jobs < Machine.max_concurrent_jobs,
+        )
+        if min_vram_gb:
+            statement = statement.where(
+                Machine.vram_gb - Machine.vram_allocated_gb >= min_vram_gb
+            ).values(vram_allocated_gb=Machine.vram_allocated_gb + min_vram_gb)
+        else:
+            statement = statement.where(Machine.running_jobs == 0).values(
+                vram_allocated_gb=Machine.vram_gb
+            )
+        return statement.values(
+            running_jobs=Machine.running_jobs + 1, status="busy"
+        ).execution_options(synchronize_session=False)
+
+    def _claim_from_db(
+        self, db: Session, requirements: Optional[dict]
+    ) -> Optional[Machine]:
+        machine: Machine | None = (
+            fitting_machines(db, *parse_requirements(requirements))
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if machine:
+            machine.vram_allocated_gb = (machine.vram_allocated_gb or 0) + (
+                vram_allocation(requirements, machine.vram_gb or 0)
+            )
+            machine.running_jobs = (machine.running_jobs or 0) + 1
+            machine.status = "busy"
+            db.flush()
+            self.sync(machine)
+        return machine
+
+
+class PoolMachine(Protocol):
+    """what FreeMachinePool reads off a Machine row, or off a stand-in for one"""
+
+    id: Any
+    gpu_name: Any
+    vram_gb: Any
+    vram_allocated_gb: Any
+    running_jobs: Any
+    max_concurrent_jobs: Any
+
+
+PoolMachineT = TypeVar("PoolMachineT", bound=PoolMachine)
+
+
+class FreeMachinePool(Generic[PoolMachineT]):
+    """
+    in-memory mirror of the index for placing a whole batch in one pass, same
+    keys and the same fit rules as MachineIndex.candidates. the pool keeps its
+    own running totals so several jobs can be packed onto one machine
+    """
+
+    def __init__(
+        self,
+        machines: Iterable[PoolMachineT],
+        inventories: Optional[dict[str, set[str]]] = None,
+    ) -> None:
+        self._entries: dict[str, list[tuple[int, str]]] = {}
+        self._machines: dict[str, PoolMachineT] = {}
+        # machine_id -> [vram_gb, vram_allocated_gb, running_jobs, max_concurrent_jobs]
+        self._capacity: dict[str, list[int]] = {}
+        # machine_id -> cached environments, see MachineIndex.inventories
+        self._inventories: dict[str, set[str]] = inventories or {}
+        for machine in machines:
+            self.add(machine)
+
+    def __len__(self) -> int:
+        return len(self._machines)
+
+    def machine_ids(self) -> list[str]:
+        return list(self._machines)
+
+    def free_slots(self) -> int:
+        return sum(slots - running for _, _, running, slots in self._capacity.values())
+
+    def capacity(self, machine_id: str) -> tuple[int, int, int, int]:
+        vram_gb, allocated, running, slots = self._capacity[machine_id]
+        return vram_gb, allocated, running, slots
+
+    def add(self, machine: PoolMachineT, inventory: Optional[set[str]] = None) -> None:
+        machine_id = str(machine.id)
+        self._machines[machine_id] = machine
+        if inventory is not None:
+            self._inventories[machine_id] = inventory
+        self._capacity[machine_id] = [
+            machine.vram_gb or 0,
+            machine.vram_allocated_gb or 0,
+            machine.running_jobs or 0,
+            machine.max_concurrent_jobs or 1,
+        ]
+        self._insert(machine_id)
+
+    def take(self, requirements: Optional[dict]) -> Optional[tuple[PoolMachineT, int]]:
+        """returns the machine and the vram allocated on it"""
+        gpu_name, min_vram_gb = parse_requirements(requirements)
+        prefix = SHARED_INDEX_PREFIX if min_vram_gb else IDLE_INDEX_PREFIX
+        entries = self._entries.get(index_key(gpu_name, prefix))
+        if not entries:
+            return None
+        position = bisect_left(entries, (min_vram_gb, ""))
+        if position == len(entries):
+            return None
+        environments = parse_environments(requirements)
+        if environments:
+            position = self._warm_position(entries, position, environments)
+
+        _, machine_id = entries[position]
+        if environments:
+            # the machine pulls them for this job, later jobs of the batch
+            # that need the same ones follow it there
+            self._inventories.setdefault(machine_id, set()).update(environments)
+        self._discard(machine_id)
+        capacity = self._capacity[machine_id]
+        allocated = vram_allocation(requirements, capacity[0])
+        capacity[1] += allocated
+        capacity[2] += 1
+        self._insert(machine_id)
+        return self._machines[machine_id], allocated
+
+    def release(self, machine_id: str, vram_gb: int) -> None:
+        """gives back a slot and the vram take() allocated on it"""
+        self._discard(machine_id)
+        capacity = self._capacity[machine_id]
+        capacity[1] = max(capacity[1] - vram_gb, 0)
+        capacity[2] = max(capacity[2] - 1, 0)
+        self._insert(machine_id)
+
+    def remove(self, machine_id: str) -> None:
+        self._discard(machine_id)
+        del self._capacity[machine_id]
+        del self._machines[machine_id]
+
+    def _warm_position(
+        self, entries: list[tuple[int, str]], position: int, environments: list[str]
+    ) -> int:
+        """the first fit with the environments cached, else the tightest fit"""
+        for candidate in range(
+            position, min(len(entries), position + CONFIG.LOCALITY_CANDIDATES)
+        ):
+            cached = self._inventories.get(entries[candidate][1])
+            if cached and cached.issuperset(environments):
+                return candidate
+        return position
+
+    def _keys(self, machine_id: str) -> list[tuple[str, int]]:
+        vram_gb, allocated, running, slots = self._capacity[machine_id]
+        gpu_name = self._machines[machine_id].gpu_name
+        keys: list[tuple[str, int]] = []
+        if running == 0:
+            keys += [(key, vram_gb) for key in index_keys_for(gpu_name)]
+        if running < slots and vram_gb - allocated > 0:
+            keys += [
+                (key, vram_gb - allocated)
+                for key in index_keys_for(gpu_name, SHARED_INDEX_PREFIX)
+            ]
+        return keys
+
+    def _insert(self, machine_id: str) -> None:
+        for key, score in self._keys(machine_id):
+            insort(self._entries.setdefault(key, []), (score, machine_id))
+
+    def _discard(self, machine_id: str) -> None:
+        for key, score in self._keys(machine_id):
+            entries = self._entries[key]
+            del entries[bisect_left(entries, (score, machine_id))]
+
+
+machine_index = MachineIndex(redis.from_url(CONFIG.REDIS_URL, decode_responses=True))
@@ -1,6 +1,23 @@
 import redis.asyncio as redis
+from redis.exceptions import ResponseError
 import json
+from typing import Optional
 from app.core.config import CONFIG
+from app.models.machine import Machine
+from app.services.dispatch import (
+    JOB_STREAM_GROUP,
+    LAST_SEEN_KEY,
+    MACHINE_NODES_KEY,
+    NODE_ID,
+    UNREGISTER_SCRIPT,
+    job_stream_key,
+)
+from app.services.matcher import (
+    inventory_key,
+    queue_index_remove,
+    queue_inventory_replace,
+    queue_machine_sync,
+)
 
 redis_url: str = CONFIG.REDIS_URL
 
@@ -8,22 +25,88 @@ redis_url: str = CONFIG.REDIS_URL
 class RedisBridge:
     def __init__(self) -> None:
         self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        # packed telemetry records are bytes, they must not be decoded
+        self.binary = redis.Redis.from_url(redis_url)
         self.pubsub = self.redis.pubsub()
+        self.unregister_script = self.redis.register_script(UNREGISTER_SCRIPT)
 
-    async def publish_job_start(
-        self, machine_id: str, job_id: str, code_payload: str
+    async def register_machine(self, machine_id: str) -> None:
+        await self.redis.hset(MACHINE_NODES_KEY, machine_id, NODE_ID)  # type: ignore[misc]
+
+    async def unregister_machine(self, machine_id: str) -> bool:
+        """returns False when the machine is registered with another node now"""
+        removed = await self.unregister_script(
+            keys=[MACHINE_NODES_KEY], args=[machine_id, NODE_ID]
+        )
+        return bool(removed)
+
+    async def unregister_machines(self, machine_ids: list[str]) -> None:
+        for machine_id in machine_ids:
+            await self.unregister_machine(machine_id)
+
+    async def record_last_seen(self, last_seen: dict[str, float]) -> None:
+        await self.redis.zadd(LAST_SEEN_KEY, last_seen)  # type: ignore[arg-type]
+
+    async def sync_machine_capacity(self, machine: Machine) -> None:
+        pipe = self.redis.pipeline()
+        queue_machine_sync(pipe, machine)
+        await pipe.execute()
+
+    async def mark_machine_unavailable(
+        self, machine_id: str, gpu_name: Optional[str]
     ) -> None:
-        message = {
-            "event": "START_JOB",
-            "machine_id": machine_id,
-            "job_id": job_id,
-            "code_payload": code_payload,
-        }
+        pipe = self.redis.pipeline()
+        queue_index_remove(pipe, machine_id, gpu_name)
+        await pipe.execute()
+
+    async def replace_inventory(self, machine_id: str, inventory: set[str]) -> None:
+        previous = await self.redis.smembers(inventory_key(machine_id))  # type: ignore[misc]
+        pipe = self.redis.pipeline()
+        queue_inventory_replace(pipe, machine_id, previous, inventory)
+        await pipe.execute()
+
+    async def ensure_job_stream(self, machine_id: str) -> None:
+        try:
+            await self.redis.xgroup_create(
+                job_stream_key(machine_id), JOB_STREAM_GROUP, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def read_job_deliveries(
+        self, machine_id: str, replay: bool = False
+    ) -> list[dict]:
+        """
+        new START_JOB messages for the machine, or with replay=True the ones
+        that were delivered before but never acked
+        """
+        deliveries: list[dict] = []
+        last_id = "0" if replay else ">"
+        while True:
+            response = await self.redis.xreadgroup(
+                JOB_STREAM_GROUP,
+                machine_id,
+                {job_stream_key(machine_id): last_id},
+                count=CONFIG.JOB_STREAM_READ_BATCH,
+            )
+            entries = response[0][1] if response else []
+            if not entries:
+                return deliveries
+            for entry_id, fields in entries:
+                data = json.loads(fields["payload"])
+                data["delivery_id"] = entry_id
+                deliveries.append(data)
+            if replay:
+                # the pending list is paged by id, new reads page themselves
+                last_id = entries[-1][0]
 
-        await self.redis.publish("gpu_events", json.dumps(message))
+    async def ack_job_delivery(self, machine_id: str, delivery_id: str) -> None:
+        await self.redis.xack(job_stream_key(machine_id), JOB_STREAM_GROUP, delivery_id)
 
     async def close(self) -> None:
         await self.redis.close()
+        await self.binary.close()
 
 
 redis_bridge = RedisBridge()
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import time
+from typing import Any, Optional
+from app.core.config import CONFIG
+from app.models.job import Job
+from app.services.redis_bridge import redis_bridge
+
+# requirements={"deterministic": true} opts a job in. its result is then cached
+# under a hash of everything that decides it and an identical job of the same
+# user later on is completed from the cache without ever reaching a machine
+MEMO_FLAG = "deterministic"
+
+KEY_PREFIX = "result_cache"
+# memo key -> last use, the least recently used entries go first
+INDEX_KEY = "result_cache:index"
+
+
+def is_deterministic(requirements: Optional[dict]) -> bool:
+    return bool(requirements and requirements.get(MEMO_FLAG))
+
+
+def memo_key(
+    owner_id: Any,
+    code_hash: Optional[str],
+    function_args: Optional[str],
+    input_hash: Optional[str],
+    requirements: Optional[dict],
+) -> Optional[str]:
+    """
+    sha256 over the owner, the code, the arguments, the input and the
+    environment, which is every requirement but the flag. None for jobs that
+    did not opt in. results come from provider machines nobody vouches for, so
+    one user's never completes another user's job
+    """
+    if not is_deterministic(requirements) or code_hash is None:
+        return None
+    environment = {
+        key: value for key, value in (requirements or {}).items() if key != MEMO_FLAG
+    }
+    identity = json.dumps(
+        {
+            "owner": str(owner_id),
+            "code": code_hash,
+            "args": function_args,
+            "input": input_hash,
+            "environment": environment,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+def job_memo_key(job: Job) -> Optional[str]:
+    return memo_key(
+        job.creator_id,
+        job.code_hash,
+        job.function_args,
+        job.input_hash,
+        job.requirements,
+    )
+
+
+def cache_entry(job: Job) -> Optional[tuple[str, dict[str, Any]]]:
+    """(memo key, entry) for a deterministic job that completed with a result"""
+    if job.status != "completed" or (job.result_hash is None and not job.result_url):
+        return None
+    key = job_memo_key(job)
+    if key is None:
+        return None
+    entry = {
+        "job_id": str(job.id),
+        "result_hash": job.result_hash,
+        "result_url": job.result_url,
+    }
+    return key, entry
+
+
+class ResultCache:
+    """
+    results of deterministic jobs in redis. entries expire after
+    RESULT_CACHE_TTL_SECONDS and past RESULT_CACHE_MAX_ENTRIES the least
+    recently used ones are evicted
+    """
+
+    async def lookup(self, keys: list[str]) -> list[Optional[dict[str, Any]]]:
+        if not keys:
+            return []
+        raw = await redis_bridge.redis.mget([f"{KEY_PREFIX}:{key}" for key in keys])
+        entries = [json.loads(value) if value else None for value in raw]
+        hits = {key: time.time() for key, entry in zip(keys, entries) if entry}
+        if hits:
+            await redis_bridge.redis.zadd(INDEX_KEY, hits)  # type: ignore[arg-type]
+        return entries
+
+    async def remember(self, entries: dict[str, dict[str, Any]]) -> None:
+        if not entries:
+            return
+        now = time.time()
+        pipe = redis_bridge.redis.pipeline(transaction=False)
+        for key, entry in entries.items():
+            pipe.set(
+                f"{KEY_PREFIX}:{key}",
+                json.dumps(entry),
+                ex=CONFIG.RESULT_CACHE_TTL_SECONDS,
+            )
+        pipe.zadd(INDEX_KEY, {key: now for key in entries})
+        # entries that expired on their own leave the index as well
+        pipe.zremrangebyscore(INDEX_KEY, "-inf", now - CONFIG.RESULT_CACHE_TTL_SECONDS)
+        pipe.zcard(INDEX_KEY)
+        *_, size = await pipe.execute()
+        if size > CONFIG.RESULT_CACHE_MAX_ENTRIES:
+            await self.evict(size - CONFIG.RESULT_CACHE_MAX_ENTRIES)
+
+    async def evict(self, count: int) -> None:
+        evicted = await redis_bridge.redis.zpopmin(INDEX_KEY, count)
+        if evicted:
+            await redis_bridge.redis.delete(
+                *[f"{KEY_PREFIX}:{key}" for key, _ in evicted]
+            )
+
+
+result_cache = ResultCache()
@@ -0,0 +1,257 @@
+# batched scheduler, used when SCHEDULER_MODE is "loop":
+# python -m app.services.scheduler
+#
+# every tick pulls the due pending jobs and the free machines, places them in one
+# pass, commits once and publishes all START_JOB messages in one pipeline. jobs
+# that fit none of those machines get a second pass over machines fetched for
+# their requirements. several loops can run side by side, jobs are claimed with
+# ZREM and rows are locked with SKIP LOCKED so two loops never place the same job
+# or machine
+
+import logging
+import time
+from typing import Optional
+from uuid import UUID
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from app.core.config import CONFIG
+from app.core.observability import setup_logging, setup_tracing, tracer
+from app.db.session import SessionLocal
+from app.models.job import Job
+from app.models.machine import Machine
+from app.models.users import User  # noqa: F401
+from app.services.job_queue import pending_queue
+from app.services.leases import lease_deadline
+from app.services.matcher import (
+    FreeMachinePool,
+    fitting_machines,
+    machine_index,
+    parse_requirements,
+    queue_index_sync,
+    unplaceable_jobs,
+)
+from app.services.tasks import (
+    build_start_message,
+    fail_unplaceable_jobs,
+    publish_start_jobs,
+    redis_client,
+    requeue_expired_jobs,
+    restore_pending_queue,
+    return_unclaimed_jobs,
+)
+from app.services.heartbeats import sweep_silent_machines
+
+
+logger = logging.getLogger(__name__)
+
+
+def place(
+    pool: FreeMachinePool[Machine],
+    jobs_by_id: dict[str, Job],
+    job_ids: list[str],
+    assignments: list[tuple[str, Job, Machine, int]],
+) -> list[str]:
+    """places the jobs in queue order, returns the ones that did not fit"""
+    unplaced: list[str] = []
+    for job_id in job_ids:
+        job = jobs_by_id.get(job_id)
+        if job is None:
+            # already handled or locked by another scheduler
+            continue
+        placement = pool.take(job.requirements)
+        if placement is None:
+            unplaced.append(job_id)
+            continue
+        machine, vram_gb = placement
+        assignments.append((job_id, job, machine, vram_gb))
+    return unplaced
+
+
+def add_candidates(
+    db: Session, pool: FreeMachinePool[Machine], jobs: list[Job]
+) -> set[str]:
+    """
+    locks and adds to the pool up to one more fitting machine per job, one query
+    per distinct requirement. returns the jobs some of whose fitting machines
+    were skipped as locked
+    """
+    classes: dict[tuple[Optional[str], int], list[str]] = {}
+    for job in jobs:
+        classes.setdefault(parse_requirements(job.requirements), []).append(str(job.id))
+    contended: set[str] = set()
+    for (gpu_name, min_vram_gb), job_ids in classes.items():
+        query = fitting_machines(db, gpu_name, min_vram_gb).filter(
+            Machine.id.notin_([UUID(machine_id) for machine_id in pool.machine_ids()])
+        )
+        found: list[Machine] = (
+            query.with_for_update(skip_locked=True).limit(len(job_ids)).all()
+        )
+        if len(found) < len(job_ids) and query.count() > len(found):
+            contended.update(job_ids)
+        inventories = machine_index.inventories([str(machine.id) for machine in found])
+        for machine in found:
+            pool.add(machine, inventories[str(machine.id)])
+    return contended
+
+
+def run_tick(db: Session, batch_size: int = CONFIG.SCHEDULER_BATCH_SIZE) -> int:
+    """places one batch, returns the number of jobs dispatched"""
+    machines: list[Machine] = (
+        db.query(Machine)
+        .filter(
+            Machine.is_online.is_(True),
+            Machine.running_jobs < Machine.max_concurrent_jobs,
+        )
+        .with_for_update(skip_locked=True)
+        .limit(batch_size)
+        .all()
+    )
+    if not machines:
+        db.rollback()
+        return 0
+
+    pool = FreeMachinePool(
+        machines, machine_index.inventories([str(machine.id) for machine in machines])
+    )
+    job_ids = pending_queue.pop_due(min(batch_size, pool.free_slots()))
+    if not job_ids:
+        db.rollback()
+        return 0
+
+    jobs_by_id: dict[str, Job] = {
+        str(job.id): job
+        for job in db.query(Job)
+        .filter(
+            Job.id.in_([UUID(job_id) for job_id in job_ids]), Job.status == "pending"
+        )
+        .with_for_update(skip_locked=True)
+    }
+
+    # locked by another scheduler or handled already, sorted out after the commit
+    unclaimed = [job_id for job_id in job_ids if job_id not in jobs_by_id]
+    assignments: list[tuple[str, Job, Machine, int]] = []
+    unplaced = place(pool, jobs_by_id, job_ids, assignments)
+    contended: set[str] = set()
+    if unplaced:
+        # the pool is whichever batch_size machines the database returned first,
+        # look for machines that fit what is left over before giving up on it
+        contended = add_candidates(
+            db, pool, [jobs_by_id[job_id] for job_id in unplaced]
+        )
+        unplaced = place(pool, jobs_by_id, unplaced, assignments)
+
+    # everything the publish step needs, read before the commit expires the rows
+    dispatches = [
+        (job_id, str(machine.id), build_start_message(job, str(machine.id)))
+        for job_id, job, machine, _ in assignments
+    ]
+    touched = {str(machine.id): machine for _, _, machine, _ in assignments}
+    index_updates = [
+        (machine_id, machine.gpu_name, *pool.capacity(machine_id))
+        for machine_id, machine in touched.items()
+    ]
+    if assignments:
+        lease_expires_at = lease_deadline()
+        db.execute(
+            update(Job),
+            [
+                {
+                    "id": job.id,
+                    "status": "assigned",
+                    "machine_id": machine.id,
+                    "vram_gb": vram_gb,
+                    "lease_expires_at": lease_expires_at,
+                }
+                for _, job, machine, vram_gb in assignments
+            ],
+        )
+        # the rows are locked for the whole tick, absolute values are safe
+        db.execute(
+            update(Machine),
+            [
+                {
+                    "id": UUID(machine_id),
+                    "vram_allocated_gb": allocated,
+                    "running_jobs": running,
+                    "status": "busy",
+                }
+                for machine_id, _, _, allocated, running, _ in index_updates
+            ],
+        )
+    # machines that fit were locked by another scheduler, not worth an attempt
+    waiting = [job_id for job_id in unplaced if job_id in contended]
+    retried = [job_id for job_id in unplaced if job_id not in contended]
+    # a job waiting for a busy machine never runs out of attempts
+    may_fail = unplaceable_jobs(db, [jobs_by_id[job_id] for job_id in retried])
+    db.commit()
+
+    pending_queue.put_back(waiting)
+    return_unclaimed_jobs(db, unclaimed)
+    exhausted = pending_queue.requeue_many(retried, may_fail)
+    if exhausted:
+        fail_unplaceable_jobs(db, exhausted)
+    if not dispatches:
+        return 0
+
+    pending_queue.forget_many([job_id for job_id, _, _ in dispatches])
+    pipe = redis_client.pipeline(transaction=False)
+    for update_args in index_updates:
+        queue_index_sync(pipe, *update_args)
+    publish_start_jobs(
+        [(machine_id, message) for _, machine_id, message in dispatches], pipe
+    )
+    pipe.execute()
+    return len(dispatches)
+
+
+def run_scheduler(tick_seconds: float = CONFIG.SCHEDULER_TICK_SECONDS) -> None:
+    logger.info(
+        "Scheduler loop started, free machines: %d",
+        machine_index.free_machine_count(),
+    )
+    next_reap = time.monotonic()
+    # restored once at startup already
+    next_restore = next_reap + CONFIG.PENDING_RESTORE_INTERVAL_SECONDS
+    while True:
+        started = time.monotonic()
+        placed = 0
+        db: Session = SessionLocal()
+        try:
+            # there is no beat in loop mode, the loop sweeps silent machines,
+            # reaps expired leases and restores the queue itself
+            if started >= next_restore:
+                next_restore = started + CONFIG.PENDING_RESTORE_INTERVAL_SECONDS
+                restore_pending_queue()
+            if started >= next_reap:
+                next_reap = started + CONFIG.LEASE_REAP_INTERVAL_SECONDS
+                silent = sweep_silent_machines(db, redis_client)
+                if silent:
+                    logger.info("Machines went silent, marked offline: %d", len(silent))
+                reaped = requeue_expired_jobs(db)
+                if reaped:
+                    logger.info("Requeued jobs with expired leases: %d", reaped)
+            with tracer.start_as_current_span("scheduler_tick") as span:
+                placed = run_tick(db)
+                span.set_attribute("placed", placed)
+            if placed:
+                logger.debug("Scheduler placed jobs: %d", placed)
+        except Exception:
+            db.rollback()
+            logger.exception("Error in scheduler tick")
+        finally:
+            db.close()
+
+        # a full batch means there is more waiting, go again straight away
+        if placed < CONFIG.SCHEDULER_BATCH_SIZE:
+            time.sleep(max(0.0, tick_seconds - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    setup_logging()
+    setup_tracing()
+    db: Session = SessionLocal()
+    try:
+        logger.info("Restored pending jobs: %d", pending_queue.restore(db))
+    finally:
+        db.close()
+    run_scheduler()
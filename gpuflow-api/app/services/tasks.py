@@ -1,53 +1,285 @@
+import logging
+from typing import Optional
+from celery.signals import worker_process_init, worker_ready
 from sqlalchemy.orm import Session
 from app.core.celery_app import celery_app
+from app.core.observability import setup_tracing, tracer
 from app.db.session import SessionLocal
 from app.models.job import Job
 from app.models.machine import Machine
 from app.models.users import User  # noqa: F401
+from app.services.dispatch import queue_start_job, resolve_nodes
+from app.services.job_logs import queue_job_event
+from app.services.job_queue import pending_queue, queue_entry
+from app.services import leases
+from app.services.heartbeats import sweep_silent_machines
+from app.services.matcher import (
+    count_free_machines,
+    machine_index,
+    queue_machine_sync,
+    unplaceable_jobs,
+    vram_allocation,
+)
 from uuid import UUID
 import redis
 import json
 from app.core.config import CONFIG
 
-redis_client = redis.from_url(CONFIG.CELERY_RESULT_BACKEND, decode_responses=True)
+# same redis the api processes listen on, see app/services/dispatch.py
+redis_client = redis.from_url(CONFIG.REDIS_URL, decode_responses=True)
+
+logger = logging.getLogger(__name__)
+
+
+def build_start_message(job: Job, machine_id: str) -> str:
+    message = {
+        "event": "START_JOB",
+        "machine_id": machine_id,
+        "job_id": str(job.id),
+    }
+    # agents fetch the code from /blobs unless they have it cached already
+    if job.code_hash is not None:
+        message["code_hash"] = job.code_hash
+    else:
+        message["code"] = job.pickled_function.decode("utf-8")
+    if job.input_hash is not None:
+        message["input_hash"] = job.input_hash
+    # jobs from POST /jobs/batch share the code and differ in their arguments
+    if job.function_args is not None:
+        message["args"] = json.loads(job.function_args)
+    # the api measures the assignment latency from it
+    if job.created_at is not None:
+        message["submitted_at"] = job.created_at.timestamp()
+    return json.dumps(message)
+
+
+def publish_start_jobs(messages: list[tuple[str, str]], pipe=None) -> None:
+    """
+    appends (machine_id, message) pairs to the machines' job streams and rings
+    the api node holding each machine, queued on `pipe` when given, otherwise
+    sent right away
+    """
+    nodes = resolve_nodes(redis_client, [machine_id for machine_id, _ in messages])
+    own_pipe = pipe is None
+    if own_pipe:
+        pipe = redis_client.pipeline(transaction=False)
+    for (machine_id, message), node_id in zip(messages, nodes):
+        queue_start_job(pipe, machine_id, node_id, message)
+    if own_pipe:
+        pipe.execute()
+
+
+def try_assign_job(db: Session, job_id: str) -> Optional[bool]:
+    """
+    returns True when the job was dispatched, False when no machine fits and
+    None when there is nothing to do (job gone, locked or already handled)
+    """
+    with tracer.start_as_current_span("assign_job", attributes={"job_id": job_id}):
+        return _try_assign_job(db, job_id)
+
+
+def _try_assign_job(db: Session, job_id: str) -> Optional[bool]:
+    # skip_locked so a redelivered task never races the one already on it
+    job: Job | None = (
+        db.query(Job).filter(Job.id == UUID(job_id)).with_for_update(skip_locked=True)
+    ).first()
+    if not job:
+        logger.debug("Job not found or already locked: %s", job_id)
+        return None
+
+    if job.status != "pending":
+        logger.debug("Job already handled: %s", job_id)
+        return None
+
+    machine: Machine | None = machine_index.claim(db, job.requirements)
+    if not machine:
+        # release the job row lock before the caller requeues it
+        db.rollback()
+        return False
+
+    logger.debug("Machine found: %s", machine.id)
+
+    job.status = "assigned"
+    job.machine_id: UUID = machine.id
+    job.vram_gb = vram_allocation(job.requirements, machine.vram_gb or 0)
+    job.lease_expires_at = leases.lease_deadline()
+
+    db.commit()
+    pending_queue.forget(job_id)
+    logger.debug("Job %s assigned to machine: %s", job_id, machine.id)
+
+    publish_start_jobs([(str(machine.id), build_start_message(job, str(machine.id)))])
+    return True
+
+
+def requeue_or_fail(db: Session, job_id: str) -> None:
+    # only a job no machine could ever run uses up its attempts
+    job: Job | None = db.get(Job, job_id)
+    may_fail = job is None or bool(unplaceable_jobs(db, [job]))
+    db.rollback()
+    if pending_queue.requeue(job_id, may_fail):
+        return
+    fail_unplaceable_jobs(db, [job_id])
+
+
+def return_unclaimed_jobs(db: Session, job_ids: list[str]) -> None:
+    """
+    popped jobs that could not be locked or were no longer pending. the ones
+    still pending go back to the queue without an attempt, the rest are
+    forgotten
+    """
+    if not job_ids:
+        return
+    pending = {
+        str(job_id)
+        for (job_id,) in db.query(Job.id).filter(
+            Job.id.in_([UUID(job_id) for job_id in job_ids]), Job.status == "pending"
+        )
+    }
+    pending_queue.put_back([job_id for job_id in job_ids if job_id in pending])
+    pending_queue.forget_many([job_id for job_id in job_ids if job_id not in pending])
+
+
+def fail_unplaceable_jobs(db: Session, job_ids: list[str]) -> None:
+    logger.warning("Jobs ran out of placement attempts: %s", job_ids)
+    db.query(Job).filter(
+        Job.id.in_([UUID(job_id) for job_id in job_ids]), Job.status == "pending"
+    ).update(
+        {
+            Job.status: "failed",
+            Job.error_message: "No machine matched the job requirements",
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+
+
+def request_drain() -> None:
+    # the scheduler loop drains on its own every tick
+    if CONFIG.SCHEDULER_MODE == "task":
+        drain_pending_jobs.delay()
 
 
 @celery_app.task(acks_late=True)
 def process_job_task(job_id: str):
     db: Session = SessionLocal()
     try:
-        print("Processing job: ", job_id)
-        job: Job | None = db.query(Job).filter(Job.id == job_id).first()
-        if not job:
-            print("Job not found")
+        logger.debug("Processing job: %s", job_id)
+        if pending_queue.depth():
+            # other jobs are waiting, queue behind them by priority and share
+            job: Job | None = db.get(Job, job_id)
+            if job is not None and job.status == "pending":
+                pending_queue.push_many([queue_entry(job)])
+            drain_pending_jobs.delay()
             return
 
-        machine: Machine | None = (
-            db.query(Machine)
-            .filter(Machine.is_online.is_(True), Machine.status == "idle")
-            .first()
+        if try_assign_job(db, job_id) is False:
+            logger.debug("No machines available, queued for later: %s", job_id)
+            # never queued so far, the drains count its attempts from here on
+            job = db.get(Job, job_id)
+            if job is not None:
+                pending_queue.push_many([queue_entry(job)])
+    except Exception:
+        db.rollback()
+        logger.exception("Error processing job: %s", job_id)
+    finally:
+        db.close()
+
+
+@celery_app.task
+def drain_pending_jobs(limit: int = CONFIG.PENDING_DRAIN_BATCH):
+    db: Session = SessionLocal()
+    try:
+        # never pop more jobs than there are machines with room for them. the
+        # index is empty after a redis restart, then the database counts them
+        free = machine_index.free_machine_count() or count_free_machines(db)
+        for job_id in pending_queue.pop_due(min(limit, free)):
+            try:
+                assigned = try_assign_job(db, job_id)
+                if assigned is False:
+                    requeue_or_fail(db, job_id)
+                elif assigned is None:
+                    return_unclaimed_jobs(db, [job_id])
+            except Exception:
+                db.rollback()
+                pending_queue.put_back([job_id])
+                logger.exception("Error draining job: %s", job_id)
+    finally:
+        db.close()
+
+
+def requeue_expired_jobs(db: Session) -> int:
+    """reaps expired leases in bounded batches, returns the number of jobs requeued"""
+    reaped = 0
+    # whatever is left over waits for the next run
+    for _ in range(CONFIG.LEASE_REAP_MAX_BATCHES):
+        requeued, failed, machines = leases.reap_expired_leases(
+            db, CONFIG.LEASE_REAP_BATCH
         )
-        if machine:
-            print("Machine found: ", machine.id)
-
-            job.status = "assigned"
-            job.machine_id: UUID = machine.id
-
-            machine.status = "busy"
-
-            db.commit()
-            print("Job assigned to machine: ", machine.id)
-
-            message = {
-                "event": "START_JOB",
-                "machine_id": str(machine.id),
-                "job_id": str(job.id),
-                "code": job.pickled_function.decode("utf-8"),
-            }
-            redis_client.publish("gpu_events", json.dumps(message))
-        else:
-            print("No machines available, retrying later")
-    except Exception as e:
-        print("Error processing job: ", e)
+        if not requeued and not failed:
+            break
+        reaped += len(requeued)
+        pending_queue.push_many(requeued)
+        pipe = redis_client.pipeline(transaction=False)
+        for machine in machines:
+            if machine.is_online:
+                queue_machine_sync(pipe, machine)
+        # followers of the job's logs learn it went back or gave up
+        for job_id, _, _ in requeued:
+            queue_job_event(pipe, job_id, "status", {"status": "pending"})
+        for job_id in failed:
+            queue_job_event(pipe, job_id, "status", {"status": "failed"})
+        pipe.execute()
+    return reaped
+
+
+@celery_app.task
+def sweep_machines():
+    db: Session = SessionLocal()
+    try:
+        silent = sweep_silent_machines(db, redis_client)
+        if silent:
+            logger.info("Machines went silent, marked offline: %d", len(silent))
+    except Exception:
+        db.rollback()
+        logger.exception("Error sweeping machines")
     finally:
         db.close()
+
+
+@celery_app.task
+def reap_expired_job_leases():
+    db: Session = SessionLocal()
+    reaped = 0
+    try:
+        reaped = requeue_expired_jobs(db)
+    except Exception:
+        db.rollback()
+        logger.exception("Error reaping leases")
+    finally:
+        db.close()
+    if reaped:
+        logger.info("Requeued jobs with expired leases: %d", reaped)
+        request_drain()
+
+
+@celery_app.task
+def restore_pending_queue():
+    db: Session = SessionLocal()
+    try:
+        restored = pending_queue.restore(db)
+        logger.info("Restored pending jobs: %d", restored)
+    except Exception:
+        logger.exception("Error restoring pending jobs")
+    finally:
+        db.close()
+
+
+@worker_ready.connect
+def restore_pending_jobs(**kwargs):
+    restore_pending_queue()
+
+
+@worker_process_init.connect
+def init_worker_tracing(**kwargs):
+    setup_tracing()
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import math
+import struct
+import time
+from typing import Any, Optional
+from app.core.config import CONFIG
+from app.services.redis_bridge import redis_bridge
+
+logger = logging.getLogger(__name__)
+
+# one fixed size record per bucket: bucket number, sample count and the sums of
+# gpu util, vram used, temperature and power. averages are sum / count
+RECORD = struct.Struct("<IIffff")
+METRIC_FIELDS = ("gpu_util", "vram_used_gb", "temperature_c", "power_w")
+# far beyond any real reading, keeps the float32 sums of a bucket finite
+METRIC_LIMIT = 1e6
+
+# (name, seconds per bucket, buckets kept). every tier is a ring buffer in one
+# redis string, bucket n lives at offset (n % buckets) * RECORD.size
+TIERS: tuple[tuple[str, int, int], ...] = (
+    ("1s", 1, CONFIG.TELEMETRY_SECOND_BUCKETS),
+    ("1m", 60, CONFIG.TELEMETRY_MINUTE_BUCKETS),
+    ("1h", 3600, CONFIG.TELEMETRY_HOUR_BUCKETS),
+)
+
+
+def metric_value(raw: Any) -> float:
+    """a reading as a float, 0 for one that is missing or not a number"""
+    try:
+        value = float(raw or 0)
+    except (TypeError, ValueError, OverflowError):
+        return 0.0
+    if not math.isfinite(value):
+        return 0.0
+    return max(-METRIC_LIMIT, min(value, METRIC_LIMIT))
+
+
+def metrics_key(machine_id: str, tier: str) -> str:
+    return f"machine_metrics:{machine_id}:{tier}"
+
+
+def choose_tier(
+    start: float, end: float, tier: Optional[str] = None
+) -> tuple[str, int, int]:
+    """
+    the finest tier that still holds start and answers with at most
+    TELEMETRY_MAX_POINTS points, unless the caller asked for one
+    """
+    if tier is not None:
+        for candidate in TIERS:
+            if candidate[0] == tier:
+                return candidate
+        raise ValueError(f"unknown resolution {tier}")
+    now = time.time()
+    for candidate in TIERS:
+        _, seconds, buckets = candidate
+        retained = now - start <= seconds * buckets
+        if retained and (end - start) / seconds <= CONFIG.TELEMETRY_MAX_POINTS:
+            return candidate
+    return TIERS[-1]
+
+
+class TelemetryStore:
+    """
+    downsamples metrics samples per api process, every sample lands in the open
+    bucket of each tier and flush() writes the touched buckets with SETRANGE in
+    one pipeline. reads fetch the bucket range with at most two GETRANGEs per
+    tier, whatever the number of raw samples behind it
+    """
+
+    def __init__(self) -> None:
+        # (machine_id, tier) -> [bucket, count, *sums] of the open bucket
+        self._open: dict[tuple[str, str], list[Any]] = {}
+        self._dirty: set[tuple[str, str]] = set()
+        # buckets that closed before a flush got to write them
+        self._closed: list[tuple[str, str, list[Any]]] = []
+
+    def record(self, machine_id: str, sample: dict[str, Any]) -> None:
+        now = time.time()
+        values = [metric_value(sample.get(field)) for field in METRIC_FIELDS]
+        for tier, seconds, _ in TIERS:
+            bucket = int(now // seconds)
+            key = (machine_id, tier)
+            current = self._open.get(key)
+            if current is not None and current[0] != bucket and key in self._dirty:
+                self._closed.append((machine_id, tier, current))
+            if current is None or current[0] != bucket:
+                # a bucket that was open on another process before a reconnect
+                # is overwritten, at worst one bucket loses its first samples
+                current = [bucket, 0, 0.0, 0.0, 0.0, 0.0]
+                self._open[key] = current
+            current[1] += 1
+            for i, value in enumerate(values):
+                current[2 + i] += value
+            self._dirty.add(key)
+
+    def forget(self, machine_id: str) -> None:
+        """drops the machine's open buckets, unwritten ones still go out next flush"""
+        for tier, _, _ in TIERS:
+            key = (machine_id, tier)
+            current = self._open.pop(key, None)
+            if current is not None and key in self._dirty:
+                self._dirty.discard(key)
+                self._closed.append((machine_id, tier, current))
+
+    async def flush(self) -> int:
+        dirty, self._dirty = self._dirty, set()
+        closed, self._closed = self._closed, []
+        writes = closed + [
+            (machine_id, tier, self._open[(machine_id, tier)])
+            for machine_id, tier in dirty
+            if (machine_id, tier) in self._open
+        ]
+        if not writes:
+            return 0
+        buckets_by_tier = {tier: buckets for tier, _, buckets in TIERS}
+        seconds_by_tier = {tier: seconds for tier, seconds, _ in TIERS}
+        pipe = redis_bridge.binary.pipeline(transaction=False)
+        for machine_id, tier, current in writes:
+            key = metrics_key(machine_id, tier)
+            buckets = buckets_by_tier[tier]
+            pipe.setrange(
+                key, (current[0] % buckets) * RECORD.size, RECORD.pack(*current)
+            )
+            # a machine that goes away takes its history with it after one lap
+            pipe.expire(key, seconds_by_tier[tier] * buckets)
+        await pipe.execute()
+        return len(writes)
+
+    async def run(self, interval: float = CONFIG.TELEMETRY_FLUSH_INTERVAL_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error flushing telemetry")
+
+    async def query(
+        self, machine_id: str, start: float, end: float, tier: Optional[str] = None
+    ) -> tuple[str, list[dict[str, Any]]]:
+        """returns the tier used and its non-empty buckets between start and end"""
+        name, seconds, buckets = choose_tier(start, end, tier)
+        first = int(start // seconds)
+        last = int(end // seconds)
+        # older buckets were overwritten by the ring
+        first = max(first, last - buckets + 1)
+        if last < first:
+            return name, []
+
+        key = metrics_key(machine_id, name)
+        slot = first % buckets
+        count = last - first + 1
+        # (first slot, number of slots), two ranges when the window wraps
+        if slot + count <= buckets:
+            ranges = [(slot, count)]
+        else:
+            ranges = [(slot, buckets - slot), (0, slot + count - buckets)]
+        pipe = redis_bridge.binary.pipeline(transaction=False)
+        for range_slot, range_count in ranges:
+            pipe.getrange(
+                key,
+                range_slot * RECORD.size,
+                (range_slot + range_count) * RECORD.size - 1,
+            )
+        chunks = await pipe.execute()
+        # a ring that has not gone round yet is shorter, pad so offsets line up
+        raw = b"".join(
+            chunk.ljust(range_count * RECORD.size, b"\0")
+            for chunk, (_, range_count) in zip(chunks, ranges)
+        )
+
+        points: list[dict[str, Any]] = []
+        for offset, record in enumerate(RECORD.iter_unpack(raw)):
+            bucket, samples, *sums = record
+            # empty slots and slots from an earlier lap of the ring are skipped
+            if samples == 0 or bucket != first + offset:
+                continue
+            point: dict[str, Any] = {"t": bucket * seconds, "samples": samples}
+            for field, total in zip(METRIC_FIELDS, sums):
+                point[field] = round(total / samples, 3)
+            points.append(point)
+        return name, points
+
+
+telemetry_store = TelemetryStore()
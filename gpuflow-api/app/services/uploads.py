@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import hashlib
+import json
+import os
+import time
+from typing import AsyncIterator, Optional
+import anyio
+from app.core.config import CONFIG
+from app.services.blob_store import blob_store, digest_of_file
+
+logger = logging.getLogger(__name__)
+
+# an upload is a spool file <upload_id> plus <upload_id>.json with its owner and
+# declared length. the spool's size is the offset to resume from, so an upload
+# survives a dropped connection and a restart of the api process holding it
+
+
+class UploadOffsetMismatch(Exception):
+    def __init__(self, offset: int) -> None:
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+class UploadChecksumMismatch(Exception):
+    pass
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadBusy(Exception):
+    pass
+
+
+# uploads with a request appending to them right now, in this process
+_appending: set[str] = set()
+
+
+def spool_root() -> str:
+    return CONFIG.UPLOAD_SPOOL_PATH or os.path.join(CONFIG.BLOB_STORE_PATH, ".uploads")
+
+
+def spool_path(upload_id: str) -> str:
+    return os.path.join(spool_root(), upload_id)
+
+
+def meta_path(upload_id: str) -> str:
+    return spool_path(upload_id) + ".json"
+
+
+def create_upload(upload_id: str, owner: str, length: Optional[int]) -> None:
+    os.makedirs(spool_root(), exist_ok=True)
+    open(spool_path(upload_id), "xb").close()
+    with open(meta_path(upload_id), "w") as meta:
+        json.dump({"owner": owner, "length": length}, meta)
+
+
+def read_upload(upload_id: str) -> Optional[dict]:
+    """owner, declared length and current offset, None for unknown uploads"""
+    try:
+        with open(meta_path(upload_id)) as meta:
+            upload = json.load(meta)
+        upload["offset"] = os.path.getsize(spool_path(upload_id))
+    except FileNotFoundError:
+        return None
+    return upload
+
+
+def is_appending(upload_id: str) -> bool:
+    return upload_id in _appending
+
+
+def remove_upload(upload_id: str) -> None:
+    for path in (spool_path(upload_id), meta_path(upload_id)):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+async def append_chunk(
+    upload_id: str,
+    offset: int,
+    chunks: AsyncIterator[bytes],
+    limit: int,
+    checksum: Optional[str] = None,
+) -> int:
+    """
+    streams one request body onto the end of the spool and returns the new
+    offset. with a checksum the chunk lands whole or not at all, without one
+    whatever arrived before a dropped connection is kept to resume from
+    """
+    if upload_id in _appending:
+        raise UploadBusy()
+    _appending.add(upload_id)
+    try:
+        return await _append(upload_id, offset, chunks, limit, checksum)
+    finally:
+        _appending.discard(upload_id)
+
+
+async def _append(
+    upload_id: str,
+    offset: int,
+    chunks: AsyncIterator[bytes],
+    limit: int,
+    checksum: Optional[str],
+) -> int:
+    path = spool_path(upload_id)
+    start = os.path.getsize(path)
+    if offset != start:
+        raise UploadOffsetMismatch(start)
+    digest = hashlib.sha256()
+    size = start
+    try:
+        async with await anyio.open_file(path, "ab") as spool:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > limit:
+                    raise UploadTooLarge()
+                digest.update(chunk)
+                await spool.write(chunk)
+        if checksum is not None and digest.hexdigest() != checksum:
+            raise UploadChecksumMismatch()
+    except BaseException as e:
+        if checksum is not None or isinstance(e, UploadTooLarge):
+            await anyio.to_thread.run_sync(os.truncate, path, start)
+        raise
+    return size
+
+
+def finish_upload(upload_id: str, digest: str) -> int:
+    """
+    hashes the spool a chunk at a time and moves it into the blob store if it
+    matches digest. returns its size, blocks, run it in a thread
+    """
+    path = spool_path(upload_id)
+    size = os.path.getsize(path)
+    if digest_of_file(path) != digest:
+        raise UploadChecksumMismatch()
+    blob_store.put_file(path, digest)
+    remove_upload(upload_id)
+    return size
+
+
+def remove_stale_uploads() -> int:
+    """drops uploads nobody appended to for UPLOAD_TTL_SECONDS"""
+    cutoff = time.time() - CONFIG.UPLOAD_TTL_SECONDS
+    removed = 0
+    try:
+        names = os.listdir(spool_root())
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if name.endswith(".json"):
+            continue
+        try:
+            stale = os.path.getmtime(spool_path(name)) < cutoff
+        except FileNotFoundError:
+            continue
+        if stale:
+            remove_upload(name)
+            removed += 1
+    return removed
+
+
+async def run_upload_sweeper(
+    interval: float = CONFIG.UPLOAD_SWEEP_INTERVAL_SECONDS,
+):
+    # spools are local to this api process, so is cleaning them up
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await anyio.to_thread.run_sync(remove_stale_uploads)
+        except Exception:
+            logger.exception("Error removing stale uploads")
@@ -1,24 +1,155 @@
-from typing import Dict
+import asyncio
+import logging
+import time
+from contextlib import suppress
+from typing import Callable, Dict, Optional, Union
 from fastapi import WebSocket
+from app.core.config import CONFIG
+from app.core.metrics import (
+    CONNECTED_MACHINES,
+    WEBSOCKET_BYTES,
+    WEBSOCKET_QUEUE_WAIT,
+    WEBSOCKET_SEND_FAILURES,
+    WEBSOCKET_SEND_LATENCY,
+)
+from app.services.wire import JsonCodec, MsgpackCodec, negotiate
+
+logger = logging.getLogger(__name__)
+
+# close code for a machine that could not keep up, "try again later"
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# called with the time the message went out
+OnSent = Callable[[float], None]
+
+
+class MachineConnection:
+    """
+    one machine websocket and the task writing it. messages wait in a bounded
+    queue, so a slow or half dead socket only holds up its own machine
+    """
+
+    def __init__(
+        self,
+        machine_id: str,
+        websocket: WebSocket,
+        codec: Union[JsonCodec, MsgpackCodec],
+    ):
+        self.machine_id = machine_id
+        self.websocket = websocket
+        self.codec = codec
+        self.outbox: asyncio.Queue[tuple[dict, float, Optional[OnSent]]] = (
+            asyncio.Queue(CONFIG.WEBSOCKET_SEND_QUEUE_SIZE)
+        )
+        self.closing = False
+        self.writer = asyncio.create_task(self._write())
+
+    def send(
+        self, message: dict, droppable: bool = False, on_sent: Optional[OnSent] = None
+    ) -> None:
+        if self.closing:
+            # START_JOB stays pending in the stream and is replayed on reconnect
+            return
+        try:
+            self.outbox.put_nowait((message, time.perf_counter(), on_sent))
+        except asyncio.QueueFull:
+            if droppable:
+                WEBSOCKET_SEND_FAILURES.labels("dropped").inc()
+                return
+            self.close_soon("queue_full")
+
+    def close_soon(self, reason: str) -> None:
+        if self.closing:
+            return
+        self.closing = True
+        WEBSOCKET_SEND_FAILURES.labels(reason).inc()
+        logger.warning("Closing websocket of %s: %s", self.machine_id, reason)
+        # the writer may be stuck in a send, the close must not wait behind it
+        self.writer.cancel()
+        self.writer = asyncio.create_task(self._close())
+
+    def stop(self) -> None:
+        self.closing = True
+        self.writer.cancel()
+
+    async def _write(self) -> None:
+        while True:
+            message, queued_at, on_sent = await self.outbox.get()
+            event = message.get("event") or "other"
+            began = time.perf_counter()
+            WEBSOCKET_QUEUE_WAIT.labels(event).observe(began - queued_at)
+            try:
+                payload = self.codec.encode(message)
+                if isinstance(payload, str):
+                    sending = self.websocket.send_text(payload)
+                else:
+                    sending = self.websocket.send_bytes(payload)
+                await asyncio.wait_for(sending, CONFIG.WEBSOCKET_SEND_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                self.close_soon("timeout")
+                return
+            except Exception:
+                # gone meanwhile, the receive loop sees the disconnect
+                self.close_soon("error")
+                return
+            WEBSOCKET_SEND_LATENCY.labels(event).observe(time.perf_counter() - began)
+            WEBSOCKET_BYTES.labels("sent", self.codec.name).inc(len(payload))
+            if on_sent is not None:
+                on_sent(time.time())
+
+    async def _close(self) -> None:
+        # the receive loop of the endpoint gets the disconnect and cleans up
+        with suppress(Exception):
+            await asyncio.wait_for(
+                self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE),
+                CONFIG.WEBSOCKET_SEND_TIMEOUT_SECONDS,
+            )
 
 
 class ConnectionManager:
     def __init__(self):
-        # keeps track of the active connections {machine_id: websocket_connection}
-        self.active_connections: Dict[str, WebSocket] = {}
+        # keeps track of the active connections {machine_id: connection}
+        self.active_connections: Dict[str, MachineConnection] = {}
 
-    async def connect(self, machine_id: str, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections[machine_id] = websocket
+    async def connect(self, machine_id: str, websocket: WebSocket) -> str:
+        """accepts the websocket, returns the protocol agreed with the agent"""
+        codec = negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=codec.subprotocol)
+        previous = self.active_connections.get(machine_id)
+        if previous is not None:
+            # the machine came back before its old socket was noticed gone
+            previous.stop()
+        self.active_connections[machine_id] = MachineConnection(
+            machine_id, websocket, codec
+        )
+        CONNECTED_MACHINES.set(len(self.active_connections))
+        return codec.name
 
-    def disconnect(self, machine_id: str):
-        if machine_id in self.active_connections:
-            del self.active_connections[machine_id]
+    def disconnect(self, machine_id: str, websocket: WebSocket) -> bool:
+        """returns False when a reconnect of the machine replaced this websocket"""
+        connection = self.active_connections.get(machine_id)
+        if connection is None or connection.websocket is not websocket:
+            return False
+        connection.stop()
+        del self.active_connections[machine_id]
+        CONNECTED_MACHINES.set(len(self.active_connections))
+        return True
 
-    async def send_message(self, machine_id: str, message: dict):
-        if machine_id in self.active_connections:
-            websocket = self.active_connections[machine_id]
-            await websocket.send_json(message)
+    async def send_message(
+        self,
+        machine_id: str,
+        message: dict,
+        droppable: bool = False,
+        on_sent: Optional[OnSent] = None,
+    ):
+        """
+        queues the message for the machine's writer and returns right away.
+        when the queue is full a droppable message is dropped, anything else
+        closes the connection
+        """
+        connection = self.active_connections.get(machine_id)
+        if connection is not None:
+            connection.send(message, droppable, on_sent)
 
 
 manager = ConnectionManager()
@@ -0,0 +1,143 @@
+import json
+import zlib
+from typing import Any, Optional, Union
+import msgpack
+from fastapi import WebSocket, WebSocketDisconnect
+from app.core.config import CONFIG
+from app.core.metrics import WEBSOCKET_BYTES
+
+try:
+    import zstandard
+except ImportError:
+    # the zstd extra, without it agents are offered deflate at most
+    zstandard = None
+
+# binary frames start with one byte naming how the msgpack body is compressed,
+# so either side can read any frame whatever was negotiated
+FRAME_RAW = 0
+FRAME_DEFLATE = 1
+FRAME_ZSTD = 2
+
+# websocket subprotocols an agent may offer, the server takes the first one in
+# this order. agents offering none get json text frames like before
+MSGPACK_ZSTD = "gpuflow.v1.msgpack.zstd"
+MSGPACK_DEFLATE = "gpuflow.v1.msgpack.deflate"
+MSGPACK = "gpuflow.v1.msgpack"
+
+
+class WireError(ValueError):
+    pass
+
+
+class JsonCodec:
+    subprotocol: Optional[str] = None
+    name = "json"
+
+    def encode(self, message: dict) -> Union[str, bytes]:
+        # same as starlette's send_json
+        return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+class MsgpackCodec:
+    """
+    msgpack in binary frames, bodies of COMPRESS_MIN_BYTES or more are
+    compressed with the negotiated codec
+    """
+
+    def __init__(self, subprotocol: str, frame: int) -> None:
+        self.subprotocol = subprotocol
+        self.name = subprotocol.removeprefix("gpuflow.v1.")
+        self.frame = frame
+
+    def encode(self, message: dict) -> Union[str, bytes]:
+        body = msgpack.packb(message, use_bin_type=True)
+        if self.frame == FRAME_RAW or len(body) < CONFIG.WEBSOCKET_COMPRESS_MIN_BYTES:
+            return bytes((FRAME_RAW,)) + body
+        if self.frame == FRAME_ZSTD:
+            return bytes((FRAME_ZSTD,)) + zstd_compressor().compress(body)
+        return bytes((FRAME_DEFLATE,)) + zlib.compress(body, 6)
+
+
+JSON = JsonCodec()
+
+# frame type each subprotocol compresses large bodies with
+SUBPROTOCOL_FRAMES = {
+    MSGPACK_ZSTD: FRAME_ZSTD,
+    MSGPACK_DEFLATE: FRAME_DEFLATE,
+    MSGPACK: FRAME_RAW,
+}
+
+_zstd_compressor: Any = None
+
+
+def supported_subprotocols() -> list[str]:
+    if zstandard is None:
+        return [MSGPACK_DEFLATE, MSGPACK]
+    return list(SUBPROTOCOL_FRAMES)
+
+
+def negotiate(offered: list[str]) -> Union[JsonCodec, MsgpackCodec]:
+    """the codec for an agent offering these subprotocols"""
+    if not CONFIG.WEBSOCKET_BINARY_ENABLED:
+        return JSON
+    for subprotocol in supported_subprotocols():
+        if subprotocol in offered:
+            return MsgpackCodec(subprotocol, SUBPROTOCOL_FRAMES[subprotocol])
+    return JSON
+
+
+def zstd_compressor() -> Any:
+    # only ever used from the event loop thread, one is enough
+    global _zstd_compressor
+    if _zstd_compressor is None:
+        _zstd_compressor = zstandard.ZstdCompressor(level=3)
+    return _zstd_compressor
+
+
+def inflate(frame: int, body: bytes) -> bytes:
+    limit = CONFIG.WEBSOCKET_MAX_MESSAGE_BYTES
+    if frame == FRAME_RAW:
+        return body
+    if frame == FRAME_DEFLATE:
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(body, limit)
+        if inflater.unconsumed_tail:
+            raise WireError("message too large")
+        return data
+    if frame == FRAME_ZSTD and zstandard is not None:
+        try:
+            # max_output_size only applies to frames without their size
+            if zstandard.frame_content_size(body) > limit:
+                raise WireError("message too large")
+            return zstandard.ZstdDecompressor().decompress(body, max_output_size=limit)
+        except zstandard.ZstdError as e:
+            raise WireError(str(e)) from e
+    raise WireError(f"unknown frame type {frame}")
+
+
+def decode(payload: Union[str, bytes]) -> dict:
+    """text frames are json, binary frames msgpack whatever was negotiated"""
+    try:
+        if isinstance(payload, str):
+            message = json.loads(payload)
+        else:
+            if not payload:
+                raise WireError("empty frame")
+            message = msgpack.unpackb(inflate(payload[0], payload[1:]), raw=False)
+    except (ValueError, TypeError, zlib.error, msgpack.UnpackException) as e:
+        raise WireError(str(e)) from e
+    if not isinstance(message, dict):
+        raise WireError("message is not an object")
+    return message
+
+
+async def receive_message(websocket: WebSocket, protocol: str) -> dict:
+    """the next message from the agent, raises WireError for one it cannot read"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    payload = message.get("bytes")
+    if payload is None:
+        payload = message["text"]
+    WEBSOCKET_BYTES.labels("received", protocol).inc(len(payload))
+    return decode(payload)
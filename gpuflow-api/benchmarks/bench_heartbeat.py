@@ -0,0 +1,146 @@
+# heartbeat latency with thousands of machines on one api process. every fake
+# machine handles its heartbeats the way websocket_endpoint does, either on the
+# old blocking session or on the async one, and the latency of a heartbeat is
+# the time from when it was due until its lease renewal is committed. runs
+# against the DATABASE_URL from dev.env, seeds its own user, machines and jobs
+# and removes them
+#
+#   python -m benchmarks.bench_heartbeat --machines 5000
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from app.db.session import AsyncSessionLocal, SessionLocal, async_engine
+from app.models.job import Job
+from app.models.machine import Machine
+from app.models.users import User
+from app.services.leases import lease_deadline, renew_leases, renew_leases_statement
+
+
+def seed(db, owner: User, count: int) -> list[uuid.UUID]:
+    machines = [
+        Machine(
+            name=f"bench-{i}",
+            owner_id=owner.id,
+            auth_token=uuid.uuid4().hex,
+            device_id=uuid.uuid4().hex,
+            gpu_name="RTX 4090",
+            vram_gb=24,
+            is_online=True,
+            status="busy",
+            running_jobs=1,
+            vram_allocated_gb=24,
+        )
+        for i in range(count)
+    ]
+    db.add_all(machines)
+    db.flush()
+    machine_ids = [machine.id for machine in machines]
+    # one running job per machine, so every heartbeat renews a real lease
+    db.add_all(
+        Job(
+            creator_id=owner.id,
+            pickled_function=b"print('hello from the benchmark')",
+            status="running",
+            machine_id=machine.id,
+            vram_gb=24,
+            lease_expires_at=lease_deadline(),
+        )
+        for machine in machines
+    )
+    db.commit()
+    return machine_ids
+
+
+def cleanup(db, owner: User) -> None:
+    db.query(Job).filter(Job.creator_id == owner.id).delete()
+    db.query(Machine).filter(Machine.owner_id == owner.id).delete()
+    db.commit()
+
+
+async def sync_machine(machine_id, due: float, args, latencies: list[float]) -> None:
+    # the old handler, the commit holds the event loop for every other machine
+    db = SessionLocal()
+    try:
+        while due < args.stop_at:
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            renew_leases(db, machine_id)
+            db.commit()
+            latencies.append(time.perf_counter() - due)
+            due += args.interval
+    finally:
+        db.close()
+
+
+async def async_machine(machine_id, due: float, args, latencies: list[float]) -> None:
+    async with AsyncSessionLocal() as db:
+        while due < args.stop_at:
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            await db.execute(renew_leases_statement(machine_id))
+            await db.commit()
+            latencies.append(time.perf_counter() - due)
+            due += args.interval
+
+
+async def run(mode: str, machine_ids: list, args) -> list[float]:
+    handler = sync_machine if mode == "sync" else async_machine
+    latencies: list[float] = []
+    started = time.perf_counter()
+    args.stop_at = started + args.duration
+    # heartbeats are spread evenly over the interval, like agents that
+    # connected at random times
+    await asyncio.gather(
+        *(
+            handler(
+                machine_id, started + random.uniform(0, args.interval), args, latencies
+            )
+            for machine_id in machine_ids
+        )
+    )
+    # pooled connections belong to this event loop
+    await async_engine.dispose()
+    return latencies
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def report(mode: str, latencies: list[float], duration: float) -> None:
+    print(
+        f"{mode:5} : {len(latencies) / duration:8.0f} heartbeats/s"
+        f"  p50 {percentile(latencies, 50) * 1000:8.1f}ms"
+        f"  p99 {percentile(latencies, 99) * 1000:8.1f}ms"
+        f"  max {max(latencies) * 1000:8.1f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--machines", type=int, default=5000)
+    parser.add_argument("--interval", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--mode", choices=["sync", "async", "both"], default="both")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    owner = User(email=f"bench-{uuid.uuid4().hex}@gpuflow.local", hashed_password="-")
+    db.add(owner)
+    db.commit()
+    try:
+        machine_ids = seed(db, owner, args.machines)
+        modes = ["sync", "async"] if args.mode == "both" else [args.mode]
+        for mode in modes:
+            latencies = asyncio.run(run(mode, machine_ids, args))
+            report(mode, latencies, args.duration)
+    finally:
+        cleanup(db, owner)
+        db.delete(owner)
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# compares per-job placement (what every process_job_task does, minus the broker
+# round trip) with one batched scheduler tick. runs against the DATABASE_URL and
+# REDIS_URL from dev.env, seeds its own user, machines and jobs and removes them
+#
+#   python -m benchmarks.bench_scheduler --jobs 2000
+import argparse
+import time
+import uuid
+from app.db.session import SessionLocal
+from app.models.job import Job
+from app.models.machine import Machine
+from app.models.users import User
+from app.services.job_queue import pending_queue, queue_entry
+from app.services.matcher import machine_index
+from app.services.scheduler import run_tick
+from app.services.tasks import try_assign_job
+
+GPUS = [("RTX 4090", 24), ("A100", 80), ("T4", 16), ("RTX 3090", 24)]
+
+
+def seed(db, owner: User, count: int) -> tuple[list[Machine], list[Job]]:
+    machines = []
+    jobs = []
+    for i in range(count):
+        gpu_name, vram_gb = GPUS[i % len(GPUS)]
+        machines.append(
+            Machine(
+                name=f"bench-{i}",
+                owner_id=owner.id,
+                auth_token=uuid.uuid4().hex,
+                device_id=uuid.uuid4().hex,
+                gpu_name=gpu_name,
+                vram_gb=vram_gb,
+                is_online=True,
+                status="idle",
+            )
+        )
+        jobs.append(
+            Job(
+                creator_id=owner.id,
+                pickled_function=b"print('hello from the benchmark')",
+                requirements={"min_vram_gb": GPUS[(i * 7) % len(GPUS)][1]},
+                status="pending",
+            )
+        )
+    db.add_all(machines + jobs)
+    db.commit()
+    for machine in machines:
+        machine_index.sync(machine)
+    return machines, jobs
+
+
+def cleanup(db, owner: User) -> None:
+    machines = db.query(Machine).filter(Machine.owner_id == owner.id).all()
+    for machine in machines:
+        machine_index.remove(str(machine.id), machine.gpu_name)
+    job_ids = [
+        str(job_id) for (job_id,) in db.query(Job.id).filter(Job.creator_id == owner.id)
+    ]
+    pending_queue.forget_many(job_ids)
+    db.query(Job).filter(Job.creator_id == owner.id).delete()
+    db.query(Machine).filter(Machine.owner_id == owner.id).delete()
+    db.commit()
+
+
+def bench_per_job(db, owner: User, count: int) -> float:
+    _, jobs = seed(db, owner, count)
+    job_ids = [str(job.id) for job in jobs]
+    started = time.perf_counter()
+    for job_id in job_ids:
+        try_assign_job(db, job_id)
+    return time.perf_counter() - started
+
+
+def bench_batched(db, owner: User, count: int, batch_size: int) -> float:
+    _, jobs = seed(db, owner, count)
+    pending_queue.push_many([queue_entry(job) for job in jobs])
+    started = time.perf_counter()
+    placed = 0
+    while placed < count:
+        done = run_tick(db, batch_size)
+        if not done:
+            break
+        placed += done
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    owner = User(email=f"bench-{uuid.uuid4().hex}@gpuflow.local", hashed_password="-")
+    db.add(owner)
+    db.commit()
+    try:
+        per_job = bench_per_job(db, owner, args.jobs)
+        cleanup(db, owner)
+        batched = bench_batched(db, owner, args.jobs, args.batch_size)
+        cleanup(db, owner)
+    finally:
+        db.delete(owner)
+        db.commit()
+        db.close()
+
+    print(f"per-job : {args.jobs / per_job:10.0f} jobs/s ({per_job:.2f}s)")
+    print(f"batched : {args.jobs / batched:10.0f} jobs/s ({batched:.2f}s)")
+    print(f"speedup : {per_job / batched:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
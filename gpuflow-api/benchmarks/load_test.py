@@ -0,0 +1,469 @@
+# end to end load test. boots the api (uvicorn) and the batched scheduler as
+# subprocesses, connects simulated agents on /ws/machine/{auth_token} that
+# heartbeat, ack, run and complete the jobs they get, submits POST /jobs/ at a
+# fixed rate and reports submit -> assign -> start -> complete latency
+# percentiles and throughput. runs against the DATABASE_URL and REDIS_URL from
+# dev.env, or with --fakeredis against an in-process redis stand in (needs
+# fakeredis and lupa installed). seeds its own user and machines and removes
+# them. the results are written as json, --baseline compares with an older run.
+# --protocol has the agents negotiate the binary websocket framing
+#
+#   python -m benchmarks.load_test --agents 2000 --rate 200 --duration 60
+#   python -m benchmarks.load_test --baseline benchmarks/results/<earlier>.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+import requests
+import websockets
+from app.core.security import create_access_token
+from app.db.session import SessionLocal
+from app.models.job import Job
+from app.models.machine import Machine
+from app.models.users import User
+from app.services.job_queue import pending_queue
+from app.services.matcher import machine_index
+from app.services.wire import JSON, decode, negotiate
+from benchmarks.bench_heartbeat import percentile
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+LATENCIES = ("assign", "start", "complete")
+
+
+class FleetStats:
+    """when each job was submitted, delivered, started and completed"""
+
+    def __init__(self) -> None:
+        self.submitted: dict[str, float] = {}
+        self.assigned: dict[str, float] = {}
+        self.started: dict[str, float] = {}
+        self.completed: dict[str, float] = {}
+        self.rejected = 0
+        self.connected = 0
+        self.disconnected = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fakeredis() -> str:
+    from fakeredis import TcpFakeServer
+
+    port = free_port()
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"redis://127.0.0.1:{port}/0"
+
+
+def start_services(args, env: dict[str, str]) -> list[subprocess.Popen]:
+    log = open(args.log, "ab")
+    api = [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "app.main:app",
+        "--port",
+        str(args.port),
+        "--workers",
+        str(args.workers),
+        "--log-level",
+        "warning",
+    ]
+    scheduler = [sys.executable, "-m", "app.services.scheduler"]
+    return [
+        subprocess.Popen(command, env=env, stdout=log, stderr=log)
+        for command in (api, scheduler)
+    ]
+
+
+def wait_until_up(base_url: str, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(base_url + "/", timeout=1).ok:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"api did not come up on {base_url}")
+
+
+def seed(db, owner: User, args) -> list[str]:
+    machines = [
+        Machine(
+            name=f"load-{i}",
+            owner_id=owner.id,
+            auth_token=uuid.uuid4().hex,
+            device_id=uuid.uuid4().hex,
+            gpu_name="RTX 4090",
+            vram_gb=24,
+            max_concurrent_jobs=args.slots,
+        )
+        for i in range(args.agents)
+    ]
+    db.add_all(machines)
+    db.commit()
+    return [machine.auth_token for machine in machines]
+
+
+def cleanup(db, owner: User) -> None:
+    job_ids = [
+        str(job_id) for (job_id,) in db.query(Job.id).filter(Job.creator_id == owner.id)
+    ]
+    pending_queue.forget_many(job_ids)
+    machines = db.query(Machine).filter(Machine.owner_id == owner.id).all()
+    for machine in machines:
+        machine_index.remove(str(machine.id), machine.gpu_name)
+    db.query(Job).filter(Job.creator_id == owner.id).delete()
+    # the fleet takes any pending job, on a shared database some were not ours
+    db.query(Job).filter(
+        Job.machine_id.in_([machine.id for machine in machines])
+    ).update({Job.machine_id: None}, synchronize_session=False)
+    db.query(Machine).filter(Machine.owner_id == owner.id).delete()
+    db.delete(owner)
+    db.commit()
+
+
+async def send(ws, codec, stats: FleetStats, message: dict) -> None:
+    payload = codec.encode(message)
+    stats.bytes_sent += len(payload)
+    await ws.send(payload)
+
+
+async def run_job(ws, codec, stats: FleetStats, job_id: str, args) -> None:
+    await send(
+        ws,
+        codec,
+        stats,
+        {"type": "job_status", "job_id": job_id, "seq": 1, "status": "running"},
+    )
+    await asyncio.sleep(random.expovariate(1 / args.job_seconds))
+    await send(
+        ws,
+        codec,
+        stats,
+        {
+            "type": "job_status",
+            "job_id": job_id,
+            "seq": 2,
+            "status": "completed",
+            "result": "load-test",
+        },
+    )
+
+
+async def heartbeat(ws, codec, stats: FleetStats, args) -> None:
+    # agents connected at random times, so are their heartbeats
+    await asyncio.sleep(random.uniform(0, args.heartbeat_seconds))
+    while True:
+        await send(ws, codec, stats, {"type": "heartbeat"})
+        await asyncio.sleep(args.heartbeat_seconds)
+
+
+async def agent(token: str, args, stats: FleetStats) -> None:
+    url = f"{args.ws_url}/api/v1/ws/machine/{token}"
+    subprotocols = None
+    if args.protocol != "json":
+        subprotocols = [f"gpuflow.v1.{args.protocol}"]
+    async with websockets.connect(
+        url, open_timeout=120, max_size=None, subprotocols=subprotocols
+    ) as ws:
+        stats.connected += 1
+        # json when the api does not speak the one offered
+        codec = negotiate([ws.subprotocol]) if ws.subprotocol else JSON
+        tasks = {asyncio.create_task(heartbeat(ws, codec, stats, args))}
+        try:
+            async for raw in ws:
+                stats.bytes_received += len(raw)
+                data = decode(raw)
+                now = time.perf_counter()
+                if data.get("event") == "START_JOB":
+                    job_id = data["job_id"]
+                    stats.assigned.setdefault(job_id, now)
+                    await send(
+                        ws,
+                        codec,
+                        stats,
+                        {"type": "ack", "delivery_id": data["delivery_id"]},
+                    )
+                    task = asyncio.create_task(run_job(ws, codec, stats, job_id, args))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif data.get("event") == "JOB_STATUS_ACK" and data.get("applied"):
+                    # a short job's running and completed can share one flush,
+                    # then the completed ack is the first sign it started
+                    stats.started.setdefault(data["job_id"], now)
+                    if data["seq"] == 2:
+                        stats.completed.setdefault(data["job_id"], now)
+        finally:
+            stats.disconnected += 1
+            for task in tasks:
+                task.cancel()
+
+
+async def connect_fleet(tokens: list[str], args, stats: FleetStats) -> list:
+    agents = []
+    for i, token in enumerate(tokens):
+        agents.append(asyncio.create_task(agent(token, args, stats)))
+        # spread the connects, every one of them costs the api a few queries
+        if (i + 1) % args.connect_batch == 0:
+            await asyncio.sleep(args.connect_batch / args.connect_rate)
+    deadline = time.monotonic() + 120
+    while stats.connected < len(tokens) and time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+    return agents
+
+
+def submit(session_for, args, headers: dict) -> tuple[float, Optional[str], int]:
+    sent = time.perf_counter()
+    body: dict = {"code_string": "print('load test')"}
+    if args.job_vram_gb:
+        body["requirements"] = {"min_vram_gb": args.job_vram_gb}
+    try:
+        response = session_for().post(
+            f"{args.base_url}/api/v1/jobs/", json=body, headers=headers, timeout=30
+        )
+    except requests.RequestException:
+        return sent, None, 0
+    if not response.ok:
+        return sent, None, response.status_code
+    return sent, response.json()["id"], response.status_code
+
+
+async def drive(args, stats: FleetStats, headers: dict) -> float:
+    """submits jobs on a fixed schedule, returns how long the window took"""
+    local = threading.local()
+
+    def session_for() -> requests.Session:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(args.concurrency)
+    total = int(args.rate * args.duration)
+    started = time.perf_counter()
+    pending = []
+    for i in range(total):
+        # open loop, a slow api does not slow the arrivals down
+        await asyncio.sleep(max(0.0, started + i / args.rate - time.perf_counter()))
+        pending.append(loop.run_in_executor(pool, submit, session_for, args, headers))
+    for sent, job_id, status in await asyncio.gather(*pending):
+        if job_id is None:
+            stats.rejected += 1
+        else:
+            stats.submitted[job_id] = sent
+    pool.shutdown()
+    return time.perf_counter() - started
+
+
+async def wait_for_completion(args, stats: FleetStats) -> None:
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline:
+        if all(job_id in stats.completed for job_id in stats.submitted):
+            return
+        await asyncio.sleep(0.5)
+
+
+def summarize(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) * 1000,
+        "p50": percentile(values, 50) * 1000,
+        "p90": percentile(values, 90) * 1000,
+        "p99": percentile(values, 99) * 1000,
+        "max": max(values) * 1000,
+    }
+
+
+def build_report(args, stats: FleetStats, window: float) -> dict:
+    latency = {}
+    for name, reached in zip(
+        LATENCIES, (stats.assigned, stats.started, stats.completed)
+    ):
+        latency[name] = summarize(
+            [
+                reached[job_id] - sent
+                for job_id, sent in stats.submitted.items()
+                if job_id in reached
+            ]
+        )
+    first = min(stats.submitted.values(), default=0.0)
+    last = max(stats.completed.values(), default=first)
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("baseline", "output", "log")
+        },
+        "agents_connected": stats.connected,
+        "agents_dropped": stats.disconnected,
+        "submitted": len(stats.submitted),
+        "rejected": stats.rejected,
+        "assigned": len(stats.assigned),
+        "started": len(stats.started),
+        "completed": len(stats.completed),
+        "throughput": {
+            "submitted_per_second": len(stats.submitted) / window if window else 0.0,
+            "completed_per_second": (
+                len(stats.completed) / (last - first) if last > first else 0.0
+            ),
+        },
+        "latency_ms": latency,
+        "websocket_bytes": {
+            "sent": stats.bytes_sent,
+            "received": stats.bytes_received,
+        },
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: dict, baseline: Optional[dict]) -> None:
+    print(
+        f"submitted {report['submitted']}  rejected {report['rejected']}"
+        f"  assigned {report['assigned']}  started {report['started']}"
+        f"  completed {report['completed']}"
+    )
+    for name, value in report["throughput"].items():
+        line = f"{name:22}: {value:10.1f}"
+        if baseline:
+            line += change(baseline["throughput"].get(name), value)
+        print(line)
+    for name in LATENCIES:
+        summary = report["latency_ms"][name]
+        if not summary["count"]:
+            print(f"{name:8}: no samples")
+            continue
+        line = f"{name:8}:"
+        for pct in ("p50", "p90", "p99", "max"):
+            line += f"  {pct} {summary[pct]:9.1f}ms"
+            if baseline:
+                line += change(baseline["latency_ms"][name].get(pct), summary[pct])
+        print(line)
+    for name, value in report["websocket_bytes"].items():
+        line = f"ws bytes {name:13}: {value:10d}"
+        if baseline:
+            line += change(baseline.get("websocket_bytes", {}).get(name), value)
+        print(line)
+
+
+def change(old: Optional[float], new: float) -> str:
+    if not old:
+        return ""
+    return f" ({(new - old) / old * 100:+.0f}%)"
+
+
+async def run(args, tokens: list[str], headers: dict) -> dict:
+    stats = FleetStats()
+    agents = await connect_fleet(tokens, args, stats)
+    print(f"agents connected: {stats.connected} / {len(tokens)}")
+    window = await drive(args, stats, headers)
+    await wait_for_completion(args, stats)
+    for task in agents:
+        task.cancel()
+    await asyncio.gather(*agents, return_exceptions=True)
+    return build_report(args, stats, window)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--agents", type=int, default=1000)
+    parser.add_argument("--slots", type=int, default=1, help="jobs per agent")
+    parser.add_argument("--rate", type=float, default=100.0, help="jobs per second")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--job-seconds", type=float, default=2.0, help="mean runtime")
+    parser.add_argument("--job-vram-gb", type=int, default=0)
+    parser.add_argument("--heartbeat-seconds", type=float, default=30.0)
+    parser.add_argument("--concurrency", type=int, default=64, help="http clients")
+    parser.add_argument("--connect-rate", type=float, default=500.0)
+    parser.add_argument("--connect-batch", type=int, default=50)
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free one")
+    parser.add_argument("--url", help="an api already running, nothing is booted")
+    parser.add_argument("--fakeredis", action="store_true")
+    parser.add_argument(
+        "--protocol",
+        default="json",
+        choices=("json", "msgpack", "msgpack.deflate", "msgpack.zstd"),
+        help="agent websocket framing",
+    )
+    parser.add_argument("--log", default=os.devnull, help="api and scheduler output")
+    parser.add_argument("--output", help="json results, under benchmarks/results")
+    parser.add_argument("--baseline", help="json results of an earlier run")
+    args = parser.parse_args()
+
+    services: list[subprocess.Popen] = []
+    if args.url:
+        args.base_url = args.url.rstrip("/")
+    else:
+        env = dict(os.environ, SCHEDULER_MODE="loop")
+        if args.fakeredis:
+            env["REDIS_URL"] = start_fakeredis()
+        args.port = args.port or free_port()
+        args.base_url = f"http://127.0.0.1:{args.port}"
+        services = start_services(args, env)
+    args.ws_url = args.base_url.replace("http", "ws", 1)
+
+    db = SessionLocal()
+    owner = User(email=f"load-{uuid.uuid4().hex}@gpuflow.local", hashed_password="-")
+    db.add(owner)
+    db.commit()
+    try:
+        wait_until_up(args.base_url)
+        tokens = seed(db, owner, args)
+        headers = {
+            "Authorization": f"Bearer {create_access_token({'sub': str(owner.id)})}"
+        }
+        report = asyncio.run(run(args, tokens, headers))
+    finally:
+        for service in services:
+            service.terminate()
+        for service in services:
+            service.wait(timeout=30)
+        cleanup(db, owner)
+        db.close()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as results:
+            baseline = json.load(results)
+    print_report(report, baseline)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"load_test-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as results:
+        json.dump(report, results, indent=2)
+    print("results written to", output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1011 @@
+# offline discrete event simulator for scheduling policies. replays a trace of
+# job arrivals (owner, priority, runtime, vram, gpu model) and machine churn
+# (up / down) in virtual time through one or more placement policies and
+# reports utilization, queue wait, fairness and makespan. placement is the
+# FreeMachinePool the batched scheduler uses, policies decide which pending job
+# goes next. nothing touches redis or the database except --record
+#
+#   python -m benchmarks.simulator trace.csv.gz --policy fifo --policy fair_share
+#   python -m benchmarks.simulator --synthetic 1000000 --machines 5000
+#   python -m benchmarks.simulator --record trace.csv.gz --since-hours 168
+#
+# a trace is a csv (gzipped when it ends in .gz) with the header
+#   time,event,id,owner,priority,duration,vram_gb,gpu_name,slots,weight
+# event "job": an arrival, vram_gb 0 takes a whole card, weight is the owner's
+#   share weight, the last one seen wins
+# event "up": machine id comes online with vram_gb, gpu_name and slots
+# event "down": machine id goes away, the jobs it runs start over elsewhere
+import argparse
+import csv
+import gzip
+import heapq
+import importlib
+import json
+import math
+import os
+import random
+import time
+from array import array
+from collections import deque
+from datetime import datetime, timezone
+from operator import itemgetter
+from typing import Any, Iterable, Optional
+from app.models.job import JOB_PRIORITIES
+from app.services.matcher import FreeMachinePool
+from benchmarks.load_test import RESULTS_DIR, git_commit
+
+TRACE_FIELDS = (
+    "time",
+    "event",
+    "id",
+    "owner",
+    "priority",
+    "duration",
+    "vram_gb",
+    "gpu_name",
+    "slots",
+    "weight",
+)
+MACHINE_UP, MACHINE_DOWN = 1, 0
+# runtimes below this count as this long in the slowdown, a 1s job that waited
+# a minute is not 60 times worse off than a 1h one that waited an hour
+SLOWDOWN_FLOOR_SECONDS = 10.0
+GPUS = [("RTX 4090", 24), ("A100", 80), ("T4", 16), ("RTX 3090", 24)]
+
+
+class Trace:
+    """
+    a trace in flat arrays, one slot per job or machine event. jobs are indexes
+    into these, owners, requirements and machines are interned
+    """
+
+    def __init__(self) -> None:
+        self.arrival = array("d")
+        self.duration = array("d")
+        self.owner = array("i")
+        # index into JOB_PRIORITIES, highest class first
+        self.priority = array("b")
+        # index into requirements, every distinct (gpu_name, min_vram_gb) once
+        self.shape = array("i")
+        self.requirements: list[dict] = []
+        self.owners: list[str] = []
+        self.weights = array("d")
+        # machine events, in time order
+        self.machine_time = array("d")
+        self.machine_event = array("b")
+        self.machine = array("i")
+        self.machines: list[str] = []
+        # latest (gpu_name, vram_gb, slots) per machine
+        self.specs: list[tuple[Optional[str], int, int]] = []
+        self._owner_index: dict[str, int] = {}
+        self._shape_index: dict[tuple[Optional[str], int], int] = {}
+        self._machine_index: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.arrival)
+
+    def add_job(
+        self,
+        arrival: float,
+        duration: float,
+        owner: str,
+        priority: str = "normal",
+        vram_gb: int = 0,
+        gpu_name: Optional[str] = None,
+        weight: Optional[float] = None,
+    ) -> None:
+        owner_index = self._owner_index.get(owner)
+        if owner_index is None:
+            owner_index = self._owner_index[owner] = len(self.owners)
+            self.owners.append(owner)
+            self.weights.append(1.0)
+        if weight:
+            self.weights[owner_index] = weight
+        shape = (gpu_name or None, vram_gb)
+        shape_index = self._shape_index.get(shape)
+        if shape_index is None:
+            shape_index = self._shape_index[shape] = len(self.requirements)
+            self.requirements.append({"gpu_name": gpu_name, "min_vram_gb": vram_gb})
+        self.arrival.append(arrival)
+        self.duration.append(duration)
+        self.owner.append(owner_index)
+        self.priority.append(
+            JOB_PRIORITIES.index(priority) if priority in JOB_PRIORITIES else 1
+        )
+        self.shape.append(shape_index)
+
+    def add_machine_event(
+        self,
+        when: float,
+        machine: str,
+        up: bool,
+        vram_gb: int = 0,
+        gpu_name: Optional[str] = None,
+        slots: int = 1,
+    ) -> None:
+        machine_index = self._machine_index.get(machine)
+        if machine_index is None:
+            machine_index = self._machine_index[machine] = len(self.machines)
+            self.machines.append(machine)
+            self.specs.append((gpu_name or None, vram_gb, slots))
+        elif up:
+            self.specs[machine_index] = (gpu_name or None, vram_gb, slots)
+        self.machine_time.append(when)
+        self.machine_event.append(MACHINE_UP if up else MACHINE_DOWN)
+        self.machine.append(machine_index)
+
+    def sort(self) -> None:
+        """puts jobs and machine events in time order, a stable sort"""
+        if any(b < a for a, b in zip(self.arrival, self.arrival[1:])):
+            order = sorted(range(len(self.arrival)), key=self.arrival.__getitem__)
+            for name in ("arrival", "duration", "owner", "priority", "shape"):
+                column = getattr(self, name)
+                setattr(
+                    self, name, array(column.typecode, map(column.__getitem__, order))
+                )
+        times = self.machine_time
+        if any(b < a for a, b in zip(times, times[1:])):
+            order = sorted(range(len(times)), key=times.__getitem__)
+            for name in ("machine_time", "machine_event", "machine"):
+                column = getattr(self, name)
+                setattr(
+                    self, name, array(column.typecode, map(column.__getitem__, order))
+                )
+
+
+def open_trace(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", newline="")
+    return open(path, mode, newline="")
+
+
+def load_trace(path: str) -> Trace:
+    trace = Trace()
+    with open_trace(path, "r") as source:
+        for row in csv.DictReader(source):
+            event = row["event"]
+            when = float(row["time"])
+            vram_gb = int(row.get("vram_gb") or 0)
+            gpu_name = row.get("gpu_name") or None
+            if event == "job":
+                trace.add_job(
+                    when,
+                    float(row["duration"]),
+                    row["owner"],
+                    row.get("priority") or "normal",
+                    vram_gb,
+                    gpu_name,
+                    float(row.get("weight") or 0),
+                )
+            elif event in ("up", "down"):
+                trace.add_machine_event(
+                    when,
+                    row["id"],
+                    event == "up",
+                    vram_gb,
+                    gpu_name,
+                    int(row.get("slots") or 1),
+                )
+            else:
+                raise ValueError(f"unknown trace event {event}")
+    trace.sort()
+    return trace
+
+
+def write_trace(trace: Trace, path: str) -> None:
+    """jobs and machine events merged in time order"""
+    with open_trace(path, "w") as target:
+        writer = csv.writer(target)
+        writer.writerow(TRACE_FIELDS)
+        machine_rows = (
+            (
+                trace.machine_time[i],
+                "up" if trace.machine_event[i] == MACHINE_UP else "down",
+                trace.machines[trace.machine[i]],
+                "",
+                "",
+                "",
+                trace.specs[trace.machine[i]][1],
+                trace.specs[trace.machine[i]][0] or "",
+                trace.specs[trace.machine[i]][2],
+                "",
+            )
+            for i in range(len(trace.machine_time))
+        )
+        job_rows = (
+            (
+                trace.arrival[job],
+                "job",
+                job,
+                trace.owners[trace.owner[job]],
+                JOB_PRIORITIES[trace.priority[job]],
+                round(trace.duration[job], 3),
+                trace.requirements[trace.shape[job]]["min_vram_gb"],
+                trace.requirements[trace.shape[job]]["gpu_name"] or "",
+                "",
+                trace.weights[trace.owner[job]],
+            )
+            for job in range(len(trace))
+        )
+        # machines first on a tie, a job may arrive the moment its machine does
+        writer.writerows(heapq.merge(machine_rows, job_rows, key=itemgetter(0)))
+
+
+def synthetic_trace(
+    jobs: int,
+    machines: int,
+    owners: int = 50,
+    job_seconds: float = 600.0,
+    load: float = 0.9,
+    churn_per_hour: float = 0.05,
+    downtime_seconds: float = 900.0,
+    seed: int = 0,
+) -> Trace:
+    """
+    poisson arrivals sized to keep `load` of the slots busy, lognormal runtimes,
+    a few heavy owners, machines that fail at churn_per_hour and come back
+    """
+    rng = random.Random(seed)
+    trace = Trace()
+    slot_choices = (1, 1, 1, 2, 4)
+    total_slots = 0
+    for machine in range(machines):
+        gpu_name, vram_gb = GPUS[machine % len(GPUS)]
+        slots = rng.choice(slot_choices)
+        total_slots += slots
+        trace.add_machine_event(0.0, f"m{machine}", True, vram_gb, gpu_name, slots)
+
+    rate = load * total_slots / job_seconds
+    horizon = jobs / rate
+    if churn_per_hour > 0:
+        failures_per_second = churn_per_hour / 3600
+        for machine in range(machines):
+            gpu_name, vram_gb, slots = trace.specs[machine]
+            when = rng.expovariate(failures_per_second)
+            while when < horizon:
+                trace.add_machine_event(when, f"m{machine}", False)
+                when += rng.expovariate(1 / downtime_seconds)
+                trace.add_machine_event(
+                    when, f"m{machine}", True, vram_gb, gpu_name, slots
+                )
+                when += rng.expovariate(failures_per_second)
+
+    # a few owners submit most of the work
+    owner_weights = [1 / (rank + 1) for rank in range(owners)]
+    owner_names = [f"user{rank}" for rank in range(owners)]
+    submitters = rng.choices(range(owners), owner_weights, k=jobs)
+    sigma = 1.0
+    mu = math.log(job_seconds) - sigma * sigma / 2
+    when = 0.0
+    for job in range(jobs):
+        when += rng.expovariate(rate)
+        vram_gb = rng.choice((0, 0, 4, 8, 16, 24))
+        gpu_name = GPUS[rng.randrange(len(GPUS))][0] if rng.random() < 0.1 else None
+        owner = submitters[job]
+        trace.add_job(
+            when,
+            rng.lognormvariate(mu, sigma),
+            owner_names[owner],
+            rng.choices(JOB_PRIORITIES, (1, 7, 2))[0],
+            vram_gb,
+            gpu_name,
+            # the heaviest owner paid for a bigger share
+            3.0 if owner == 0 else 1.0,
+        )
+    trace.sort()
+    return trace
+
+
+def record_trace(path: str, since_hours: float) -> int:
+    """
+    writes the jobs that ran in the window and today's fleet as a trace. the
+    database keeps no machine history, so every machine is up from the start
+    """
+    from app.db.session import SessionLocal
+    from app.models.job import Job
+    from app.models.machine import Machine
+    from app.models.users import User
+
+    db = SessionLocal()
+    try:
+        since = datetime.now(timezone.utc).timestamp() - since_hours * 3600
+        rows = (
+            db.query(
+                Job.created_at,
+                Job.started_at,
+                Job.completed_at,
+                Job.creator_id,
+                Job.priority,
+                Job.requirements,
+                User.share_weight,
+            )
+            .join(User, User.id == Job.creator_id)
+            .filter(
+                Job.created_at >= datetime.fromtimestamp(since, timezone.utc),
+                Job.started_at.isnot(None),
+                Job.completed_at.isnot(None),
+            )
+            .order_by(Job.created_at)
+            .yield_per(10000)
+        )
+        trace = Trace()
+        start: Optional[float] = None
+        for created, started, completed, owner, priority, requirements, weight in rows:
+            arrival = created.timestamp()
+            if start is None:
+                start = arrival
+            requirements = requirements or {}
+            trace.add_job(
+                arrival - start,
+                max((completed - started).total_seconds(), 0.0),
+                str(owner),
+                priority,
+                int(requirements.get("min_vram_gb") or 0),
+                requirements.get("gpu_name"),
+                weight,
+            )
+        for machine in db.query(Machine).filter(Machine.vram_gb.isnot(None)):
+            trace.add_machine_event(
+                0.0,
+                str(machine.id),
+                True,
+                machine.vram_gb or 0,
+                machine.gpu_name,
+                machine.max_concurrent_jobs or 1,
+            )
+    finally:
+        db.close()
+    write_trace(trace, path)
+    return len(trace)
+
+
+class Policy:
+    """
+    decides which pending job is offered a machine next. every round the
+    simulator pops jobs until the free slots run out, a job that finds no
+    machine goes back through block() and keeps its place. pop() skips the
+    blocked shapes until capacity_freed() reports a machine they fit on, the
+    rest of the pool only shrank meanwhile so asking it again is wasted work.
+    this is what the requeue backoff does for jobs that did not fit in the
+    scheduler
+    """
+
+    name = "policy"
+
+    def __init__(self, trace: Trace) -> None:
+        self.trace = trace
+        # requirements shapes that found no machine since capacity was freed
+        self.blocked: set[int] = set()
+        # (lowercase gpu_name or None, min_vram_gb) per shape, as the index keys it
+        self.shapes = [
+            (
+                (requirements["gpu_name"] or "").strip().lower() or None,
+                requirements["min_vram_gb"],
+            )
+            for requirements in trace.requirements
+        ]
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def push(self, job: int) -> None:
+        raise NotImplementedError
+
+    def pop(self) -> Optional[int]:
+        """the next job whose shape is not blocked, None when there is none"""
+        raise NotImplementedError
+
+    def put_back(self, job: int) -> None:
+        """a job pop() handed out that is to keep its place"""
+        raise NotImplementedError
+
+    def place(
+        self, pool: "FreeMachinePool[SimMachine]", job: int
+    ) -> Optional[tuple[Any, int]]:
+        # tightest fit, what the scheduler does
+        return pool.take(self.trace.requirements[self.trace.shape[job]])
+
+    def block(self, job: int) -> bool:
+        """puts back a job that did not fit, False when its shape was blocked"""
+        shape = self.trace.shape[job]
+        known = shape in self.blocked
+        self.blocked.add(shape)
+        self.put_back(job)
+        return not known
+
+    def capacity_freed(
+        self, gpu_name: Optional[str], capacity: tuple[int, int, int, int]
+    ) -> None:
+        """
+        a job finished on a machine or it came up, capacity as in
+        FreeMachinePool.capacity(). unblocks the shapes that fit there now
+        """
+        if not self.blocked:
+            return
+        vram_gb, allocated, running, slots = capacity
+        if running >= slots:
+            return
+        gpu_name = (gpu_name or "").strip().lower() or None
+        freed = set()
+        for shape in self.blocked:
+            wanted_gpu, min_vram_gb = self.shapes[shape]
+            if wanted_gpu is not None and wanted_gpu != gpu_name:
+                continue
+            # a whole card needs an idle machine, like the idle index
+            if (vram_gb - allocated >= min_vram_gb) if min_vram_gb else not running:
+                freed.add(shape)
+        if freed:
+            self.blocked -= freed
+            self.unblocked(freed)
+
+    def unblocked(self, shapes: set[int]) -> None:
+        """the shapes are worth offering again"""
+
+
+class OrderedPolicy(Policy):
+    """
+    pending jobs in a fixed order given by key(). one heap per shape and a heap
+    of the shape heads, a blocked shape is parked until capacity is freed
+    """
+
+    def __init__(self, trace: Trace) -> None:
+        super().__init__(trace)
+        self.queues: dict[int, list[tuple[Any, int]]] = {}
+        # (key of the shape's head, shape), only for shapes that are not parked
+        self.heads: list[tuple[Any, int]] = []
+        # shape -> key its entry in heads was pushed with, older entries are stale
+        self.head_keys: dict[int, Any] = {}
+        self.parked: set[int] = set()
+        self.size = 0
+
+    def key(self, job: int) -> Any:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        return self.size
+
+    def push(self, job: int) -> None:
+        entry = (self.key(job), job)
+        shape = self.trace.shape[job]
+        queue = self.queues.setdefault(shape, [])
+        heapq.heappush(queue, entry)
+        self.size += 1
+        if shape not in self.parked and queue[0] is entry:
+            self._register(shape)
+
+    def put_back(self, job: int) -> None:
+        self.push(job)
+
+    def pop(self) -> Optional[int]:
+        heads = self.heads
+        while heads:
+            key, shape = heapq.heappop(heads)
+            if self.head_keys.get(shape) != key:
+                continue
+            del self.head_keys[shape]
+            if shape in self.blocked:
+                self.parked.add(shape)
+                continue
+            queue = self.queues[shape]
+            _, job = heapq.heappop(queue)
+            self.size -= 1
+            if queue:
+                self._register(shape)
+            else:
+                del self.queues[shape]
+            return job
+        return None
+
+    def unblocked(self, shapes: set[int]) -> None:
+        for shape in shapes & self.parked:
+            if shape in self.queues:
+                self._register(shape)
+        self.parked -= shapes
+
+    def _register(self, shape: int) -> None:
+        key = self.queues[shape][0][0]
+        self.head_keys[shape] = key
+        heapq.heappush(self.heads, (key, shape))
+
+
+class FifoPolicy(OrderedPolicy):
+    """submission order, what the queue did before priorities and fair share"""
+
+    name = "fifo"
+
+    def key(self, job: int) -> Any:
+        # the trace is in arrival order
+        return job
+
+
+class ShortestFirstPolicy(OrderedPolicy):
+    """
+    shortest runtime first with the runtime known upfront. not something the
+    api can do, a lower bound on mean wait to hold the others against
+    """
+
+    name = "shortest_first"
+
+    def key(self, job: int) -> Any:
+        return (self.trace.duration[job], job)
+
+
+class FairSharePolicy(Policy):
+    """
+    the production queue, see job_queue.py. priority classes highest first and
+    stride scheduling across owners by share weight within a class. an owner
+    whose jobs are all blocked is parked with its pass
+    """
+
+    name = "fair_share"
+
+    def __init__(self, trace: Trace) -> None:
+        super().__init__(trace)
+        classes = len(JOB_PRIORITIES)
+        # per class: owner -> shape -> the owner's jobs of that shape in order
+        self.queues: list[dict[int, dict[int, deque[int]]]] = [
+            {} for _ in range(classes)
+        ]
+        # per class: (pass, owner) of the owners with jobs, and the parked ones
+        self.active: list[list[tuple[float, int]]] = [[] for _ in range(classes)]
+        self.parked: list[dict[int, float]] = [{} for _ in range(classes)]
+        self.vtime = [0.0] * classes
+        self.finish: list[dict[int, float]] = [{} for _ in range(classes)]
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def push(self, job: int) -> None:
+        self._shapes_of(job).setdefault(self.trace.shape[job], deque()).append(job)
+        self.size += 1
+
+    def put_back(self, job: int) -> None:
+        # the pass stays charged, as with pending_queue.put_back
+        self._shapes_of(job).setdefault(self.trace.shape[job], deque()).appendleft(job)
+        self.size += 1
+
+    def pop(self) -> Optional[int]:
+        blocked = self.blocked
+        for priority, active in enumerate(self.active):
+            queues = self.queues[priority]
+            while active:
+                current, owner = heapq.heappop(active)
+                shapes = queues[owner]
+                # the owner's oldest job that can be placed
+                best: Optional[deque[int]] = None
+                for shape, queue in shapes.items():
+                    if shape not in blocked and (best is None or queue[0] < best[0]):
+                        best = queue
+                if best is None:
+                    self.parked[priority][owner] = current
+                    continue
+                job = best.popleft()
+                if not best:
+                    del shapes[self.trace.shape[job]]
+                self.size -= 1
+                finish = current + 1 / self.trace.weights[owner]
+                self.vtime[priority] = current
+                self.finish[priority][owner] = finish
+                if shapes:
+                    heapq.heappush(active, (finish, owner))
+                else:
+                    del queues[owner]
+                return job
+        return None
+
+    def unblocked(self, shapes: set[int]) -> None:
+        for priority, parked in enumerate(self.parked):
+            queues = self.queues[priority]
+            for owner in [
+                owner for owner in parked if not shapes.isdisjoint(queues[owner])
+            ]:
+                heapq.heappush(self.active[priority], (parked.pop(owner), owner))
+
+    def _shapes_of(self, job: int) -> dict[int, deque[int]]:
+        priority = self.trace.priority[job]
+        owner = self.trace.owner[job]
+        shapes = self.queues[priority].get(owner)
+        if shapes is None:
+            shapes = self.queues[priority][owner] = {}
+            # waiting earns no credit, an owner comes back at the current pass
+            start = max(self.vtime[priority], self.finish[priority].get(owner, 0.0))
+            heapq.heappush(self.active[priority], (start, owner))
+        elif (
+            owner in self.parked[priority] and self.trace.shape[job] not in self.blocked
+        ):
+            heapq.heappush(
+                self.active[priority], (self.parked[priority].pop(owner), owner)
+            )
+        return shapes
+
+
+POLICIES: dict[str, type[Policy]] = {
+    policy.name: policy for policy in (FifoPolicy, FairSharePolicy, ShortestFirstPolicy)
+}
+
+
+def policy_class(name: str) -> type[Policy]:
+    """a registered name or "package.module:Class" for one of your own"""
+    if name in POLICIES:
+        return POLICIES[name]
+    if ":" not in name:
+        raise ValueError(f"unknown policy {name}, one of {', '.join(POLICIES)}")
+    module, attribute = name.split(":", 1)
+    return getattr(importlib.import_module(module), attribute)
+
+
+class SimMachine:
+    """the fields FreeMachinePool reads off a Machine row"""
+
+    __slots__ = (
+        "id",
+        "index",
+        "gpu_name",
+        "vram_gb",
+        "vram_allocated_gb",
+        "running_jobs",
+        "max_concurrent_jobs",
+    )
+
+    def __init__(
+        self, index: int, gpu_name: Optional[str], vram_gb: int, slots: int
+    ) -> None:
+        self.id = str(index)
+        self.index = index
+        self.gpu_name = gpu_name
+        self.vram_gb = vram_gb
+        self.vram_allocated_gb = 0
+        self.running_jobs = 0
+        self.max_concurrent_jobs = slots
+
+
+def simulate(trace: Trace, policy: Policy) -> dict[str, Any]:
+    """
+    runs the trace to the end in virtual time. arrivals and machine events are
+    read off the sorted arrays, only completions go through the heap, so the
+    heap never holds more than the running jobs
+    """
+    jobs = len(trace)
+    arrival, duration = trace.arrival, trace.duration
+    machine_time, machine_event, machine_of = (
+        trace.machine_time,
+        trace.machine_event,
+        trace.machine,
+    )
+    machine_events = len(machine_time)
+
+    pool: FreeMachinePool[SimMachine] = FreeMachinePool([])
+    online: dict[int, SimMachine] = {}
+    # machine -> jobs running there
+    running: dict[int, set[int]] = {}
+    # (completion time, job, run), a run number that moved on means preempted
+    completions: list[tuple[float, int, int]] = []
+    run = array("i", [0]) * jobs
+    placed_on = array("i", [-1]) * jobs
+    allocated = array("i", [0]) * jobs
+    queued_since = array("d", arrival)
+    waited = array("d", [0.0]) * jobs
+    completed_at = array("d", [-1.0]) * jobs
+
+    free_slots = 0
+    # time weighted totals: online machines, busy machines, slots, busy slots,
+    # vram, allocated vram
+    levels = [0, 0, 0, 0, 0, 0]
+    areas = [0.0] * 6
+    events = preempted = finished = 0
+    next_job = next_machine = 0
+    now = arrival[0] if jobs else 0.0
+    inf = math.inf
+
+    def release(job: int) -> None:
+        nonlocal free_slots
+        machine = online[placed_on[job]]
+        held = running[machine.index]
+        held.discard(job)
+        pool.release(machine.id, allocated[job])
+        free_slots += 1
+        levels[3] -= 1
+        levels[5] -= allocated[job]
+        if not held:
+            levels[1] -= 1
+        placed_on[job] = -1
+        policy.capacity_freed(machine.gpu_name, pool.capacity(machine.id))
+
+    while True:
+        next_arrival = arrival[next_job] if next_job < jobs else inf
+        next_churn = (
+            machine_time[next_machine] if next_machine < machine_events else inf
+        )
+        next_completion = completions[0][0] if completions else inf
+        moment = min(next_arrival, next_churn, next_completion)
+        if moment == inf:
+            break
+        if finished == jobs:
+            break
+        elapsed = moment - now
+        if elapsed > 0:
+            for level in range(6):
+                areas[level] += levels[level] * elapsed
+        now = moment
+
+        # completions first, the capacity they free is there for this moment
+        while completions and completions[0][0] <= now:
+            _, job, attempt = heapq.heappop(completions)
+            if attempt != run[job]:
+                continue
+            release(job)
+            completed_at[job] = now
+            finished += 1
+            events += 1
+
+        while next_machine < machine_events and machine_time[next_machine] <= now:
+            index = machine_of[next_machine]
+            up = machine_event[next_machine] == MACHINE_UP
+            next_machine += 1
+            events += 1
+            if up and index not in online:
+                gpu_name, vram_gb, slots = trace.specs[index]
+                machine = online[index] = SimMachine(index, gpu_name, vram_gb, slots)
+                running[index] = set()
+                pool.add(machine)
+                free_slots += slots
+                levels[0] += 1
+                levels[2] += slots
+                levels[4] += vram_gb
+                policy.capacity_freed(gpu_name, pool.capacity(machine.id))
+            elif not up and index in online:
+                # the jobs there start over, their wait clock runs again
+                for job in list(running[index]):
+                    release(job)
+                    run[job] += 1
+                    queued_since[job] = now
+                    policy.push(job)
+                    preempted += 1
+                machine = online.pop(index)
+                del running[index]
+                pool.remove(machine.id)
+                free_slots -= machine.max_concurrent_jobs
+                levels[0] -= 1
+                levels[2] -= machine.max_concurrent_jobs
+                levels[4] -= machine.vram_gb
+
+        while next_job < jobs and arrival[next_job] <= now:
+            policy.push(next_job)
+            next_job += 1
+            events += 1
+
+        while free_slots and len(policy):
+            job = policy.pop()
+            if job is None:
+                # everything waiting is blocked
+                break
+            placement = policy.place(pool, job)
+            if placement is None:
+                if not policy.block(job):
+                    # a pop() that ignores blocked shapes, stop the round
+                    break
+                continue
+            machine, vram_gb = placement
+            held = running[machine.index]
+            if not held:
+                levels[1] += 1
+            held.add(job)
+            placed_on[job] = machine.index
+            allocated[job] = vram_gb
+            free_slots -= 1
+            levels[3] += 1
+            levels[5] += vram_gb
+            waited[job] += now - queued_since[job]
+            heapq.heappush(completions, (now + duration[job], job, run[job]))
+
+    return summarize(trace, policy, waited, completed_at, areas, events, preempted)
+
+
+def summarize(
+    trace: Trace,
+    policy: Policy,
+    waited: array,
+    completed_at: array,
+    areas: list[float],
+    events: int,
+    preempted: int,
+) -> dict[str, Any]:
+    done = [job for job in range(len(trace)) if completed_at[job] >= 0]
+    waits = sorted(waited[job] for job in done)
+    first = trace.arrival[0] if len(trace) else 0.0
+    last = max((completed_at[job] for job in done), default=first)
+
+    by_priority: dict[str, list[float]] = {name: [] for name in JOB_PRIORITIES}
+    # owner -> [jobs, summed wait, summed bounded slowdown]
+    owners: dict[int, list[float]] = {}
+    for job in done:
+        wait = waited[job]
+        by_priority[JOB_PRIORITIES[trace.priority[job]]].append(wait)
+        runtime = trace.duration[job]
+        totals = owners.setdefault(trace.owner[job], [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += wait
+        totals[2] += max((wait + runtime) / max(runtime, SLOWDOWN_FLOOR_SECONDS), 1.0)
+    slowdowns = [total / count for count, _, total in owners.values()]
+    mean_waits = [total / count for count, total, _ in owners.values()]
+
+    return {
+        "policy": policy.name,
+        "jobs": len(trace),
+        "finished": len(done),
+        "unfinished": len(trace) - len(done),
+        "preempted": preempted,
+        "events": events,
+        "makespan_seconds": last - first,
+        "utilization": {
+            "machines_busy": ratio(areas[1], areas[0]),
+            "slots_busy": ratio(areas[3], areas[2]),
+            "vram_allocated": ratio(areas[5], areas[4]),
+        },
+        "wait_seconds": distribution(waits),
+        "wait_seconds_by_priority": {
+            name: distribution(sorted(values))
+            for name, values in by_priority.items()
+            if values
+        },
+        "fairness": {
+            "owners": len(owners),
+            # 1 when every owner sees the same mean slowdown, 1/owners at worst
+            "jain_slowdown": jain(slowdowns),
+            "worst_owner_mean_wait_seconds": max(mean_waits, default=0.0),
+        },
+    }
+
+
+def ratio(part: float, whole: float) -> float:
+    return part / whole if whole else 0.0
+
+
+def jain(values: list[float]) -> float:
+    squares = sum(value * value for value in values)
+    return sum(values) ** 2 / (len(values) * squares) if squares else 1.0
+
+
+def distribution(ordered: list[float]) -> dict[str, float]:
+    if not ordered:
+        return {"count": 0}
+
+    def at(pct: float) -> float:
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": at(50),
+        "p90": at(90),
+        "p99": at(99),
+        "max": ordered[-1],
+    }
+
+
+def print_report(report: dict) -> None:
+    wait = report["wait_seconds"]
+    usage = report["utilization"]
+    fairness = report["fairness"]
+    print(
+        f"{report['policy']:15} {report['events']:>10} events"
+        f" {report['wall_seconds']:7.1f}s"
+        f"  finished {report['finished']}/{report['jobs']}"
+        f"  preempted {report['preempted']}"
+    )
+    if wait["count"]:
+        print(
+            f"{'':15} wait mean {wait['mean']:9.1f}s  p50 {wait['p50']:9.1f}s"
+            f"  p99 {wait['p99']:9.1f}s  max {wait['max']:9.1f}s"
+        )
+    print(
+        f"{'':15} makespan {report['makespan_seconds']:11.0f}s"
+        f"  machines busy {usage['machines_busy']:6.1%}"
+        f"  slots busy {usage['slots_busy']:6.1%}"
+        f"  vram {usage['vram_allocated']:6.1%}"
+    )
+    print(
+        f"{'':15} jain slowdown {fairness['jain_slowdown']:.3f}"
+        f"  worst owner mean wait {fairness['worst_owner_mean_wait_seconds']:.1f}s"
+        f"  owners {fairness['owners']}"
+    )
+    for name, waits in report["wait_seconds_by_priority"].items():
+        print(f"{'':15} {name:11} mean {waits['mean']:9.1f}s  p99 {waits['p99']:9.1f}s")
+
+
+def run_policies(
+    trace: Trace, policies: Iterable[type[Policy]]
+) -> list[dict[str, Any]]:
+    reports = []
+    for policy_type in policies:
+        policy = policy_type(trace)
+        began = time.perf_counter()
+        report = simulate(trace, policy)
+        report["wall_seconds"] = time.perf_counter() - began
+        print_report(report)
+        reports.append(report)
+    return reports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", nargs="?", help="csv trace, see the header above")
+    parser.add_argument(
+        "--policy",
+        action="append",
+        help=f"one of {', '.join(POLICIES)} or package.module:Class, repeatable",
+    )
+    parser.add_argument("--synthetic", type=int, help="generate this many jobs")
+    parser.add_argument("--machines", type=int, default=1000)
+    parser.add_argument("--owners", type=int, default=50)
+    parser.add_argument("--job-seconds", type=float, default=600.0)
+    parser.add_argument("--load", type=float, default=0.9, help="offered slot load")
+    parser.add_argument("--churn-per-hour", type=float, default=0.05)
+    parser.add_argument("--downtime-seconds", type=float, default=900.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--write-trace", help="save the synthetic trace here")
+    parser.add_argument("--record", help="write a trace of the database's jobs here")
+    parser.add_argument("--since-hours", type=float, default=24 * 7)
+    parser.add_argument("--output", help="json results, under benchmarks/results")
+    args = parser.parse_args()
+
+    try:
+        policies = [policy_class(name) for name in args.policy or POLICIES]
+    except (ValueError, ImportError, AttributeError) as e:
+        parser.error(str(e))
+
+    if args.record:
+        count = record_trace(args.record, args.since_hours)
+        print(f"{count} jobs written to {args.record}")
+        return
+
+    began = time.perf_counter()
+    if args.synthetic:
+        trace = synthetic_trace(
+            args.synthetic,
+            args.machines,
+            args.owners,
+            args.job_seconds,
+            args.load,
+            args.churn_per_hour,
+            args.downtime_seconds,
+            args.seed,
+        )
+        if args.write_trace:
+            write_trace(trace, args.write_trace)
+    elif args.trace:
+        trace = load_trace(args.trace)
+    else:
+        parser.error("a trace, --synthetic or --record is needed")
+    print(
+        f"{len(trace)} jobs, {len(trace.machines)} machines,"
+        f" {len(trace.machine_time)} machine events"
+        f" loaded in {time.perf_counter() - began:.1f}s"
+    )
+
+    reports = run_policies(trace, policies)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"simulator-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as results:
+        json.dump(
+            {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "git_commit": git_commit(),
+                "config": {
+                    key: value
+                    for key, value in vars(args).items()
+                    if key not in ("output", "record")
+                },
+                "policies": reports,
+            },
+            results,
+            indent=2,
+        )
+    print("results written to", output)
+
+
+if __name__ == "__main__":
+    main()
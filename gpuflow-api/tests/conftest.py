@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+# the settings are read at import, point them at throwaway backends unless the
+# environment names real ones. tests get their own database and redis below
+_scratch = tempfile.mkdtemp(prefix="gpuflow-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_scratch}/app.db")
+os.environ.setdefault("ASYNC_DATABASE_URL", f"sqlite+aiosqlite:///{_scratch}/app.db")
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("CELERY_BROKER_URL", "memory://")
+os.environ.setdefault("CELERY_RESULT_BACKEND", "cache+memory://")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("BLOB_STORE_PATH", f"{_scratch}/blobs")
+
+import fakeredis  # noqa: E402
+import pytest  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.pool import NullPool  # noqa: E402
+from app.db.base_class import Base  # noqa: E402
+from app.models.job import Job  # noqa: E402, F401
+from app.models.machine import Machine  # noqa: E402, F401
+from app.models.users import User  # noqa: E402, F401
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    path = tmp_path / "test.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    return path
+
+
+@pytest.fixture
+def db(database_path):
+    engine = create_engine(f"sqlite:///{database_path}")
+    session = sessionmaker(bind=engine, autoflush=False)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def async_sessions(database_path):
+    """an AsyncSessionLocal stand-in on the same database as `db`"""
+    # no pooling, every asyncio.run() of a test gets connections of its own loop
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{database_path}", poolclass=NullPool
+    )
+    yield async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    engine.sync_engine.dispose()
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis(redis_server):
+    return fakeredis.FakeRedis(server=redis_server, decode_responses=True)
+
+
+@pytest.fixture
+def async_redis(redis_server):
+    return fakeredis.FakeAsyncRedis(server=redis_server, decode_responses=True)
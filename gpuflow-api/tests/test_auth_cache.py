@@ -0,0 +1,157 @@
+import asyncio
+import uuid
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import MissingGreenlet
+from app.api import deps
+from app.core.security import create_access_token
+from app.models.users import User
+from app.services import auth_cache as auth_cache_module
+from app.services.auth_cache import AuthCache, principal_name, token_key
+
+FIELDS = {"id": "1", "email": "a@example.com"}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(auth_cache_module.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def user(db):
+    user = User(email=f"{uuid.uuid4().hex}@example.com", hashed_password="-", credits=7)
+    db.add(user)
+    db.commit()
+    return user
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = AuthCache(max_entries=10, ttl=60)
+    monkeypatch.setattr(deps, "auth_cache", cache)
+    return cache
+
+
+def count_queries(db) -> list[str]:
+    statements: list[str] = []
+    event.listen(
+        db.get_bind(),
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    return statements
+
+
+def test_the_least_recently_used_entry_goes_first(clock):
+    cache = AuthCache(max_entries=2, ttl=60)
+    cache.put("a", "user:a", FIELDS, clock[0] + 60)
+    cache.put("b", "user:b", FIELDS, clock[0] + 60)
+    cache.get("a")
+    cache.put("c", "user:c", FIELDS, clock[0] + 60)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == FIELDS
+    assert cache.get("c") == FIELDS
+
+
+def test_entries_expire_with_their_token_or_the_ttl(clock):
+    cache = AuthCache(max_entries=10, ttl=60)
+    cache.put("expired", "user:a", FIELDS, clock[0] - 1)
+    cache.put("short", "user:a", FIELDS, clock[0] + 10)
+    cache.put("long", "user:a", FIELDS, clock[0] + 3600)
+    assert cache.get("expired") is None
+
+    clock[0] += 30
+    assert cache.get("short") is None
+    assert cache.get("long") == FIELDS
+    clock[0] += 30
+    assert cache.get("long") is None
+
+
+def test_invalidation_drops_every_token_of_the_principal(clock):
+    cache = AuthCache(max_entries=10, ttl=60)
+    cache.put("laptop", "user:a", FIELDS, clock[0] + 60)
+    cache.put("ci", "user:a", FIELDS, clock[0] + 60)
+    cache.put("other", "user:b", FIELDS, clock[0] + 60)
+
+    cache.invalidate("user:a")
+    assert cache.get("laptop") is None
+    assert cache.get("ci") is None
+    assert cache.get("other") == FIELDS
+
+
+def test_workers_share_entries_and_invalidations_through_redis(clock, redis):
+    one = AuthCache(max_entries=10, ttl=60, client=redis, local_ttl=5)
+    two = AuthCache(max_entries=10, ttl=60, client=redis, local_ttl=5)
+    one.put("token", "user:a", FIELDS, clock[0] + 60)
+    assert two.get("token") == FIELDS
+
+    one.invalidate("user:a")
+    assert one.get("token") is None
+    # the other worker's local copy lives out its short ttl
+    assert two.get("token") == FIELDS
+    clock[0] += 5
+    assert two.get("token") is None
+
+
+def test_async_workers_share_entries_and_invalidations(clock, async_redis):
+    one = AuthCache(max_entries=10, ttl=60, async_client=async_redis, local_ttl=0)
+    two = AuthCache(max_entries=10, ttl=60, async_client=async_redis, local_ttl=0)
+
+    async def scenario():
+        await one.aput("token", "user:a", FIELDS, clock[0] + 60)
+        assert await two.aget("token") == FIELDS
+        await two.ainvalidate("user:a")
+        assert await one.aget("token") is None
+
+    asyncio.run(scenario())
+
+
+def test_a_cached_user_is_merged_without_a_query(db, user, cache):
+    token = create_access_token({"sub": str(user.id)})
+    assert deps.get_current_user(db, token).id == user.id
+    db.expunge_all()
+    statements = count_queries(db)
+
+    cached = deps.get_current_user(db, token)
+    assert (cached.id, cached.email) == (user.id, user.email)
+    assert statements == []
+    # columns that are not cached are read from the database on first use
+    assert cached.credits == 7
+    assert len(statements) == 1
+
+
+def test_a_cached_user_is_merged_into_async_sessions(db, user, cache, async_sessions):
+    token = create_access_token({"sub": str(user.id)})
+
+    async def current_user():
+        async with async_sessions() as session:
+            found = await deps.get_current_user_async(session, token)
+            return found.id, found.share_weight
+
+    assert asyncio.run(current_user()) == (user.id, 1)
+    assert cache.get(token_key("user", token)) is not None
+    assert asyncio.run(current_user()) == (user.id, 1)
+
+    cache.invalidate(principal_name("user", user.id))
+    assert cache.get(token_key("user", token)) is None
+
+
+def test_async_principals_refresh_the_columns_that_are_not_cached(
+    db, user, cache, async_sessions
+):
+    token = create_access_token({"sub": str(user.id)})
+    deps.get_current_user(db, token)
+
+    async def credits():
+        async with async_sessions() as session:
+            found = await deps.get_current_user_async(session, token)
+            # no lazy loads in an AsyncSession
+            with pytest.raises(MissingGreenlet):
+                found.credits
+            await session.refresh(found, ["credits"])
+            return found.credits
+
+    assert asyncio.run(credits()) == 7
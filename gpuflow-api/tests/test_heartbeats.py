@@ -0,0 +1,56 @@
+import asyncio
+import uuid
+import pytest
+from pydantic import ValidationError
+from app.models.machine import Machine
+from app.models.users import User
+from app.schemas.machine import HardwareInfoMessage
+from app.services import heartbeats
+from app.services.heartbeats import HeartbeatBuffer
+from app.services.redis_bridge import redis_bridge
+
+
+@pytest.fixture
+def machine(db):
+    owner = User(email=f"{uuid.uuid4().hex}@example.com", hashed_password="-")
+    db.add(owner)
+    db.flush()
+    machine = Machine(
+        name="m", owner_id=owner.id, gpu_name="RTX 4090", vram_gb=24, is_online=True
+    )
+    db.add(machine)
+    db.commit()
+    return machine
+
+
+@pytest.fixture
+def buffer(monkeypatch, async_sessions, async_redis):
+    monkeypatch.setattr(heartbeats, "AsyncSessionLocal", async_sessions)
+    monkeypatch.setattr(redis_bridge, "redis", async_redis)
+    return HeartbeatBuffer()
+
+
+@pytest.mark.parametrize("vram_gb", ["24GB", -1, {"gb": 24}, 2**40])
+def test_bad_vram_is_rejected(vram_gb):
+    with pytest.raises(ValidationError):
+        HardwareInfoMessage.model_validate({"gpu_name": "RTX 4090", "vram_gb": vram_gb})
+
+
+@pytest.mark.parametrize("gpu_name", [{"name": "RTX"}, 4090, "x" * 129])
+def test_bad_gpu_name_is_rejected(gpu_name):
+    with pytest.raises(ValidationError):
+        HardwareInfoMessage.model_validate({"gpu_name": gpu_name, "vram_gb": 24})
+
+
+def test_a_spec_the_database_refuses_does_not_block_later_flushes(db, machine, buffer):
+    machine_id = str(machine.id)
+    buffer.set_hardware(machine_id, "RTX 4090", {"gb": 24})  # type: ignore[arg-type]
+    with pytest.raises(Exception):
+        asyncio.run(buffer.flush())
+
+    # the heartbeat is kept, the spec is not
+    assert asyncio.run(buffer.flush()) == 1
+    db.expire_all()
+    stored = db.get(Machine, machine.id)
+    assert stored.last_seen_at is not None
+    assert stored.vram_gb == 24
@@ -0,0 +1,142 @@
+import uuid
+import pytest
+from app.core.config import CONFIG
+from app.models.job import Job
+from app.models.machine import Machine
+from app.models.users import User
+from app.services import job_queue, tasks
+from app.services.job_queue import (
+    PENDING_ATTEMPTS_KEY,
+    PENDING_OWNERS_KEY,
+    PendingQueue,
+    queue_entry,
+)
+from app.services.matcher import MachineIndex
+
+
+@pytest.fixture
+def queue(redis, monkeypatch):
+    queue = PendingQueue(redis)
+    monkeypatch.setattr(tasks, "pending_queue", queue)
+    return queue
+
+
+@pytest.fixture
+def owner(db):
+    user = User(email=f"{uuid.uuid4().hex}@example.com", hashed_password="-")
+    db.add(user)
+    db.commit()
+    return user
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(job_queue.time, "time", lambda: now[0])
+    return now
+
+
+def add_job(db, owner, status="pending", **fields) -> Job:
+    job = Job(creator_id=owner.id, pickled_function=b"x", status=status, **fields)
+    db.add(job)
+    db.commit()
+    return job
+
+
+def test_unclaimed_jobs_still_pending_go_back_the_rest_are_forgotten(
+    db, queue, owner, redis
+):
+    waiting = add_job(db, owner)
+    finished = add_job(db, owner, status="completed")
+    queue.push_many([queue_entry(waiting), queue_entry(finished)])
+    popped = queue.pop_due(10)
+    assert sorted(popped) == sorted([str(waiting.id), str(finished.id)])
+    # an earlier attempt left a counter behind
+    redis.hset(PENDING_ATTEMPTS_KEY, str(finished.id), 1)
+
+    tasks.return_unclaimed_jobs(db, popped)
+
+    assert queue.pop_due(10) == [str(waiting.id)]
+    assert not redis.hexists(PENDING_OWNERS_KEY, str(finished.id))
+    assert not redis.hexists(PENDING_ATTEMPTS_KEY, str(finished.id))
+
+
+def test_drain_places_jobs_while_the_index_is_cold(
+    db, database_path, queue, owner, redis, monkeypatch
+):
+    # a redis restart emptied the index, the machine itself is free
+    monkeypatch.setattr(tasks, "machine_index", MachineIndex(redis))
+    monkeypatch.setattr(tasks, "redis_client", redis)
+    monkeypatch.setattr(tasks, "SessionLocal", lambda: type(db)(bind=db.get_bind()))
+    machine = Machine(
+        name="m", owner_id=owner.id, gpu_name="RTX 4090", vram_gb=24, is_online=True
+    )
+    db.add(machine)
+    job = add_job(db, owner, requirements={"gpu_name": "RTX 4090"})
+    queue.push_many([queue_entry(job)])
+
+    tasks.drain_pending_jobs()
+
+    db.expire_all()
+    assert db.get(Job, job.id).status == "assigned"
+    assert db.get(Job, job.id).machine_id == machine.id
+    assert queue.depth() == 0
+
+
+def test_owners_share_by_weight_whoever_queued_first(queue):
+    queue.push_many([(f"a{i}", "alice", "normal") for i in range(6)], {"alice": 2})
+    queue.push_many([(f"b{i}", "bob", "normal") for i in range(6)], {"bob": 1})
+
+    popped = queue.pop_due(6)
+    assert sum(job_id.startswith("a") for job_id in popped) == 4
+    assert sum(job_id.startswith("b") for job_id in popped) == 2
+    # each owner's jobs in arrival order
+    alice = [job_id for job_id in popped if job_id.startswith("a")]
+    assert alice == ["a0", "a1", "a2", "a3"]
+    assert queue.depth_of("alice") == 2
+    assert queue.depth() == 6
+
+
+def test_higher_priority_classes_go_first(queue):
+    queue.push("batch", "alice", "batch")
+    queue.push("normal", "alice", "normal")
+    queue.push("interactive", "bob", "interactive")
+
+    assert queue.pop_due(3) == ["interactive", "normal", "batch"]
+
+
+def test_a_job_pushed_twice_keeps_its_place(queue):
+    queue.push_many([("a0", "alice", "normal"), ("a1", "alice", "normal")])
+    queue.push("a0", "alice", "normal")
+
+    assert queue.depth() == 2
+    assert queue.pop_due(3) == ["a0", "a1"]
+
+
+def test_requeued_jobs_back_off_exponentially(queue, clock, monkeypatch):
+    monkeypatch.setattr(CONFIG, "PENDING_BACKOFF_SECONDS", 1.0)
+    monkeypatch.setattr(CONFIG, "PENDING_MAX_BACKOFF_SECONDS", 3.0)
+    queue.push("a0", "alice")
+    for delay in (1, 2, 3, 3):
+        assert queue.pop_due(1) == ["a0"]
+        assert queue.requeue("a0")
+        clock[0] += delay - 0.5
+        assert queue.pop_due(1) == []
+        clock[0] += 0.5
+    assert queue.pop_due(1) == ["a0"]
+
+
+def test_only_jobs_that_may_fail_run_out_of_attempts(queue, clock, monkeypatch):
+    monkeypatch.setattr(CONFIG, "PENDING_MAX_ATTEMPTS", 2)
+    queue.push_many([("fits", "alice", "normal"), ("never", "alice", "normal")])
+    exhausted = []
+    for _ in range(3):
+        popped = queue.pop_due(2)
+        assert sorted(popped) == ["fits", "never"]
+        exhausted = queue.requeue_many(popped, may_fail=["never"])
+        clock[0] += CONFIG.PENDING_MAX_BACKOFF_SECONDS
+
+    assert exhausted == ["never"]
+    # the job that waits for a busy machine stays queued however long it takes
+    assert queue.pop_due(2) == ["fits"]
+    assert queue.depth() == 0
@@ -0,0 +1,104 @@
+import uuid
+import pytest
+from app.models.job import Job
+from app.models.machine import Machine
+from app.models.users import User
+from app.schemas.job import JobStatusMessage, JobUpdate
+from app.services.job_status import JobStatusBuffer, is_stale, write_job_updates
+
+
+@pytest.fixture
+def machine(db):
+    owner = User(email=f"{uuid.uuid4().hex}@example.com", hashed_password="-")
+    db.add(owner)
+    db.flush()
+    machine = Machine(
+        name="m",
+        owner_id=owner.id,
+        gpu_name="RTX 4090",
+        vram_gb=24,
+        is_online=True,
+        status="busy",
+        running_jobs=1,
+        vram_allocated_gb=24,
+    )
+    db.add(machine)
+    db.commit()
+    return machine
+
+
+@pytest.fixture
+def job(db, machine):
+    job = Job(
+        creator_id=machine.owner_id,
+        pickled_function=b"x",
+        status="running",
+        machine_id=machine.id,
+        vram_gb=24,
+        status_seq=2,
+    )
+    db.add(job)
+    db.commit()
+    return job
+
+
+def message(job_id, status, seq) -> JobStatusMessage:
+    return JobStatusMessage(job_id=job_id, status=status, seq=seq)
+
+
+@pytest.mark.parametrize(
+    ("seq", "stale"), [(None, False), (1, True), (2, True), (3, False)]
+)
+def test_updates_at_or_below_the_last_seq_are_stale(seq, stale):
+    job = Job(status_seq=2)
+    assert is_stale(job, JobUpdate(status="running", seq=seq)) is stale
+
+
+def test_a_job_without_updates_takes_any_seq():
+    assert not is_stale(Job(status_seq=None), JobUpdate(status="running", seq=1))
+
+
+def test_the_buffer_keeps_the_newest_update_per_job():
+    buffer = JobStatusBuffer()
+    job_id = uuid.uuid4()
+    buffer.submit("m", message(job_id, "running", 1))
+    buffer.submit("m", message(job_id, "completed", 3))
+    buffer.submit("m", message(job_id, "running", 2))
+
+    assert buffer._pending[str(job_id)][1].seq == 3
+
+
+def test_a_stale_update_is_not_applied(db, machine, job):
+    job_id = str(job.id)
+    applied, stale, machines, _ = write_job_updates(
+        db, {job_id: (str(machine.id), message(job.id, "failed", 2))}
+    )
+
+    assert applied == {}
+    assert stale == {job_id: "Stale seq"}
+    assert machines == []
+    assert job.status == "running"
+
+
+def test_finishing_a_job_releases_its_machine(db, machine, job):
+    job_id = str(job.id)
+    applied, stale, machines, _ = write_job_updates(
+        db, {job_id: (str(machine.id), message(job.id, "completed", 3))}
+    )
+    db.commit()
+
+    assert applied == {job_id: "completed"}
+    assert stale == {}
+    assert [(m.id, m.running_jobs, m.vram_allocated_gb) for m in machines] == [
+        (machine.id, 0, 0)
+    ]
+    assert job.status_seq == 3
+
+
+def test_updates_from_another_machine_are_refused(db, machine, job):
+    job_id = str(job.id)
+    _, stale, _, _ = write_job_updates(
+        db, {job_id: (str(uuid.uuid4()), message(job.id, "completed", 3))}
+    )
+
+    assert stale == {job_id: "Job is not assigned to this machine"}
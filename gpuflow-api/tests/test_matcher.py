@@ -0,0 +1,106 @@
+import uuid
+import pytest
+from app.models.machine import Machine
+from app.models.users import User
+from app.services.matcher import FreeMachinePool, MachineIndex
+
+
+def pool_machine(gpu_name="RTX 4090", vram_gb=24, slots=1, **fields) -> Machine:
+    return Machine(
+        id=uuid.uuid4(),
+        name="m",
+        gpu_name=gpu_name,
+        vram_gb=vram_gb,
+        max_concurrent_jobs=slots,
+        running_jobs=fields.pop("running_jobs", 0),
+        vram_allocated_gb=fields.pop("vram_allocated_gb", 0),
+        **fields,
+    )
+
+
+@pytest.fixture
+def owner(db):
+    user = User(email=f"{uuid.uuid4().hex}@example.com", hashed_password="-")
+    db.add(user)
+    db.commit()
+    return user
+
+
+@pytest.fixture
+def index(redis):
+    return MachineIndex(redis)
+
+
+def add_machine(db, index, owner, **fields) -> Machine:
+    machine = pool_machine(owner_id=owner.id, is_online=True, **fields)
+    db.add(machine)
+    db.commit()
+    index.sync(machine)
+    return machine
+
+
+def test_pool_packs_vram_budgets_tightest_fit_first():
+    small = pool_machine(vram_gb=16, slots=4)
+    large = pool_machine(vram_gb=48, slots=4)
+    pool = FreeMachinePool([large, small])
+
+    assert pool.take({"min_vram_gb": 8}) == (small, 8)
+    assert pool.take({"min_vram_gb": 8}) == (small, 8)
+    # the small card is full, the next budget goes to the large one
+    assert pool.take({"min_vram_gb": 8}) == (large, 8)
+    assert pool.capacity(str(small.id)) == (16, 16, 2, 4)
+
+
+def test_pool_gives_jobs_without_a_budget_a_whole_idle_card():
+    shared = pool_machine(vram_gb=24, slots=2, running_jobs=1, vram_allocated_gb=8)
+    idle = pool_machine(vram_gb=24, slots=2)
+    pool = FreeMachinePool([shared, idle])
+
+    assert pool.take(None) == (idle, 24)
+    # the other card still runs a job, and shares only what it has left
+    assert pool.take(None) is None
+    assert pool.take({"min_vram_gb": 16}) == (shared, 16)
+    assert pool.free_slots() == 1
+
+
+def test_pool_matches_the_gpu_model_and_takes_back_releases():
+    a100 = pool_machine(gpu_name="A100", vram_gb=80)
+    pool = FreeMachinePool([a100, pool_machine(gpu_name="RTX 4090")])
+
+    assert pool.take({"gpu_name": "a100 "}) == (a100, 80)
+    assert pool.take({"gpu_name": "A100"}) is None
+    pool.release(str(a100.id), 80)
+    assert pool.take({"gpu_name": "A100"}) == (a100, 80)
+
+
+def test_claim_takes_a_slot_and_the_vram(db, index, owner):
+    machine = add_machine(db, index, owner, vram_gb=24, slots=2)
+
+    assert index.claim(db, {"min_vram_gb": 16}) is machine
+    db.commit()
+    assert (machine.running_jobs, machine.vram_allocated_gb) == (1, 16)
+    # 8GB left, a second 16GB job does not fit whatever the index said before
+    assert index.claim(db, {"min_vram_gb": 16}) is None
+    assert index.claim(db, {"min_vram_gb": 8}) is machine
+    assert index.free_machine_count() == 0
+
+
+def test_claim_skips_machines_gone_from_the_database(db, index, owner, redis):
+    gone = pool_machine()
+    index.sync(gone)
+    machine = add_machine(db, index, owner, vram_gb=48)
+
+    assert index.claim(db, None) is machine
+    assert not redis.zscore("idle_machines:all", str(gone.id))
+
+
+def test_claim_falls_back_to_the_database_when_the_index_is_cold(
+    db, index, owner, redis
+):
+    machine = add_machine(db, index, owner, slots=2)
+    redis.flushall()
+
+    assert index.claim(db, {"min_vram_gb": 8}) is machine
+    assert (machine.running_jobs, machine.vram_allocated_gb) == (1, 8)
+    # and warms the index on the way
+    assert redis.zscore("free_vram:all", str(machine.id)) == 16
@@ -0,0 +1,21 @@
+import uuid
+from app.services.result_cache import memo_key
+
+DETERMINISTIC = {"deterministic": True, "gpu": "A100"}
+
+
+def test_same_job_of_the_same_user_shares_the_entry():
+    owner = uuid.uuid4()
+    first = memo_key(owner, "a" * 64, "[1]", None, DETERMINISTIC)
+    second = memo_key(owner, "a" * 64, "[1]", None, dict(DETERMINISTIC))
+    assert first is not None
+    assert first == second
+
+
+def test_users_never_share_an_entry():
+    job = ("a" * 64, "[1]", "b" * 64, DETERMINISTIC)
+    assert memo_key(uuid.uuid4(), *job) != memo_key(uuid.uuid4(), *job)
+
+
+def test_jobs_that_did_not_opt_in_have_no_key():
+    assert memo_key(uuid.uuid4(), "a" * 64, None, None, {"gpu": "A100"}) is None
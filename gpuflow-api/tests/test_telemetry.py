@@ -0,0 +1,65 @@
+import asyncio
+import time
+import fakeredis
+import pytest
+from app.services import telemetry
+from app.services.redis_bridge import redis_bridge
+from app.services.telemetry import METRIC_LIMIT, TelemetryStore
+
+
+@pytest.fixture
+def store(redis_server, monkeypatch):
+    binary = fakeredis.FakeAsyncRedis(server=redis_server)
+    monkeypatch.setattr(redis_bridge, "binary", binary)
+    return TelemetryStore()
+
+
+def test_samples_average_per_bucket(store):
+    now = time.time()
+    store.record("m", {"gpu_util": 50, "temperature_c": "60"})
+    store.record("m", {"gpu_util": 100, "temperature_c": 70})
+    asyncio.run(store.flush())
+
+    _, points = asyncio.run(store.query("m", now - 5, now + 5, "1m"))
+    [point] = points
+    assert point["samples"] == 2
+    assert point["gpu_util"] == 75
+    assert point["temperature_c"] == 65
+    assert point["vram_used_gb"] == 0
+
+
+@pytest.mark.parametrize(
+    "raw", ["hot", {"c": 70}, [70], float("nan"), float("inf"), 10**400]
+)
+def test_a_malformed_reading_counts_as_zero(store, raw):
+    now = time.time()
+    store.record("m", {"gpu_util": 40, "temperature_c": raw})
+    asyncio.run(store.flush())
+
+    _, [point] = asyncio.run(store.query("m", now - 5, now + 5, "1m"))
+    assert point["gpu_util"] == 40
+    assert point["temperature_c"] == 0
+
+
+def test_huge_readings_are_clamped(store):
+    now = time.time()
+    store.record("m", {"power_w": 1e300})
+    asyncio.run(store.flush())
+
+    _, [point] = asyncio.run(store.query("m", now - 5, now + 5, "1m"))
+    assert point["power_w"] == METRIC_LIMIT
+
+
+def test_the_ring_overwrites_its_oldest_bucket(store, monkeypatch):
+    monkeypatch.setattr(telemetry, "TIERS", (("1s", 1, 4),))
+    clock = [1000.0]
+    monkeypatch.setattr(telemetry.time, "time", lambda: clock[0])
+    for second in range(6):
+        clock[0] = 1000.0 + second
+        store.record("m", {"gpu_util": second})
+    asyncio.run(store.flush())
+
+    _, points = asyncio.run(store.query("m", 1000, 1005, "1s"))
+    # a lap of four buckets, the first two were written over
+    assert [point["t"] for point in points] == [1002, 1003, 1004, 1005]
+    assert [point["gpu_util"] for point in points] == [2, 3, 4, 5]
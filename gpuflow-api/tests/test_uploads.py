@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import os
+import time
+import pytest
+from app.core.config import CONFIG
+from app.services import uploads
+from app.services.blob_store import LocalBlobStore
+from app.services.uploads import (
+    UploadBusy,
+    UploadChecksumMismatch,
+    UploadOffsetMismatch,
+    UploadTooLarge,
+    append_chunk,
+    create_upload,
+    finish_upload,
+    read_upload,
+    remove_stale_uploads,
+)
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG, "UPLOAD_SPOOL_PATH", str(tmp_path / "spool"))
+    store = LocalBlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr(uploads, "blob_store", store)
+    return store
+
+
+async def body(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+async def dropped(*chunks: bytes):
+    """a request body whose connection drops after the chunks"""
+    for chunk in chunks:
+        yield chunk
+    raise ConnectionResetError()
+
+
+def append(offset, chunks, limit=1024, checksum=None) -> int:
+    return asyncio.run(append_chunk("up", offset, chunks, limit, checksum))
+
+
+def test_an_upload_resumes_from_its_offset_and_lands_in_the_blob_store(store):
+    create_upload("up", "user:a", 10)
+    assert read_upload("up") == {"owner": "user:a", "length": 10, "offset": 0}
+    assert append(0, body(b"hello")) == 5
+    assert append(5, body(b"wor", b"ld")) == 10
+
+    digest = hashlib.sha256(b"helloworld").hexdigest()
+    assert finish_upload("up", digest) == 10
+    assert store.get(digest) == b"helloworld"
+    assert read_upload("up") is None
+
+
+def test_an_append_at_the_wrong_offset_is_told_the_right_one():
+    create_upload("up", "user:a", None)
+    append(0, body(b"hello"))
+
+    with pytest.raises(UploadOffsetMismatch) as mismatch:
+        append(2, body(b"llo"))
+    assert mismatch.value.offset == 5
+
+
+def test_a_dropped_connection_keeps_what_arrived():
+    create_upload("up", "user:a", None)
+    with pytest.raises(ConnectionResetError):
+        append(0, dropped(b"hel", b"lo"))
+
+    assert read_upload("up")["offset"] == 5
+
+
+def test_a_chunk_with_a_checksum_lands_whole_or_not_at_all():
+    create_upload("up", "user:a", None)
+    append(0, body(b"hello"))
+    with pytest.raises(ConnectionResetError):
+        append(5, dropped(b"wor"), checksum=hashlib.sha256(b"world").hexdigest())
+    with pytest.raises(UploadChecksumMismatch):
+        append(5, body(b"word"), checksum=hashlib.sha256(b"world").hexdigest())
+    assert read_upload("up")["offset"] == 5
+
+    checksum = hashlib.sha256(b"world").hexdigest()
+    assert append(5, body(b"world"), checksum=checksum) == 10
+
+
+def test_an_upload_stops_at_the_limit():
+    create_upload("up", "user:a", None)
+    append(0, body(b"hello"))
+
+    with pytest.raises(UploadTooLarge):
+        append(5, body(b"wor", b"ld"), limit=8)
+    assert read_upload("up")["offset"] == 5
+
+
+def test_one_append_at_a_time():
+    create_upload("up", "user:a", None)
+
+    async def both():
+        gate = asyncio.Event()
+
+        async def slow():
+            await gate.wait()
+            yield b"hello"
+
+        first = asyncio.create_task(append_chunk("up", 0, slow(), 1024))
+        await asyncio.sleep(0)
+        with pytest.raises(UploadBusy):
+            await append_chunk("up", 0, body(b"x"), 1024)
+        gate.set()
+        return await first
+
+    assert asyncio.run(both()) == 5
+
+
+def test_a_blob_that_does_not_match_its_digest_is_refused(store):
+    create_upload("up", "user:a", None)
+    append(0, body(b"hello"))
+
+    with pytest.raises(UploadChecksumMismatch):
+        finish_upload("up", hashlib.sha256(b"world").hexdigest())
+    assert read_upload("up")["offset"] == 5
+
+
+def test_abandoned_uploads_are_swept():
+    create_upload("old", "user:a", None)
+    create_upload("new", "user:a", None)
+    past = time.time() - CONFIG.UPLOAD_TTL_SECONDS - 1
+    os.utime(uploads.spool_path("old"), (past, past))
+
+    assert remove_stale_uploads() == 1
+    assert read_upload("old") is None
+    assert read_upload("new") is not None
@@ -0,0 +1,25 @@
+import pytest
+from app.api.v1.endpoints.websockets import is_delivery_id
+
+
+@pytest.mark.parametrize("delivery_id", ["1700000000000-0", "0-1"])
+def test_stream_ids_are_acked(delivery_id):
+    assert is_delivery_id(delivery_id)
+
+
+@pytest.mark.parametrize(
+    "delivery_id",
+    [
+        None,
+        1700000000000,
+        ["1-0"],
+        {"id": "1-0"},
+        "",
+        "abc",
+        "1-0 ",
+        "1-0-0",
+        "9" * 20 + "-0",
+    ],
+)
+def test_anything_else_is_not(delivery_id):
+    assert not is_delivery_id(delivery_id)
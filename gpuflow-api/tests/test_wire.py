@@ -0,0 +1,86 @@
+import zlib
+import msgpack
+import pytest
+import zstandard
+from app.core.config import CONFIG
+from app.services import wire
+from app.services.wire import (
+    FRAME_DEFLATE,
+    FRAME_ZSTD,
+    JSON,
+    MSGPACK,
+    MSGPACK_DEFLATE,
+    MSGPACK_ZSTD,
+    WireError,
+    decode,
+    negotiate,
+)
+
+LIMIT = 64 * 1024
+
+
+@pytest.fixture(autouse=True)
+def small_messages(monkeypatch):
+    monkeypatch.setattr(CONFIG, "WEBSOCKET_MAX_MESSAGE_BYTES", LIMIT)
+
+
+def test_the_best_offered_codec_wins():
+    assert negotiate([MSGPACK, MSGPACK_ZSTD]).subprotocol == MSGPACK_ZSTD
+    assert negotiate([MSGPACK, MSGPACK_DEFLATE]).subprotocol == MSGPACK_DEFLATE
+    assert negotiate(["something-else"]) is JSON
+    assert negotiate([]) is JSON
+
+
+def test_zstd_is_not_offered_without_the_extra(monkeypatch):
+    monkeypatch.setattr(wire, "zstandard", None)
+    assert negotiate([MSGPACK_ZSTD, MSGPACK]).subprotocol == MSGPACK
+
+
+def test_binary_frames_can_be_switched_off(monkeypatch):
+    monkeypatch.setattr(CONFIG, "WEBSOCKET_BINARY_ENABLED", False)
+    assert negotiate([MSGPACK_ZSTD]) is JSON
+
+
+@pytest.mark.parametrize("subprotocol", [MSGPACK_ZSTD, MSGPACK_DEFLATE, MSGPACK])
+def test_messages_round_trip(subprotocol):
+    codec = negotiate([subprotocol])
+    message = {"type": "log", "data": "x" * 10_000, "bytes": b"\x00\x01"}
+    assert decode(codec.encode(message)) == message
+
+
+def test_json_text_frames_round_trip():
+    assert decode(JSON.encode({"type": "heartbeat"})) == {"type": "heartbeat"}
+
+
+def bomb() -> bytes:
+    return msgpack.packb({"data": "x" * (LIMIT * 4)})
+
+
+def test_deflate_stops_at_the_limit():
+    frame = bytes((FRAME_DEFLATE,)) + zlib.compress(bomb())
+    with pytest.raises(WireError, match="too large"):
+        decode(frame)
+
+
+def test_zstd_stops_at_the_declared_size():
+    frame = bytes((FRAME_ZSTD,)) + zstandard.ZstdCompressor().compress(bomb())
+    with pytest.raises(WireError, match="too large"):
+        decode(frame)
+
+
+def test_zstd_stops_at_the_limit_without_a_declared_size():
+    compressor = zstandard.ZstdCompressor(write_content_size=False)
+    small = bytes((FRAME_ZSTD,)) + compressor.compress(msgpack.packb({"a": 1}))
+    assert decode(small) == {"a": 1}
+    frame = bytes((FRAME_ZSTD,)) + compressor.compress(bomb())
+    with pytest.raises(WireError):
+        decode(frame)
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [b"", b"\x07" + msgpack.packb({}), b"\x00" + msgpack.packb([1]), "{", "[]"],
+)
+def test_unreadable_frames_raise_wire_errors(payload):
+    with pytest.raises(WireError):
+        decode(payload)
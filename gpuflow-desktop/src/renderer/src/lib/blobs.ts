@@ -0,0 +1,45 @@
+const BLOBS_URL = 'http://localhost:8000/api/v1/blobs'
+const CACHE_NAME = 'gpuflow-blobs'
+
+const toHex = (buffer: ArrayBuffer): string =>
+  Array.from(new Uint8Array(buffer))
+    .map((byte) => byte.toString(16).padStart(2, '0'))
+    .join('')
+
+// blobs are named by the sha256 of their content, a cached blob never goes stale
+// so the server is only asked for digests this machine has not seen before
+export const getBlob = async (digest: string, authToken: string): Promise<ArrayBuffer> => {
+  const cache = await caches.open(CACHE_NAME)
+  const url = `${BLOBS_URL}/${digest}`
+  const cached = await cache.match(url)
+  if (cached) {
+    return cached.arrayBuffer()
+  }
+
+  const response = await fetch(url, {
+    headers: { Authorization: `Bearer ${authToken}` }
+  })
+  if (!response.ok) {
+    throw new Error(`Failed to fetch blob ${digest}: ${response.status}`)
+  }
+  const data = await response.arrayBuffer()
+  if (toHex(await crypto.subtle.digest('SHA-256', data)) !== digest) {
+    throw new Error(`Blob ${digest} does not match its digest`)
+  }
+  await cache.put(url, new Response(data))
+  return data
+}
+
+// START_JOB carries either the code inline or only the digest of it
+export const getJobCode = async (
+  job: { code?: string; code_hash?: string },
+  authToken: string
+): Promise<string> => {
+  if (job.code !== undefined) {
+    return job.code
+  }
+  if (!job.code_hash) {
+    throw new Error('Job has no code')
+  }
+  return new TextDecoder().decode(await getBlob(job.code_hash, authToken))
+}
@@ -1,3 +1,5 @@
+import { getJobCode } from './blobs'
+
 export class MachineConnection {
   private ws: WebSocket | null = null
   private authToken: string
@@ -37,7 +39,15 @@ export class MachineConnection {
         
         if (data.event === 'START_JOB') {
           console.log('⚡ New job received:', data.job_id)
-          // TODO: Handle job execution
+          // acked on arrival, before the code download, the server resends an
+          // unacked START_JOB on every reconnect
+          this.ackDelivery(data.delivery_id)
+          getJobCode(data, this.authToken)
+            .then((code) => {
+              console.log(`📦 Code ready for job ${data.job_id} (${code.length} chars)`)
+              // TODO: Handle job execution
+            })
+            .catch((error) => console.error('Failed to load job code:', error))
         }
       } catch (error) {
         console.error('Failed to parse message:', error)
@@ -93,6 +103,12 @@ export class MachineConnection {
     return this.ws !== null && this.ws.readyState === WebSocket.OPEN
   }
 
+  private ackDelivery(deliveryId: string | undefined): void {
+    if (deliveryId && this.ws && this.ws.readyState === WebSocket.OPEN) {
+      this.ws.send(JSON.stringify({ type: 'ack', delivery_id: deliveryId }))
+    }
+  }
+
   sendHardwareInfo(gpuName: string, vramGB: number): void {
     if (this.ws && this.ws.readyState === WebSocket.OPEN) {
       this.ws.send(JSON.stringify({
@@ -103,6 +119,40 @@ export class MachineConnection {
       console.log('📊 Hardware info sent to server')
     }
   }
+
+  // everything cached locally, sent on connect and whenever it changes. jobs
+  // naming one of these images or environments are placed here first
+  sendCacheInventory(images: string[], environments: string[]): void {
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+      this.ws.send(JSON.stringify({ type: 'cache_inventory', images, environments }))
+    }
+  }
+
+  // stdout / stderr of a running job, followed live by the job's owner
+  sendLog(jobId: string, stream: 'stdout' | 'stderr', data: string): void {
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+      this.ws.send(JSON.stringify({ type: 'log', job_id: jobId, stream, data }))
+    }
+  }
+
+  // seq counts up per job, the server drops updates older than one it applied
+  // and answers each with a JOB_STATUS_ACK, unacked ones are resent on reconnect
+  sendJobStatus(
+    jobId: string,
+    seq: number,
+    status: 'running' | 'completed' | 'failed',
+    details: { result_hash?: string; error_message?: string } = {}
+  ): void {
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+      this.ws.send(JSON.stringify({ type: 'job_status', job_id: jobId, seq, status, ...details }))
+    }
+  }
+
+  sendProgress(jobId: string, progress: number, message?: string): void {
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+      this.ws.send(JSON.stringify({ type: 'progress', job_id: jobId, progress, message }))
+    }
+  }
 }
 
 // Global connection manager